@@ -6,7 +6,7 @@ import sys
 import time
 
 from channel import channel_factory
-from common import const
+from common import const, tokenizer
 from config import load_config
 from plugins import *
 import threading
@@ -44,6 +44,8 @@ def run():
     try:
         # load config
         load_config()
+        # 后台预加载token计算所需的编码
+        tokenizer.preload()
         # ctrl + c
         sigterm_handler_wrap(signal.SIGINT)
         # kill signal
@@ -5,6 +5,7 @@ Auto-replay chat robot abstract class
 
 from bridge.context import Context
 from bridge.reply import Reply
+from common.async_utils import run_in_thread
 
 
 class Bot(object):
@@ -15,3 +16,13 @@ class Bot(object):
         :return: reply content
         """
         raise NotImplementedError
+
+    async def areply(self, query, context: Context = None) -> Reply:
+        """
+        async version of reply, used in async_mode
+        http api bots implement it natively with common.http_client's async pool,
+        bots without native async support run the sync reply in a thread
+        :param req: received message
+        :return: reply content
+        """
+        return await run_in_thread(self.reply, query, context)
@@ -0,0 +1,202 @@
+"""
+Chat completion bot
+
+OpenAI风格对话接口的bot共用的处理流程：管理命令、会话查询、回复构建和失败重试。
+子类设置LOG_TAG和MODEL_KEY，实现_build_request(必要时重写_parse_response)，同步和异步回复共用同一套请求构建和响应解析，
+不通过HTTP接口调用的bot可以重写_complete和_acomplete。
+"""
+
+import asyncio
+import time
+
+from bot.bot import Bot
+from bridge.context import ContextType
+from bridge.reply import Reply, ReplyType
+from common import http_client
+from common.log import logger
+from config import conf_snapshot, load_config
+
+
+class ChatCompletionBot(Bot):
+    LOG_TAG = "[CHAT]"  # 日志前缀
+    MODEL_KEY = "gpt_model"  # context中指定对话模型的key
+    MAX_RETRIES = 2  # 最多重试次数
+    RATE_LIMIT_DELAY = 3  # 接口返回429时重试前等待的秒数
+    SERVER_ERROR_DELAY = 3  # 接口返回5xx时重试前等待的秒数
+    EXCEPTION_DELAY = 3  # 请求异常时重试前等待的秒数
+
+    def reply(self, query, context=None):
+        if context.type != ContextType.TEXT:
+            return self._reply_other(query, context)
+        logger.info("{} query={}".format(self.LOG_TAG, query))
+        reply = self._handle_command(query, context)
+        if reply:
+            return reply
+        session, args = self._session_query(query, context)
+        return self._reply_session(session, self._api_key(context), args, context)
+
+    async def areply(self, query, context=None):
+        if context.type != ContextType.TEXT:
+            return await super().areply(query, context)
+        logger.info("{} query={}".format(self.LOG_TAG, query))
+        reply = self._handle_command(query, context)
+        if reply:
+            return reply
+        session, args = self._session_query(query, context)
+        reply_content = await self.areply_text(session, self._api_key(context), args)
+        return self._build_reply(session, reply_content)
+
+    def _reply_other(self, query, context):
+        """
+        处理文本以外的消息
+        """
+        return Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
+
+    def _reply_session(self, session, api_key, args, context):
+        return self._build_reply(session, self.reply_text(session, api_key, args))
+
+    def _handle_command(self, query, context):
+        reply = None
+        clear_memory_commands = conf_snapshot().get("clear_memory_commands", ["#清除记忆"])
+        if query in clear_memory_commands:
+            self.sessions.clear_session(context["session_id"])
+            reply = Reply(ReplyType.INFO, "记忆已清除")
+        elif query == "#清除所有":
+            self.sessions.clear_all_session()
+            reply = Reply(ReplyType.INFO, "所有人记忆已清除")
+        elif query == "#更新配置":
+            load_config()
+            reply = Reply(ReplyType.INFO, "配置已更新")
+        return reply
+
+    def _api_key(self, context):
+        """
+        context中指定的api key，为None时使用默认配置
+        """
+        return None
+
+    def _session_query(self, query, context):
+        session = self.sessions.session_query(query, context["session_id"])
+        logger.debug("%s session query=%s", self.LOG_TAG, session.messages)
+
+        args = self.args.copy()
+        model = context.get(self.MODEL_KEY)
+        if model:
+            args["model"] = model
+        return session, args
+
+    def _build_reply(self, session, reply_content: dict) -> Reply:
+        session_id = session.session_id
+        logger.debug(
+            "%s new_query=%s, session_id=%s, reply_cont=%s, completion_tokens=%s",
+            self.LOG_TAG,
+            session.messages,
+            session_id,
+            reply_content["content"],
+            reply_content["completion_tokens"],
+        )
+        if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
+            reply = Reply(ReplyType.ERROR, reply_content["content"])
+        elif reply_content["completion_tokens"] > 0:
+            if isinstance(reply_content["content"], dict):
+                new_content = reply_content["content"]
+                reply_content["content"] = new_content.get("content")
+                self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
+                reply = Reply(ReplyType.IMAGE_AND_TEXT, new_content)
+            else:
+                self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
+                reply = Reply(ReplyType.TEXT, reply_content["content"])
+        else:
+            reply = Reply(ReplyType.ERROR, reply_content["content"])
+            logger.debug("%s reply %s used 0 tokens.", self.LOG_TAG, reply_content)
+        return reply
+
+    def reply_text(self, session, api_key=None, args=None) -> dict:
+        """
+        请求对话接口获取回复，失败时按返回的等待时间重试
+        :return: {"content": 回复内容, "completion_tokens": 回复token数, "total_tokens": 总token数}
+        """
+        args = args or self.args
+        retry_count = 0
+        while True:
+            try:
+                result, retry_delay = self._complete(session, api_key, args)
+            except Exception as e:
+                result, retry_delay = self._handle_error(e, session)
+            if retry_delay is None or retry_count >= self.MAX_RETRIES:
+                return result
+            retry_count += 1
+            logger.warn("{} 第{}次重试".format(self.LOG_TAG, retry_count))
+            time.sleep(retry_delay)
+
+    async def areply_text(self, session, api_key=None, args=None) -> dict:
+        """
+        async version of reply_text
+        """
+        args = args or self.args
+        retry_count = 0
+        while True:
+            try:
+                result, retry_delay = await self._acomplete(session, api_key, args)
+            except Exception as e:
+                result, retry_delay = self._handle_error(e, session)
+            if retry_delay is None or retry_count >= self.MAX_RETRIES:
+                return result
+            retry_count += 1
+            logger.warn("{} 第{}次重试".format(self.LOG_TAG, retry_count))
+            await asyncio.sleep(retry_delay)
+
+    def _complete(self, session, api_key, args):
+        """
+        发送一次请求
+        :return: (回复结果, 重试前等待的秒数，不需要重试时为None)
+        """
+        url, headers, body = self._build_request(session, args)
+        res = http_client.post(url, headers=headers, json=body)
+        return self._parse_response(res.status_code, res.json())
+
+    async def _acomplete(self, session, api_key, args):
+        url, headers, body = self._build_request(session, args)
+        res = await http_client.apost(url, headers=headers, json=body)
+        return self._parse_response(res.status_code, res.json())
+
+    def _build_request(self, session, args):
+        """
+        :return: (url, headers, 请求体)
+        """
+        raise NotImplementedError
+
+    def _parse_response(self, status_code, response):
+        """
+        解析OpenAI格式的接口返回
+        :return: (回复结果, 重试前等待的秒数，不需要重试时为None)
+        """
+        if status_code == 200:
+            return {
+                "total_tokens": response["usage"]["total_tokens"],
+                "completion_tokens": response["usage"]["completion_tokens"],
+                "content": response["choices"][0]["message"]["content"],
+            }, None
+        error = response.get("error") or {}
+        logger.error(
+            "{} chat failed, status_code={}, msg={}, type={}".format(self.LOG_TAG, status_code, error.get("message"), error.get("type") or error.get("code"))
+        )
+        result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
+        retry_delay = None
+        if status_code == 401:
+            result["content"] = "授权失败，请检查API Key是否正确"
+        elif status_code == 429:
+            result["content"] = "提问太快啦，请休息一下再问我吧"
+            retry_delay = self.RATE_LIMIT_DELAY
+        elif status_code >= 500:
+            result["content"] = "请再问我一次"
+            retry_delay = self.SERVER_ERROR_DELAY
+        return result, retry_delay
+
+    def _handle_error(self, e, session):
+        """
+        请求抛出异常时生成错误回复
+        :return: (错误回复, 重试前等待的秒数，不需要重试时为None)
+        """
+        logger.exception("{} Exception: {}".format(self.LOG_TAG, e))
+        return {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}, self.EXCEPTION_DELAY
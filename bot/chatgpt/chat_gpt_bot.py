@@ -1,22 +1,21 @@
 # encoding:utf-8
 
-import time
-import base64
 import openai
 import openai.error
 import requests
-import io
 from common import const
+from common import http_client
 from bot.bot import Bot
+from bot.chat_completion_bot import ChatCompletionBot
 from bot.chatgpt.chat_gpt_session import ChatGPTSession
 from bot.openai.open_ai_image import OpenAIImage
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
 from common.log import logger
-from common.token_bucket import TokenBucket
-from config import conf, load_config
-import json
+from common.stream_utils import StreamContent
+from common.token_bucket import KeyedTokenBucket, TokenBucket
+from config import conf, conf_snapshot
 # from plugins.ddg import DDGSearch, DDGSearchAPIError
 from plugins.tools import Tools, DDGSearchAPIError
 
@@ -24,7 +23,10 @@ from plugins.tools import Tools, DDGSearchAPIError
 from bot.baidu.baidu_wenxin_session import BaiduWenxinSession
 
 # OpenAI对话模型API (可用)
-class ChatGPTBot(Bot, OpenAIImage):
+class ChatGPTBot(ChatCompletionBot, OpenAIImage):
+    LOG_TAG = "[CHATGPT]"
+    MODEL_KEY = "gpt_model"
+
     def __init__(self):
         super().__init__()
         # set the default api_key
@@ -36,6 +38,8 @@ class ChatGPTBot(Bot, OpenAIImage):
             openai.proxy = proxy
         if conf().get("rate_limit_chatgpt"):
             self.tb4chatgpt = TokenBucket(conf().get("rate_limit_chatgpt", 20))
+        if conf().get("rate_limit_chatgpt_per_user"):
+            self.tb4user = KeyedTokenBucket(conf().get("rate_limit_chatgpt_per_user"))
         if conf().get('enable_tools'):
             self.tools = Tools()
         conf_model = conf().get("model") or "gpt-3.5-turbo"
@@ -59,144 +63,154 @@ class ChatGPTBot(Bot, OpenAIImage):
             for key in remove_keys:
                 self.args.pop(key, None)  # 如果键不存在，使用 None 来避免抛出错误
 
-    def reply(self, query, context=None):
-        model = context.get('gpt_model') or conf().get("model") or "gpt-3.5-turbo"
-        # acquire reply content
-        if context.type == ContextType.TEXT:
-            logger.info("[CHATGPT] query={}".format(query))
-            session_id = context["session_id"]
-            reply = None
-            clear_memory_commands = conf().get("clear_memory_commands", ["#清除记忆"])
-            if query in clear_memory_commands:
-                self.sessions.clear_session(session_id)
-                reply = Reply(ReplyType.INFO, "记忆已清除")
-            elif query == "#清除所有":
-                self.sessions.clear_all_session()
-                reply = Reply(ReplyType.INFO, "所有人记忆已清除")
-            elif query == "#更新配置":
-                load_config()
-                reply = Reply(ReplyType.INFO, "配置已更新")
-            if reply:
-                return reply
-            session = self.sessions.session_query(query, session_id)
-            logger.debug("[CHATGPT] session query={}".format(session.messages))
-
-            api_key = context.get("openai_api_key")
-            model = context.get("gpt_model")
-            new_args = None
-            if model:
-                new_args = self.args.copy()
-                new_args["model"] = model
-            # if context.get('stream'):
-            #     # reply in stream
-            #     return self.reply_text_stream(query, new_query, session_id)
+    async def areply(self, query, context=None):
+        # 工具调用和流式回复暂不支持异步请求，在线程中执行
+        if hasattr(self, "tools") or context.get("stream"):
+            return await Bot.areply(self, query, context)
+        return await super().areply(query, context)
 
-            reply_content = self.reply_text(session, api_key, args=new_args)
-            logger.debug(
-                "[CHATGPT] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
-                    session.messages,
-                    session_id,
-                    reply_content["content"],
-                    reply_content["completion_tokens"],
-                )
-            )
-            if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
-                reply = Reply(ReplyType.ERROR, reply_content["content"])
-            elif reply_content["completion_tokens"] > 0:
-                if isinstance(reply_content["content"], dict):
-                    new_content = reply_content["content"]
-                    reply_content["content"] = new_content.get('content')
-                    self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
-                    reply = Reply(ReplyType.IMAGE_AND_TEXT, new_content)
-                else:
-                    self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
-                    reply = Reply(ReplyType.TEXT, reply_content["content"])
-            else:
-                reply = Reply(ReplyType.ERROR, reply_content["content"])
-                logger.debug("[CHATGPT] reply {} used 0 tokens.".format(reply_content))
-            return reply
-        elif context.type == ContextType.IMAGE_CREATE:
+    def _reply_other(self, query, context):
+        if context.type == ContextType.IMAGE_CREATE:
             ok, retstring = self.create_img(query, 0)
-            reply = None
             if ok:
-                reply = Reply(ReplyType.IMAGE_URL, retstring)
-            else:
-                reply = Reply(ReplyType.ERROR, retstring)
-            return reply
+                return Reply(ReplyType.IMAGE_URL, retstring)
+            return Reply(ReplyType.ERROR, retstring)
+        if context.type in [ContextType.IMAGE, ContextType.FILE, ContextType.VIDEO]:
+            if context.get("isgroup", False):
+                return
+            return Reply(ReplyType.ERROR, "请切换模型处理{}类型的消息".format(context.type))
+        return super()._reply_other(query, context)
+
+    def _reply_session(self, session, api_key, args, context):
+        if context.get("stream") and not hasattr(self, "tools"):
+            return self.reply_text_stream(session, api_key, args=args)
+        return super()._reply_session(session, api_key, args, context)
+
+    def _handle_command(self, query, context):
+        return super()._handle_command(query, context) or self._check_user_rate_limit(context)
+
+    # 单个用户超出每分钟提问次数时直接回复提示，不等待令牌，避免占用处理线程
+    def _check_user_rate_limit(self, context):
+        if not hasattr(self, "tb4user"):
+            return None
+        cmsg = context.get("msg")
+        if cmsg is None:
+            user_id = context["session_id"]
         else:
-            if context.type in [ContextType.IMAGE, ContextType.FILE, ContextType.VIDEO]:
-                if context.get("isgroup", False):
-                    return
-                else:
-                    reply = Reply(ReplyType.ERROR, "请切换模型处理{}类型的消息".format(context.type))
-            else:
-                reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
-            return reply
+            user_id = cmsg.actual_user_id if context.get("isgroup", False) else cmsg.from_user_id
+        if not self.tb4user.try_acquire(user_id):
+            logger.warn("[CHATGPT] user rate limit exceeded, user_id={}".format(user_id))
+            return Reply(ReplyType.ERROR, "提问太快啦，请休息一下再问我吧")
+        return None
 
-    def reply_text(self, session: ChatGPTSession, api_key=None, args=None, retry_count=0) -> dict:
+    def _api_key(self, context):
+        # if api_key == None, the default openai.api_key will be used
+        return context.get("openai_api_key")
+
+    def _complete(self, session: ChatGPTSession, api_key, args):
         """
         call openai's ChatCompletion to get the answer
-        :param session: a conversation session
-        :param session_id: session id
-        :param retry_count: retry count
-        :return: {}
+        """
+        if conf_snapshot().rate_limit_chatgpt and not self.tb4chatgpt.get_token():
+            raise openai.error.RateLimitError("RateLimitError: rate limit exceeded")
+        # if hasattr(self, 'ddg_search'):
+        if hasattr(self, 'tools'):
+            logger.debug("[CHATGPT] reply from %s", 'DDG Search')
+            response = self.tools.run_conversation(api_key, session.messages, **args)
+        else:
+            response = openai.ChatCompletion.create(api_key=api_key, messages=session.messages, **args)
+        return self._parse_completion(response), None
+
+    async def _acomplete(self, session: ChatGPTSession, api_key, args):
+        """
+        async version of _complete, call openai's ChatCompletion.acreate
+        """
+        if conf_snapshot().rate_limit_chatgpt and not await self.tb4chatgpt.aget_token():
+            raise openai.error.RateLimitError("RateLimitError: rate limit exceeded")
+        # openai默认每次请求新建aiohttp会话，这里使用共享的连接池
+        openai.aiosession.set(http_client.get_async_session())
+        response = await openai.ChatCompletion.acreate(api_key=api_key, messages=session.messages, **args)
+        return self._parse_completion(response), None
+
+    def _parse_completion(self, response):
+        return {
+            "total_tokens": response["usage"]["total_tokens"],
+            "completion_tokens": response["usage"]["completion_tokens"],
+            "content": response.choices[0]["message"]["content"],
+        }
+
+    def reply_text_stream(self, session: ChatGPTSession, api_key=None, args=None) -> Reply:
+        """
+        call openai's ChatCompletion in stream mode
+        :return: STREAM类型的回复，内容为逐段生成文本的迭代器，请求失败时改为普通请求
         """
         try:
-            if conf().get("rate_limit_chatgpt") and not self.tb4chatgpt.get_token():
+            if conf_snapshot().rate_limit_chatgpt and not self.tb4chatgpt.get_token():
                 raise openai.error.RateLimitError("RateLimitError: rate limit exceeded")
-            # if api_key == None, the default openai.api_key will be used
             if args is None:
                 args = self.args
-            # if hasattr(self, 'ddg_search'):
-            if hasattr(self, 'tools'):
-                logger.debug("[CHATGPT] reply from {}".format('DDG Search'))
-                response = self.tools.run_conversation(api_key, session.messages, **args)
-            else:
-                response = openai.ChatCompletion.create(api_key=api_key, messages=session.messages, **args)
-            # logger.debug("[CHATGPT] response={}".format(response))
-            # logger.info("[ChatGPT] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
-            return {
-                "total_tokens": response["usage"]["total_tokens"],
-                "completion_tokens": response["usage"]["completion_tokens"],
-                "content": response.choices[0]["message"]["content"],
-            }
+            response = openai.ChatCompletion.create(api_key=api_key, messages=session.messages, stream=True, **args)
         except Exception as e:
-            need_retry = retry_count < 2
-            result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-            if isinstance(e, openai.error.RateLimitError):
-                logger.warn("[CHATGPT] RateLimitError: {}".format(e))
-                result["content"] = "提问太快啦，请休息一下再问我吧"
-                if need_retry:
-                    time.sleep(20)
-            elif isinstance(e, openai.error.Timeout):
-                logger.warn("[CHATGPT] Timeout: {}".format(e))
-                result["content"] = "我没有收到你的消息"
-                if need_retry:
-                    time.sleep(5)
-            elif isinstance(e, openai.error.APIError):
-                logger.warn("[CHATGPT] Bad Gateway: {}".format(e))
-                result["content"] = "请再问我一次"
-                if need_retry:
-                    time.sleep(10)
-            elif isinstance(e, openai.error.APIConnectionError):
-                logger.warn("[CHATGPT] APIConnectionError: {}".format(e))
-                result["content"] = "我连接不到你的网络"
-                if need_retry:
-                    time.sleep(5)
-            elif isinstance(e, DDGSearchAPIError):
-                logger.warn("[CHATGPT] DDGSearchAPIError: {}".format(e))
-                need_retry = False
-                result["content"] = str(e)
-            else:
-                logger.exception("[CHATGPT] Exception: {}".format(e))
-                need_retry = False
-                self.sessions.clear_session(session.session_id)
+            logger.warn("[CHATGPT] stream request failed, fallback to normal request: {}".format(e))
+            return self._build_reply(session, self.reply_text(session, api_key, args=args))
+        contents = []
+
+        def on_close():
+            # 生成结束或中断后把已生成的内容记入会话
+            content = "".join(contents)
+            if content:
+                self.sessions.session_reply(content, session.session_id)
+            logger.debug("[CHATGPT] stream reply finished, session_id=%s, reply_cont=%s", session.session_id, content)
 
-            if need_retry:
-                logger.warn("[CHATGPT] 第{}次重试".format(retry_count + 1))
-                return self.reply_text(session, api_key, args, retry_count + 1)
-            else:
-                return result
+        return Reply(ReplyType.STREAM, StreamContent(self._stream_chunks(response, contents), on_close))
+
+    def _stream_chunks(self, response, contents):
+        """
+        逐段返回生成的文本，同时追加到contents
+        """
+        try:
+            for chunk in response:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].get("delta", {}).get("content")
+                if delta:
+                    contents.append(delta)
+                    yield delta
+        except Exception as e:
+            logger.warn("[CHATGPT] stream interrupted: {}".format(e))
+            if not contents:
+                yield "我现在有点累了，等会再来吧"
+
+    def _handle_error(self, e, session: ChatGPTSession):
+        """
+        根据异常类型生成错误回复
+        :return: (错误回复, 重试前等待的秒数, 不需要重试时为None)
+        """
+        retry_delay = None
+        result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
+        if isinstance(e, openai.error.RateLimitError):
+            logger.warn("[CHATGPT] RateLimitError: {}".format(e))
+            result["content"] = "提问太快啦，请休息一下再问我吧"
+            retry_delay = 20
+        elif isinstance(e, openai.error.Timeout):
+            logger.warn("[CHATGPT] Timeout: {}".format(e))
+            result["content"] = "我没有收到你的消息"
+            retry_delay = 5
+        elif isinstance(e, openai.error.APIError):
+            logger.warn("[CHATGPT] Bad Gateway: {}".format(e))
+            result["content"] = "请再问我一次"
+            retry_delay = 10
+        elif isinstance(e, openai.error.APIConnectionError):
+            logger.warn("[CHATGPT] APIConnectionError: {}".format(e))
+            result["content"] = "我连接不到你的网络"
+            retry_delay = 5
+        elif isinstance(e, DDGSearchAPIError):
+            logger.warn("[CHATGPT] DDGSearchAPIError: {}".format(e))
+            result["content"] = str(e)
+        else:
+            logger.exception("[CHATGPT] Exception: {}".format(e))
+            self.sessions.clear_session(session.session_id)
+        return result, retry_delay
 
 
 class AzureChatGPTBot(ChatGPTBot):
@@ -219,13 +233,13 @@ class AzureChatGPTBot(ChatGPTBot):
             headers = {"api-key": api_key, "Content-Type": "application/json"}
             try:
                 body = {"prompt": query, "size": conf().get("image_create_size", "256x256"),"n": 1}
-                submission = requests.post(url, headers=headers, json=body)
+                submission = http_client.post(url, headers=headers, json=body)
                 operation_location = submission.headers['operation-location']
                 status = ""
                 while (status != "succeeded"):
                     if retry_count > 3:
                         return False, "图片生成失败"
-                    response = requests.get(operation_location, headers=headers)
+                    response = http_client.get(operation_location, headers=headers)
                     status = response.json()['status']
                     retry_count += 1
                 image_url = response.json()['result']['data'][0]['url']
@@ -244,7 +258,7 @@ class AzureChatGPTBot(ChatGPTBot):
             headers = {"api-key": api_key, "Content-Type": "application/json"}
             try:
                 body = {"prompt": query, "size": conf().get("image_create_size", "1024x1024"), "quality": conf().get("dalle3_image_quality", "standard")}
-                response = requests.post(url, headers=headers, json=body)
+                response = http_client.post(url, headers=headers, json=body)
                 response.raise_for_status()  # 检查请求是否成功
                 data = response.json()
 
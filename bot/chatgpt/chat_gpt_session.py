@@ -1,6 +1,6 @@
 from bot.session_manager import Session
 from common.log import logger
-from common import const
+from common import const, tokenizer
 
 """
     e.g.  [
@@ -21,19 +21,21 @@ class ChatGPTSession(Session):
     def discard_exceeding(self, max_tokens, cur_tokens=None):
         precise = True
         try:
-            cur_tokens = self.calc_tokens()
+            message_tokens = self.message_tokens(self.count_message_tokens)
+            cur_tokens = sum(message_tokens) + reply_priming_tokens(self.model)
         except Exception as e:
             precise = False
             if cur_tokens is None:
                 raise e
-            logger.debug("Exception when counting tokens precisely for query: {}".format(e))
+            logger.debug("Exception when counting tokens precisely for query: %s", e)
+        # 从最早的消息开始丢弃，使用缓存的每条消息token数更新总数，不需要重新计算整个会话
         while cur_tokens > max_tokens:
             if len(self.messages) > 2:
                 self.messages.pop(1)
             elif len(self.messages) == 2 and self.messages[1]["role"] == "assistant":
                 self.messages.pop(1)
                 if precise:
-                    cur_tokens = self.calc_tokens()
+                    cur_tokens -= message_tokens.pop(1)
                 else:
                     cur_tokens = cur_tokens - max_tokens
                 break
@@ -41,61 +43,74 @@ class ChatGPTSession(Session):
                 logger.warn("user message exceed max_tokens. total_tokens={}".format(cur_tokens))
                 break
             else:
-                logger.debug("max_tokens={}, total_tokens={}, len(messages)={}".format(max_tokens, cur_tokens, len(self.messages)))
+                logger.debug("max_tokens=%s, total_tokens=%s, len(messages)=%s", max_tokens, cur_tokens, len(self.messages))
                 break
             if precise:
-                cur_tokens = self.calc_tokens()
+                cur_tokens -= message_tokens.pop(1)
             else:
                 cur_tokens = cur_tokens - max_tokens
         return cur_tokens
 
     def calc_tokens(self):
-        return num_tokens_from_messages(self.messages, self.model)
+        return sum(self.message_tokens(self.count_message_tokens)) + reply_priming_tokens(self.model)
+
+    def count_message_tokens(self, message):
+        return num_tokens_from_message(message, self.model)
+
+
+GPT_35_TOKEN_MODELS = ["gpt-3.5-turbo", "gpt-3.5-turbo-0301", "gpt-35-turbo", "gpt-3.5-turbo-1106", "moonshot", const.LINKAI_35]
+GPT_4_TOKEN_MODELS = ["gpt-4", "gpt-4-0314", "gpt-4-0613", "gpt-4-32k", "gpt-4-32k-0613", "gpt-3.5-turbo-0613",
+                      "gpt-3.5-turbo-16k", "gpt-3.5-turbo-16k-0613", "gpt-35-turbo-16k", "gpt-4-turbo-preview",
+                      "gpt-4-1106-preview", const.GPT4_TURBO_PREVIEW, const.GPT4_VISION_PREVIEW, const.GPT4_TURBO_01_25,
+                      const.GPT_4o, const.GPT_4O_0806, const.GPT_4o_MINI, const.LINKAI_4o, const.LINKAI_4_TURBO]
+
+
+def _token_model(model):
+    """
+    返回计算token数时参照的模型
+    """
+    if model in GPT_4_TOKEN_MODELS:
+        return "gpt-4"
+    if model not in GPT_35_TOKEN_MODELS and not model.startswith("claude-3"):
+        logger.debug("num_tokens_from_messages() is not implemented for model %s. Returning num tokens assuming gpt-3.5-turbo.", model)
+    return "gpt-3.5-turbo"
 
 
 # refer to https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
 def num_tokens_from_messages(messages, model):
     """Returns the number of tokens used by a list of messages."""
+    num_tokens = 0
+    for message in messages:
+        num_tokens += num_tokens_from_message(message, model)
+    return num_tokens + reply_priming_tokens(model)
+
 
-    if model in ["wenxin", "xunfei"] or model.startswith(const.GEMINI):
-        return num_tokens_by_character(messages)
-
-    import tiktoken
-
-    if model in ["gpt-3.5-turbo-0301", "gpt-35-turbo", "gpt-3.5-turbo-1106", "moonshot", const.LINKAI_35]:
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo")
-    elif model in ["gpt-4-0314", "gpt-4-0613", "gpt-4-32k", "gpt-4-32k-0613", "gpt-3.5-turbo-0613",
-                   "gpt-3.5-turbo-16k", "gpt-3.5-turbo-16k-0613", "gpt-35-turbo-16k", "gpt-4-turbo-preview",
-                   "gpt-4-1106-preview", const.GPT4_TURBO_PREVIEW, const.GPT4_VISION_PREVIEW, const.GPT4_TURBO_01_25,
-                   const.GPT_4o, const.GPT_4O_0806, const.GPT_4o_MINI, const.LINKAI_4o, const.LINKAI_4_TURBO]:
-        return num_tokens_from_messages(messages, model="gpt-4")
-    elif model.startswith("claude-3"):
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo")
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        logger.debug("Warning: model not found. Using cl100k_base encoding.")
-        encoding = tiktoken.get_encoding("cl100k_base")
-    if model == "gpt-3.5-turbo":
+def num_tokens_from_message(message, model):
+    """Returns the number of tokens used by a single message, excluding the reply priming tokens."""
+    counter = tokenizer.get_token_counter(model)
+    if counter is not None:
+        return counter(message["content"])
+
+    encoding = tokenizer.get_encoding("cl100k_base")
+    if _token_model(model) == "gpt-3.5-turbo":
         tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
         tokens_per_name = -1  # if there's a name, the role is omitted
-    elif model == "gpt-4":
+    else:
         tokens_per_message = 3
         tokens_per_name = 1
-    else:
-        logger.debug(f"num_tokens_from_messages() is not implemented for model {model}. Returning num tokens assuming gpt-3.5-turbo.")
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo")
-    num_tokens = 0
-    for message in messages:
-        num_tokens += tokens_per_message
-        for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
-            if key == "name":
-                num_tokens += tokens_per_name
-    num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
+    num_tokens = tokens_per_message
+    for key, value in message.items():
+        num_tokens += len(encoding.encode(value))
+        if key == "name":
+            num_tokens += tokens_per_name
     return num_tokens
 
 
+def reply_priming_tokens(model):
+    """every reply is primed with <|start|>assistant<|message|>"""
+    return 0 if tokenizer.get_token_counter(model) is not None else 3
+
+
 def num_tokens_by_character(messages):
     """Returns the number of tokens used by a list of messages."""
     tokens = 0
@@ -1,5 +1,6 @@
 # encoding:utf-8
 
+import asyncio
 import time
 
 import openai
@@ -13,7 +14,7 @@ from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
 from common.log import logger
-from common import const
+from common import const, http_client
 from config import conf
 
 user_session = dict()
@@ -48,21 +49,7 @@ class ClaudeAPIBot(Bot, OpenAIImage):
                 else:
                     session = self.sessions.session_query(query, session_id)
                     result = self.reply_text(session)
-                    logger.info(result)
-                    total_tokens, completion_tokens, reply_content = (
-                        result["total_tokens"],
-                        result["completion_tokens"],
-                        result["content"],
-                    )
-                    logger.debug(
-                        "[CLAUDE_API] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(str(session), session_id, reply_content, completion_tokens)
-                    )
-
-                    if total_tokens == 0:
-                        reply = Reply(ReplyType.ERROR, reply_content)
-                    else:
-                        self.sessions.session_reply(reply_content, session_id, total_tokens)
-                        reply = Reply(ReplyType.TEXT, reply_content)
+                    reply = self._build_reply(session, result)
                 return reply
             elif context.type == ContextType.IMAGE_CREATE:
                 ok, retstring = self.create_img(query, 0)
@@ -73,6 +60,30 @@ class ClaudeAPIBot(Bot, OpenAIImage):
                     reply = Reply(ReplyType.ERROR, retstring)
                 return reply
 
+    async def areply(self, query, context=None):
+        if not context or context.type != ContextType.TEXT or query in ["#清除记忆", "#清除所有"]:
+            return await super().areply(query, context)
+        logger.info("[CLAUDE_API] query={}".format(query))
+        session = self.sessions.session_query(query, context["session_id"])
+        result = await self.areply_text(session)
+        return self._build_reply(session, result)
+
+    def _build_reply(self, session: BaiduWenxinSession, result: dict) -> Reply:
+        logger.info(result)
+        total_tokens, completion_tokens, reply_content = (
+            result["total_tokens"],
+            result["completion_tokens"],
+            result["content"],
+        )
+        logger.debug(
+            "[CLAUDE_API] new_query=%s, session_id=%s, reply_cont=%s, completion_tokens=%s", session, session.session_id, reply_content, completion_tokens
+        )
+
+        if total_tokens == 0:
+            return Reply(ReplyType.ERROR, reply_content)
+        self.sessions.session_reply(reply_content, session.session_id, total_tokens)
+        return Reply(ReplyType.TEXT, reply_content)
+
     def reply_text(self, session: BaiduWenxinSession, retry_count=0):
         try:
             actual_model = self._model_mapping(conf().get("model"))
@@ -120,6 +131,60 @@ class ClaudeAPIBot(Bot, OpenAIImage):
             else:
                 return result
 
+    async def areply_text(self, session: BaiduWenxinSession, retry_count=0):
+        """
+        async version of reply_text, call the Messages api with the shared async http client
+        """
+        try:
+            base_url = conf().get("open_ai_api_base") or "https://api.anthropic.com"
+            headers = {
+                "x-api-key": conf().get("claude_api_key"),
+                "anthropic-version": "2023-06-01",
+                "content-type": "application/json",
+            }
+            body = {
+                "model": self._model_mapping(conf().get("model")),
+                "max_tokens": 4096,
+                "system": conf().get("character_desc", ""),
+                "messages": session.messages,
+            }
+            proxy = conf().get("proxy", None)
+            res = await http_client.apost(base_url.rstrip("/") + "/v1/messages", headers=headers, json=body,
+                                          proxies={"http": proxy, "https": proxy} if proxy else None)
+            response = res.json()
+            if res.status_code == 200:
+                res_content = response["content"][0]["text"].strip().replace("<|endoftext|>", "")
+                logger.info("[CLAUDE_API] reply={}".format(res_content))
+                return {
+                    "total_tokens": response["usage"]["input_tokens"] + response["usage"]["output_tokens"],
+                    "completion_tokens": response["usage"]["output_tokens"],
+                    "content": res_content,
+                }
+            error = response.get("error") or {}
+            logger.warn("[CLAUDE_API] chat failed, status_code={}, type={}, msg={}".format(res.status_code, error.get("type"), error.get("message")))
+            result = {"total_tokens": 0, "completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
+            retry_delay = None
+            if res.status_code == 429:
+                result["content"] = "提问太快啦，请休息一下再问我吧"
+                retry_delay = 20
+            elif res.status_code >= 500:
+                retry_delay = 5
+            else:
+                self.sessions.clear_session(session.session_id)
+        except asyncio.TimeoutError as e:
+            logger.warn("[CLAUDE_API] Timeout: {}".format(e))
+            result = {"total_tokens": 0, "completion_tokens": 0, "content": "我没有收到你的消息"}
+            retry_delay = 5
+        except Exception as e:
+            logger.warn("[CLAUDE_API] Exception: {}".format(e))
+            result = {"total_tokens": 0, "completion_tokens": 0, "content": "我连接不到你的网络"}
+            retry_delay = None
+        if retry_delay is not None and retry_count < 2:
+            await asyncio.sleep(retry_delay)
+            logger.warn("[CLAUDE_API] 第{}次重试".format(retry_count + 1))
+            return await self.areply_text(session, retry_count + 1)
+        return result
+
     def _model_mapping(self, model) -> str:
         if model == "claude-3-opus":
             return const.CLAUDE_3_OPUS
@@ -1,19 +1,21 @@
 # access LinkAI knowledge base platform
 # docs: https://link-ai.tech/platform/link-app/wechat
 
+import asyncio
 import re
 import time
-import requests
 import config
 from bot.bot import Bot
 from bot.chatgpt.chat_gpt_session import ChatGPTSession
 from bot.session_manager import SessionManager
 from bridge.context import Context, ContextType
 from bridge.reply import Reply, ReplyType
+from common import http_client
 from common.log import logger
 from config import conf, pconf
 import threading
 from common import memory, utils
+from common.async_utils import run_in_thread
 import base64
 import os
 
@@ -27,6 +29,11 @@ class LinkAIBot(Bot):
         self.sessions = LinkAISessionManager(LinkAISession, model=conf().get("model") or "gpt-3.5-turbo")
         self.args = {}
 
+    async def areply(self, query, context: Context = None) -> Reply:
+        if context.type == ContextType.TEXT:
+            return await self._achat(query, context)
+        return await super().areply(query, context)
+
     def reply(self, query, context: Context = None) -> Reply:
         if context.type == ContextType.TEXT:
             return self._chat(query, context)
@@ -58,116 +65,20 @@ class LinkAIBot(Bot):
             return Reply(ReplyType.TEXT, "请再问我一次吧")
 
         try:
-            # load config
-            if context.get("generate_breaked_by"):
-                logger.info(f"[LINKAI] won't set appcode because a plugin ({context['generate_breaked_by']}) affected the context")
-                app_code = None
-            else:
-                plugin_app_code = self._find_group_mapping_code(context)
-                app_code = context.kwargs.get("app_code") or plugin_app_code or conf().get("linkai_app_code")
-            linkai_api_key = conf().get("linkai_api_key")
-
-            session_id = context["session_id"]
-            session_message = self.sessions.session_msg_query(query, session_id)
-            logger.debug(f"[LinkAI] session={session_message}, session_id={session_id}")
-
-            # image process
-            img_cache = memory.USER_IMAGE_CACHE.get(session_id)
-            if img_cache:
-                messages = self._process_image_msg(app_code=app_code, session_id=session_id, query=query, img_cache=img_cache)
-                if messages:
-                    session_message = messages
-
-            model = conf().get("model")
-            # remove system message
-            if session_message[0].get("role") == "system":
-                if app_code or model == "wenxin":
-                    session_message.pop(0)
-            body = {
-                "app_code": app_code,
-                "messages": session_message,
-                "model": model,     # 对话模型的名称, 支持 gpt-3.5-turbo, gpt-3.5-turbo-16k, gpt-4, wenxin, xunfei
-                "temperature": conf().get("temperature"),
-                "top_p": conf().get("top_p", 1),
-                "frequency_penalty": conf().get("frequency_penalty", 0.0),  # [-2,2]之间，该值越大则更倾向于产生不同的内容
-                "presence_penalty": conf().get("presence_penalty", 0.0),  # [-2,2]之间，该值越大则更倾向于产生不同的内容
-                "session_id": session_id,
-                "sender_id": session_id,
-                "channel_type": conf().get("channel_type", "wx")
-            }
-            try:
-                from linkai import LinkAIClient
-                client_id = LinkAIClient.fetch_client_id()
-                if client_id:
-                    body["client_id"] = client_id
-                    # start: client info deliver
-                    if context.kwargs.get("msg"):
-                        body["session_id"] = context.kwargs.get("msg").from_user_id
-                        if context.kwargs.get("msg").is_group:
-                            body["is_group"] = True
-                            body["group_name"] = context.kwargs.get("msg").from_user_nickname
-                            body["sender_name"] = context.kwargs.get("msg").actual_user_nickname
-                        else:
-                            if body.get("channel_type") in ["wechatcom_app"]:
-                                body["sender_name"] = context.kwargs.get("msg").from_user_id
-                            else:
-                                body["sender_name"] = context.kwargs.get("msg").from_user_nickname
-
-            except Exception as e:
-                pass
-            file_id = context.kwargs.get("file_id")
-            if file_id:
-                body["file_id"] = file_id
-            logger.info(f"[LINKAI] query={query}, app_code={app_code}, model={body.get('model')}, file_id={file_id}")
-            headers = {"Authorization": "Bearer " + linkai_api_key}
+            body = self._build_chat_body(query, context)
+            headers = {"Authorization": "Bearer " + conf().get("linkai_api_key")}
 
             # do http request
             base_url = conf().get("linkai_api_base", "https://api.link-ai.tech")
-            res = requests.post(url=base_url + "/v1/chat/completions", json=body, headers=headers,
+            res = http_client.post(url=base_url + "/v1/chat/completions", json=body, headers=headers,
                                 timeout=conf().get("request_timeout", 180))
-            if res.status_code == 200:
-                # execute success
-                response = res.json()
-                reply_content = response["choices"][0]["message"]["content"]
-                total_tokens = response["usage"]["total_tokens"]
-                res_code = response.get('code')
-                logger.info(f"[LINKAI] reply={reply_content}, total_tokens={total_tokens}, res_code={res_code}")
-                if res_code == 429:
-                    logger.warn(f"[LINKAI] 用户访问超出限流配置，sender_id={body.get('sender_id')}")
-                else:
-                    self.sessions.session_reply(reply_content, session_id, total_tokens, query=query)
-                agent_suffix = self._fetch_agent_suffix(response)
-                if agent_suffix:
-                    reply_content += agent_suffix
-                if not agent_suffix:
-                    knowledge_suffix = self._fetch_knowledge_search_suffix(response)
-                    if knowledge_suffix:
-                        reply_content += knowledge_suffix
-                # image process
-                if response["choices"][0].get("img_urls"):
-                    thread = threading.Thread(target=self._send_image, args=(context.get("channel"), context, response["choices"][0].get("img_urls")))
-                    thread.start()
-                    reply_content = response["choices"][0].get("text_content")
-                if reply_content:
-                    reply_content = self._process_url(reply_content)
-                return Reply(ReplyType.TEXT, reply_content)
-
-            else:
-                response = res.json()
-                error = response.get("error")
-                logger.error(f"[LINKAI] chat failed, status_code={res.status_code}, "
-                             f"msg={error.get('message')}, type={error.get('type')}")
-
-                if res.status_code >= 500:
-                    # server error, need retry
-                    time.sleep(2)
-                    logger.warn(f"[LINKAI] do retry, times={retry_count}")
-                    return self._chat(query, context, retry_count + 1)
-
-                error_reply = "提问太快啦，请休息一下再问我吧"
-                if res.status_code == 409:
-                    error_reply = "这个问题我还没有学会，请问我其它问题吧"
-                return Reply(ReplyType.TEXT, error_reply)
+            reply = self._build_chat_reply(query, context, body, res.status_code, res.json())
+            if reply:
+                return reply
+            # server error, need retry
+            time.sleep(2)
+            logger.warn(f"[LINKAI] do retry, times={retry_count}")
+            return self._chat(query, context, retry_count + 1)
 
         except Exception as e:
             logger.exception(e)
@@ -176,6 +87,147 @@ class LinkAIBot(Bot):
             logger.warn(f"[LINKAI] do retry, times={retry_count}")
             return self._chat(query, context, retry_count + 1)
 
+    async def _achat(self, query, context, retry_count=0) -> Reply:
+        """
+        _chat的协程版本，async_mode下使用
+        """
+        if retry_count > 2:
+            logger.warn("[LINKAI] failed after maximum number of retry times")
+            return Reply(ReplyType.TEXT, "请再问我一次吧")
+
+        try:
+            if memory.USER_IMAGE_CACHE.get(context["session_id"]):
+                # 识图需要下载图片并查询应用信息，在线程中执行
+                body = await run_in_thread(self._build_chat_body, query, context)
+            else:
+                body = self._build_chat_body(query, context)
+            headers = {"Authorization": "Bearer " + conf().get("linkai_api_key")}
+
+            base_url = conf().get("linkai_api_base", "https://api.link-ai.tech")
+            res = await http_client.apost(base_url + "/v1/chat/completions", json=body, headers=headers,
+                                          timeout=conf().get("request_timeout", 180))
+            reply = self._build_chat_reply(query, context, body, res.status_code, res.json())
+            if reply:
+                return reply
+            await asyncio.sleep(2)
+            logger.warn(f"[LINKAI] do retry, times={retry_count}")
+            return await self._achat(query, context, retry_count + 1)
+
+        except Exception as e:
+            logger.exception(e)
+            await asyncio.sleep(2)
+            logger.warn(f"[LINKAI] do retry, times={retry_count}")
+            return await self._achat(query, context, retry_count + 1)
+
+    def _build_chat_body(self, query, context) -> dict:
+        # load config
+        if context.get("generate_breaked_by"):
+            logger.info(f"[LINKAI] won't set appcode because a plugin ({context['generate_breaked_by']}) affected the context")
+            app_code = None
+        else:
+            plugin_app_code = self._find_group_mapping_code(context)
+            app_code = context.kwargs.get("app_code") or plugin_app_code or conf().get("linkai_app_code")
+
+        session_id = context["session_id"]
+        session_message = self.sessions.session_msg_query(query, session_id)
+        logger.debug(f"[LinkAI] session={session_message}, session_id={session_id}")
+
+        # image process
+        img_cache = memory.USER_IMAGE_CACHE.get(session_id)
+        if img_cache:
+            messages = self._process_image_msg(app_code=app_code, session_id=session_id, query=query, img_cache=img_cache)
+            if messages:
+                session_message = messages
+
+        model = conf().get("model")
+        # remove system message
+        if session_message[0].get("role") == "system":
+            if app_code or model == "wenxin":
+                session_message.pop(0)
+        body = {
+            "app_code": app_code,
+            "messages": session_message,
+            "model": model,     # 对话模型的名称, 支持 gpt-3.5-turbo, gpt-3.5-turbo-16k, gpt-4, wenxin, xunfei
+            "temperature": conf().get("temperature"),
+            "top_p": conf().get("top_p", 1),
+            "frequency_penalty": conf().get("frequency_penalty", 0.0),  # [-2,2]之间，该值越大则更倾向于产生不同的内容
+            "presence_penalty": conf().get("presence_penalty", 0.0),  # [-2,2]之间，该值越大则更倾向于产生不同的内容
+            "session_id": session_id,
+            "sender_id": session_id,
+            "channel_type": conf().get("channel_type", "wx")
+        }
+        try:
+            from linkai import LinkAIClient
+            client_id = LinkAIClient.fetch_client_id()
+            if client_id:
+                body["client_id"] = client_id
+                # start: client info deliver
+                if context.kwargs.get("msg"):
+                    body["session_id"] = context.kwargs.get("msg").from_user_id
+                    if context.kwargs.get("msg").is_group:
+                        body["is_group"] = True
+                        body["group_name"] = context.kwargs.get("msg").from_user_nickname
+                        body["sender_name"] = context.kwargs.get("msg").actual_user_nickname
+                    else:
+                        if body.get("channel_type") in ["wechatcom_app"]:
+                            body["sender_name"] = context.kwargs.get("msg").from_user_id
+                        else:
+                            body["sender_name"] = context.kwargs.get("msg").from_user_nickname
+
+        except Exception as e:
+            pass
+        file_id = context.kwargs.get("file_id")
+        if file_id:
+            body["file_id"] = file_id
+        logger.info(f"[LINKAI] query={query}, app_code={app_code}, model={body.get('model')}, file_id={file_id}")
+        return body
+
+    def _build_chat_reply(self, query, context, body, status_code, response):
+        """
+        根据接口返回构造回复
+        :return: 回复, 服务端错误需要重试时返回None
+        """
+        session_id = context["session_id"]
+        if status_code == 200:
+            # execute success
+            reply_content = response["choices"][0]["message"]["content"]
+            total_tokens = response["usage"]["total_tokens"]
+            res_code = response.get('code')
+            logger.info(f"[LINKAI] reply={reply_content}, total_tokens={total_tokens}, res_code={res_code}")
+            if res_code == 429:
+                logger.warn(f"[LINKAI] 用户访问超出限流配置，sender_id={body.get('sender_id')}")
+            else:
+                self.sessions.session_reply(reply_content, session_id, total_tokens, query=query)
+            agent_suffix = self._fetch_agent_suffix(response)
+            if agent_suffix:
+                reply_content += agent_suffix
+            if not agent_suffix:
+                knowledge_suffix = self._fetch_knowledge_search_suffix(response)
+                if knowledge_suffix:
+                    reply_content += knowledge_suffix
+            # image process
+            if response["choices"][0].get("img_urls"):
+                thread = threading.Thread(target=self._send_image, args=(context.get("channel"), context, response["choices"][0].get("img_urls")))
+                thread.start()
+                reply_content = response["choices"][0].get("text_content")
+            if reply_content:
+                reply_content = self._process_url(reply_content)
+            return Reply(ReplyType.TEXT, reply_content)
+
+        else:
+            error = response.get("error")
+            logger.error(f"[LINKAI] chat failed, status_code={status_code}, "
+                         f"msg={error.get('message')}, type={error.get('type')}")
+
+            if status_code >= 500:
+                # server error, need retry
+                return None
+
+            error_reply = "提问太快啦，请休息一下再问我吧"
+            if status_code == 409:
+                error_reply = "这个问题我还没有学会，请问我其它问题吧"
+            return Reply(ReplyType.TEXT, error_reply)
+
     def _process_image_msg(self, app_code: str, session_id: str, query:str, img_cache: dict):
         try:
             enable_image_input = False
@@ -262,7 +314,7 @@ class LinkAIBot(Bot):
 
             # do http request
             base_url = conf().get("linkai_api_base", "https://api.link-ai.tech")
-            res = requests.post(url=base_url + "/v1/chat/completions", json=body, headers=headers,
+            res = http_client.post(url=base_url + "/v1/chat/completions", json=body, headers=headers,
                                 timeout=conf().get("request_timeout", 180))
             if res.status_code == 200:
                 # execute success
@@ -306,7 +358,7 @@ class LinkAIBot(Bot):
         # do http request
         base_url = conf().get("linkai_api_base", "https://api.link-ai.tech")
         params = {"app_code": app_code}
-        res = requests.get(url=base_url + "/v1/app/info", params=params, headers=headers, timeout=(5, 10))
+        res = http_client.get(url=base_url + "/v1/app/info", params=params, headers=headers, timeout=(5, 10))
         if res.status_code == 200:
             return res.json()
         else:
@@ -327,7 +379,7 @@ class LinkAIBot(Bot):
                 "img_proxy": conf().get("image_proxy")
             }
             url = conf().get("linkai_api_base", "https://api.link-ai.tech") + "/v1/images/generations"
-            res = requests.post(url, headers=headers, json=data, timeout=(5, 90))
+            res = http_client.post(url, headers=headers, json=data, timeout=(5, 90))
             t2 = time.time()
             image_url = res.json()["data"][0]["url"]
             logger.info("[OPEN_AI] image_url={}".format(image_url))
@@ -416,9 +468,12 @@ class LinkAIBot(Bot):
                 else:
                     reply_type = ReplyType.IMAGE_URL
                 reply = Reply(reply_type, url)
-                channel.send(reply, context)
-                if send_interval:
-                    time.sleep(send_interval)
+                if hasattr(channel, "send_in_order"):  # 由通道按顺序发送，不阻塞当前线程
+                    channel.send_in_order(context["receiver"], channel.send, reply, context, delay=send_interval if i > 1 else 0)
+                else:
+                    channel.send(reply, context)
+                    if send_interval:
+                        time.sleep(send_interval)
         except Exception as e:
             logger.error(e)
 
@@ -430,7 +485,7 @@ def _download_file(url: str):
             os.makedirs(file_path)
         file_name = url.split("/")[-1]  # 获取文件名
         file_path = os.path.join(file_path, file_name)
-        response = requests.get(url)
+        response = http_client.get(url)
         with open(file_path, "wb") as f:
             f.write(response.content)
         return file_path
@@ -451,10 +506,12 @@ class LinkAISessionManager(SessionManager):
         session.add_reply(reply)
         try:
             max_tokens = conf().get("conversation_max_tokens", 2500)
+            self.compact_session(session, max_tokens)
             tokens_cnt = session.discard_exceeding(max_tokens, total_tokens)
             logger.debug(f"[LinkAI] chat history, before tokens={total_tokens}, now tokens={tokens_cnt}")
         except Exception as e:
             logger.warning("Exception when counting tokens precisely for session: {}".format(str(e)))
+        self.track_session(session)
         return session
 
 
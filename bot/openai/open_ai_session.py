@@ -1,4 +1,5 @@
 from bot.session_manager import Session
+from common import tokenizer
 from common.log import logger
 
 
@@ -15,15 +16,7 @@ class OpenAISession(Session):
               A: xxx
               Q: xxx
         """
-        prompt = ""
-        for item in self.messages:
-            if item["role"] == "system":
-                prompt += item["content"] + "<|endoftext|>\n\n\n"
-            elif item["role"] == "user":
-                prompt += "Q: " + item["content"] + "\n"
-            elif item["role"] == "assistant":
-                prompt += "\n\nA: " + item["content"] + "<|endoftext|>\n"
-
+        prompt = "".join(prompt_segment(item) for item in self.messages)
         if len(self.messages) > 0 and self.messages[-1]["role"] == "user":
             prompt += "A: "
         return prompt
@@ -31,19 +24,21 @@ class OpenAISession(Session):
     def discard_exceeding(self, max_tokens, cur_tokens=None):
         precise = True
         try:
-            cur_tokens = self.calc_tokens()
+            message_tokens = self.message_tokens(self.count_message_tokens)
+            cur_tokens = sum(message_tokens) + self.answer_prefix_tokens()
         except Exception as e:
             precise = False
             if cur_tokens is None:
                 raise e
-            logger.debug("Exception when counting tokens precisely for query: {}".format(e))
+            logger.debug("Exception when counting tokens precisely for query: %s", e)
+        # 从最早的消息开始丢弃，使用缓存的每条消息token数更新总数，不需要重新计算整个会话
         while cur_tokens > max_tokens:
             if len(self.messages) > 1:
                 self.messages.pop(0)
             elif len(self.messages) == 1 and self.messages[0]["role"] == "assistant":
                 self.messages.pop(0)
                 if precise:
-                    cur_tokens = self.calc_tokens()
+                    cur_tokens = 0
                 else:
                     cur_tokens = len(str(self))
                 break
@@ -51,23 +46,41 @@ class OpenAISession(Session):
                 logger.warn("user question exceed max_tokens. total_tokens={}".format(cur_tokens))
                 break
             else:
-                logger.debug("max_tokens={}, total_tokens={}, len(conversation)={}".format(max_tokens, cur_tokens, len(self.messages)))
+                logger.debug("max_tokens=%s, total_tokens=%s, len(conversation)=%s", max_tokens, cur_tokens, len(self.messages))
                 break
             if precise:
-                cur_tokens = self.calc_tokens()
+                cur_tokens -= message_tokens.pop(0)
             else:
                 cur_tokens = len(str(self))
         return cur_tokens
 
     def calc_tokens(self):
-        return num_tokens_from_string(str(self), self.model)
+        # 各条消息分别计算token数并缓存，与整段prompt一起编码的结果可能有少量差异
+        return sum(self.message_tokens(self.count_message_tokens)) + self.answer_prefix_tokens()
+
+    def count_message_tokens(self, message):
+        return num_tokens_from_string(prompt_segment(message), self.model)
+
+    def answer_prefix_tokens(self):
+        if len(self.messages) > 0 and self.messages[-1]["role"] == "user":
+            return num_tokens_from_string("A: ", self.model)
+        return 0
+
+
+# 单条消息在对话模型输入中对应的文本
+def prompt_segment(item):
+    if item["role"] == "system":
+        return item["content"] + "<|endoftext|>\n\n\n"
+    elif item["role"] == "user":
+        return "Q: " + item["content"] + "\n"
+    elif item["role"] == "assistant":
+        return "\n\nA: " + item["content"] + "<|endoftext|>\n"
+    return ""
 
 
 # refer to https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
 def num_tokens_from_string(string: str, model: str) -> int:
     """Returns the number of tokens in a text string."""
-    import tiktoken
-
-    encoding = tiktoken.encoding_for_model(model)
+    encoding = tokenizer.encoding_for_model(model)
     num_tokens = len(encoding.encode(string, disallowed_special=()))
     return num_tokens
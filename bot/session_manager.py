@@ -1,12 +1,17 @@
+from bot import session_summary
+from bot.session_memory import message_size, session_memory
+from bot.session_store import TieredSessions, get_session_store
 from common.expired_dict import ExpiredDict
 from common.log import logger
-from config import conf
+from config import conf, conf_snapshot
 
 
 class Session(object):
     def __init__(self, session_id, system_prompt=None):
         self.session_id = session_id
         self.messages = []
+        self.token_cache = {}  # id(message) -> (message, content, token数)
+        self.summary_task = None  # (被压缩的消息, 生成摘要的Future)
         if system_prompt is None:
             self.system_prompt = conf().get("character_desc", "")
         else:
@@ -16,6 +21,7 @@ class Session(object):
     def reset(self):
         system_item = {"role": "system", "content": self.system_prompt}
         self.messages = [system_item]
+        self.summary_task = None
 
     def set_system_prompt(self, system_prompt):
         self.system_prompt = system_prompt
@@ -32,19 +38,112 @@ class Session(object):
     def discard_exceeding(self, max_tokens=None, cur_tokens=None):
         raise NotImplementedError
 
+    def byte_size(self) -> int:
+        """
+        估算会话占用的内存大小
+        """
+        return len(self.system_prompt or "") + sum(message_size(message.get("content")) for message in self.messages)
+
+    def to_dict(self) -> dict:
+        """
+        转换为可以JSON序列化的dict，用于持久化存储
+        """
+        state = dict(vars(self))
+        state.pop("token_cache", None)
+        state.pop("summary_task", None)
+        return state
+
+    @classmethod
+    def from_dict(cls, state: dict):
+        session = cls.__new__(cls)
+        session.__dict__.update(state)
+        session.token_cache = {}
+        session.summary_task = None
+        return session
+
     def calc_tokens(self):
         raise NotImplementedError
 
+    def schedule_summary(self, cur_tokens, max_tokens):
+        """
+        token数接近上限时，在后台把较早的对话压缩成摘要，保留最近conversation_summary_keep条消息
+        """
+        config = conf_snapshot()
+        if self.summary_task is not None or cur_tokens < max_tokens * config.get("conversation_summary_ratio", 0.8):
+            return
+        if not session_summary.available():
+            return
+        start = 1 if self.messages and self.messages[0].get("role") == "system" else 0
+        end = len(self.messages) - config.get("conversation_summary_keep", 4)
+        # 压缩到一条助手消息为止，替换后仍然保持用户和助手消息交替
+        while end > start and self.messages[end - 1].get("role") != "assistant":
+            end -= 1
+        folded = self.messages[start:end]
+        if len(folded) < 2:
+            return
+        self.summary_task = (folded, session_summary.submit(folded))
+
+    def apply_summary(self):
+        """
+        摘要生成后替换被压缩的消息，摘要还未生成时直接返回
+        """
+        folded, future = self.summary_task
+        if not future.done():
+            return
+        self.summary_task = None
+        try:
+            summary = future.result()
+        except Exception as e:
+            logger.warning("[session_summary] summarize session {} failed: {}".format(self.session_id, e))
+            return
+        if not summary:
+            return
+        start = 1 if self.messages and self.messages[0].get("role") == "system" else 0
+        # 等待摘要期间最早的消息可能已被丢弃，替换到被压缩的最后一条消息为止，已全部丢弃时只插入摘要
+        end = start
+        for index in range(len(self.messages) - 1, start - 1, -1):
+            if self.messages[index] is folded[-1]:
+                end = index + 1
+                break
+        self.messages[start:end] = session_summary.summary_messages(summary)
+
+    def message_tokens(self, count_fn):
+        """
+        返回每条消息的token数，消息的token数在首次计算后缓存，只有新增或内容被替换的消息需要重新计算
+        :param count_fn: 计算单条消息token数的函数
+        """
+        token_cache = {}
+        counts = []
+        for message in self.messages:
+            entry = self.token_cache.get(id(message))
+            if entry is None or entry[0] is not message or entry[1] is not message.get("content"):
+                entry = (message, message.get("content"), count_fn(message))
+            token_cache[id(message)] = entry
+            counts.append(entry[2])
+        self.token_cache = token_cache  # 只保留当前消息的缓存
+        return counts
+
 
 class SessionManager(object):
     def __init__(self, sessioncls, **session_args):
-        if conf().get("expires_in_seconds"):
+        store = get_session_store()
+        if store is not None:
+            sessions = TieredSessions(
+                store,
+                sessioncls.__name__,
+                sessioncls.from_dict,
+                expires_in_seconds=conf().get("expires_in_seconds") or 0,
+                max_count=conf().get("session_hot_max_count", 1000),
+                max_bytes=conf().get("session_hot_max_bytes", 0),
+            )
+        elif conf().get("expires_in_seconds"):
             sessions = ExpiredDict(conf().get("expires_in_seconds"))
         else:
             sessions = dict()
         self.sessions = sessions
         self.sessioncls = sessioncls
         self.session_args = session_args
+        self.namespace = sessioncls.__name__  # 会话类型，用于按类型设置内存配额
 
     def build_session(self, session_id, system_prompt=None):
         """
@@ -64,28 +163,73 @@ class SessionManager(object):
     def session_query(self, query, session_id):
         session = self.build_session(session_id)
         session.add_query(query)
+        max_tokens = conf_snapshot().get("conversation_max_tokens", 1000)
+        self.compact_session(session, max_tokens)
         try:
-            max_tokens = conf().get("conversation_max_tokens", 1000)
             total_tokens = session.discard_exceeding(max_tokens, None)
-            logger.debug("prompt tokens used={}".format(total_tokens))
+            logger.debug("prompt tokens used=%s", total_tokens)
         except Exception as e:
             logger.warning("Exception when counting tokens precisely for prompt: {}".format(str(e)))
+        self.track_session(session)
         return session
 
     def session_reply(self, reply, session_id, total_tokens=None):
         session = self.build_session(session_id)
         session.add_reply(reply)
+        max_tokens = conf_snapshot().get("conversation_max_tokens", 1000)
+        self.compact_session(session, max_tokens)
         try:
-            max_tokens = conf().get("conversation_max_tokens", 1000)
             tokens_cnt = session.discard_exceeding(max_tokens, total_tokens)
-            logger.debug("raw total_tokens={}, savesession tokens={}".format(total_tokens, tokens_cnt))
+            logger.debug("raw total_tokens=%s, savesession tokens=%s", total_tokens, tokens_cnt)
         except Exception as e:
             logger.warning("Exception when counting tokens precisely for session: {}".format(str(e)))
+        self.track_session(session)
         return session
 
+    def compact_session(self, session, max_tokens):
+        """
+        开启conversation_summary时，用已生成的摘要替换较早的对话，并在token数接近上限时提交新的摘要任务
+        摘要在后台生成，仍超出上限时由discard_exceeding丢弃最早的对话，摘要出错时不影响丢弃
+        """
+        if session.session_id is None or not conf_snapshot().get("conversation_summary"):
+            return
+        try:
+            if session.summary_task is not None:
+                session.apply_summary()
+            session.schedule_summary(session.calc_tokens(), max_tokens)
+        except Exception as e:
+            session.summary_task = None
+            logger.warning("[session_summary] compact session {} failed: {}".format(session.session_id, e))
+
+    def track_session(self, session):
+        """
+        记录会话大小，超出内存预算时淘汰最久未使用的会话，未设置预算和配额时不统计
+        """
+        if session.session_id is not None and session_memory.enabled():
+            session_memory.update(self, session.session_id, session.byte_size())
+
+    def holds_session(self, session_id):
+        """
+        会话是否仍在内存中，不刷新会话的过期时间
+        """
+        if isinstance(self.sessions, TieredSessions):
+            return self.sessions.in_memory(session_id)
+        return session_id in self.sessions
+
+    def evict_session(self, session_id):
+        """
+        从内存中淘汰会话，使用会话存储时会话仍保留在存储中
+        """
+        if isinstance(self.sessions, TieredSessions):
+            self.sessions.evict(session_id)
+        else:
+            self.sessions.pop(session_id, None)
+
     def clear_session(self, session_id):
         if session_id in self.sessions:
             del self.sessions[session_id]
+        session_memory.remove(self, session_id)
 
     def clear_all_session(self):
         self.sessions.clear()
+        session_memory.remove_all(self)
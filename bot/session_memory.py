@@ -0,0 +1,135 @@
+"""
+Session memory
+
+统计所有SessionManager中会话占用的内存，超出全局预算或单类会话的配额时淘汰最久未使用的会话。
+会话大小按消息内容的字符数估算，图片等base64内容也计算在内。未设置预算和配额时不统计。
+已过期或被会话存储淘汰的会话由定期清理移出统计。
+"""
+
+import threading
+import time
+import weakref
+from collections import OrderedDict, defaultdict
+
+from common.log import logger
+from config import conf_snapshot
+
+
+def message_size(value) -> int:
+    """
+    估算消息内容的大小，支持字符串以及多模态消息中的列表和字典
+    """
+    if isinstance(value, str):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(len(key) + message_size(item) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return sum(message_size(item) for item in value)
+    return 0
+
+
+class SessionMemory:
+    """
+    全局会话内存统计，按最近使用顺序记录每个会话的大小
+    """
+
+    SWEEP_INTERVAL = 60  # 清理已不在内存中的会话的间隔(秒)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # (会话类型, session_id) -> 会话大小，按最近使用排序
+        self.managers = defaultdict(weakref.WeakSet)  # 会话类型 -> 使用该类型会话的SessionManager
+        self.totals = defaultdict(int)  # 会话类型 -> 总大小
+        self.total = 0
+        self.last_sweep = time.monotonic()
+
+    @staticmethod
+    def enabled():
+        config = conf_snapshot()
+        return bool(config.get("session_memory_budget", 0) or config.get("session_memory_quotas", {}))
+
+    def update(self, manager, session_id, size):
+        """
+        会话被使用后更新其大小，超出预算时淘汰其他会话
+        """
+        if time.monotonic() - self.last_sweep > self.SWEEP_INTERVAL:
+            self.sweep()
+        namespace = manager.namespace
+        with self.lock:
+            self.managers[namespace].add(manager)
+            key = (namespace, session_id)
+            self._remove(key)
+            self.entries[key] = size
+            self.totals[namespace] += size
+            self.total += size
+            victims = self._select_victims(key)
+        for victim_namespace, victim_session_id in victims:
+            logger.info("[session_memory] evict session {} of {}, total={}".format(victim_session_id, victim_namespace, self.total))
+            for victim_manager in list(self.managers[victim_namespace]):
+                victim_manager.evict_session(victim_session_id)
+
+    def remove(self, manager, session_id):
+        with self.lock:
+            self._remove((manager.namespace, session_id))
+
+    def remove_all(self, manager):
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == manager.namespace]:
+                self._remove(key)
+
+    def sweep(self):
+        """
+        移除已不在任何SessionManager内存中的会话，如已过期或被会话存储淘汰的会话
+        """
+        with self.lock:
+            self.last_sweep = time.monotonic()
+            keys = list(self.entries)
+            managers = {namespace: list(managers) for namespace, managers in self.managers.items()}
+        # 检查会话时不持有self.lock，避免与SessionManager的锁互相等待
+        gone = [key for key in keys if not any(manager.holds_session(key[1]) for manager in managers.get(key[0], []))]
+        with self.lock:
+            for key in gone:
+                self._remove(key)
+        if gone:
+            logger.debug("[session_memory] swept %s sessions, total=%s", len(gone), self.total)
+
+    def largest(self, count=10):
+        """
+        :return: 占用最大的会话列表 [(会话类型, session_id, 大小)]
+        """
+        with self.lock:
+            items = sorted(self.entries.items(), key=lambda item: item[1], reverse=True)[:count]
+        return [(namespace, session_id, size) for (namespace, session_id), size in items]
+
+    # 以下方法调用方需持有self.lock
+    def _remove(self, key):
+        size = self.entries.pop(key, None)
+        if size is not None:
+            self.totals[key[0]] -= size
+            self.total -= size
+
+    def _select_victims(self, current_key):
+        config = conf_snapshot()
+        budget = config.get("session_memory_budget", 0)
+        quotas = config.get("session_memory_quotas", {})
+        victims = []
+        quota = quotas.get(current_key[0], 0)
+        if quota:
+            # 先按会话类型的配额淘汰同类型的会话
+            for key in list(self.entries):
+                if self.totals[current_key[0]] <= quota:
+                    break
+                if key[0] == current_key[0] and key != current_key:
+                    self._remove(key)
+                    victims.append(key)
+        if budget:
+            for key in list(self.entries):
+                if self.total <= budget:
+                    break
+                if key != current_key:
+                    self._remove(key)
+                    victims.append(key)
+        return victims
+
+
+session_memory = SessionMemory()
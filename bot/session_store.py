@@ -0,0 +1,295 @@
+"""
+Session store
+
+会话的持久化存储。内存中按最近访问保留有限数量的会话(热数据)，其余会话保存在本地SQLite数据库中，
+访问时按需加载，修改过的会话由后台线程批量写回，重启后会话不会丢失，多个进程也可以共用同一个数据库文件。
+"""
+
+import atexit
+import json
+import os
+import sqlite3
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+from common.log import logger
+from config import conf, get_appdata_dir
+
+
+class SqliteSessionStore:
+    """
+    SQLite会话存储，使用WAL模式，读写互不阻塞，允许多个进程同时访问
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "namespace TEXT NOT NULL, session_id TEXT NOT NULL, data TEXT NOT NULL, updated REAL NOT NULL, "
+            "PRIMARY KEY (namespace, session_id))"
+        )
+
+    def load(self, namespace, session_id, min_updated=0):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT data FROM sessions WHERE namespace = ? AND session_id = ? AND updated >= ?",
+                (namespace, str(session_id), min_updated),
+            ).fetchone()
+        return row[0] if row else None
+
+    def save_many(self, namespace, rows):
+        """
+        :param rows: [(session_id, data, updated)]，在一个事务中写入
+        """
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO sessions (namespace, session_id, data, updated) VALUES (?, ?, ?, ?)",
+                    [(namespace, str(session_id), data, updated) for session_id, data, updated in rows],
+                )
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def delete(self, namespace, session_id):
+        with self.lock:
+            cursor = self.conn.execute("DELETE FROM sessions WHERE namespace = ? AND session_id = ?", (namespace, str(session_id)))
+        return cursor.rowcount > 0
+
+    def clear(self, namespace):
+        with self.lock:
+            self.conn.execute("DELETE FROM sessions WHERE namespace = ?", (namespace,))
+
+    def purge(self, namespace, before):
+        """
+        删除updated早于before的过期会话
+        """
+        with self.lock:
+            self.conn.execute("DELETE FROM sessions WHERE namespace = ? AND updated < ?", (namespace, before))
+
+
+class TieredSessions(MutableMapping):
+    """
+    两级会话字典，用法与dict相同
+    热数据保存在内存中，按数量和字节数上限淘汰最久未访问的会话，访问内存中不存在的会话时从存储中加载
+    取出的会话可能被原地修改，因此每次访问都标记为待写回，由后台线程批量写入存储
+    遍历和长度只包含内存中的会话
+    """
+
+    def __init__(self, store: SqliteSessionStore, namespace, loads, expires_in_seconds=0, max_count=1000, max_bytes=0):
+        """
+        :param loads: 由dict还原会话对象的函数
+        :param expires_in_seconds: 会话无访问多久后过期，0表示不过期
+        :param max_count: 内存中最多保留的会话数
+        :param max_bytes: 内存中会话的总字节数上限(按序列化后的大小估算)，0表示不限制
+        """
+        self.store = store
+        self.namespace = namespace
+        self.loads = loads
+        self.expires_in_seconds = expires_in_seconds
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.lock = threading.RLock()
+        self.hot = OrderedDict()  # session_id -> 会话，按最近访问排序
+        self.access_time = {}  # session_id -> 最近访问时间
+        self.sizes = {}  # session_id -> 最近一次写回时序列化后的字节数
+        self.hot_bytes = 0
+        self.dirty = set()  # 待写回的session_id
+        self.evicted = {}  # 已从内存淘汰但还未写回的会话
+        self.last_purge = 0
+        register_tiered_sessions(self)
+
+    def __getitem__(self, session_id):
+        with self.lock:
+            now = time.time()
+            session = self.hot.get(session_id)
+            if session is None:
+                session = self.evicted.pop(session_id, None)
+            elif self.expires_in_seconds and now - self.access_time[session_id] > self.expires_in_seconds:
+                self._drop(session_id)
+                self.dirty.discard(session_id)
+                raise KeyError("expired {}".format(session_id))
+            if session is None:
+                session = self._load(session_id)
+            self._put(session_id, session, now)
+            return session
+
+    def __setitem__(self, session_id, session):
+        with self.lock:
+            self.evicted.pop(session_id, None)
+            self._put(session_id, session, time.time())
+
+    def __delitem__(self, session_id):
+        with self.lock:
+            found = session_id in self.hot or session_id in self.evicted
+            self._drop(session_id)
+            self.evicted.pop(session_id, None)
+            self.dirty.discard(session_id)
+            if not self.store.delete(self.namespace, session_id) and not found:
+                raise KeyError(session_id)
+
+    def __contains__(self, session_id):
+        try:
+            self[session_id]
+            return True
+        except KeyError:
+            return False
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.hot.keys()))
+
+    def __len__(self):
+        return len(self.hot)
+
+    def in_memory(self, session_id):
+        """
+        会话是否在内存中，不会从存储加载，也不更新访问时间
+        """
+        with self.lock:
+            return session_id in self.hot or session_id in self.evicted
+
+    def evict(self, session_id):
+        """
+        从内存中移除会话，修改过的会话在下次写回后从内存释放
+        """
+        with self.lock:
+            session = self.hot.get(session_id)
+            if session is None:
+                return
+            if session_id in self.dirty:
+                self.evicted[session_id] = session
+                self.dirty.discard(session_id)
+            self._drop(session_id)
+
+    def clear(self):
+        with self.lock:
+            self.hot.clear()
+            self.access_time.clear()
+            self.sizes.clear()
+            self.hot_bytes = 0
+            self.dirty.clear()
+            self.evicted.clear()
+            self.store.clear(self.namespace)
+
+    def flush(self):
+        """
+        将修改过的会话批量写入存储
+        """
+        with self.lock:
+            flush_time = time.time()
+            pending = [(session_id, self.hot[session_id]) for session_id in self.dirty if session_id in self.hot]
+            pending += list(self.evicted.items())
+            # 刚取出的会话可能还在被修改，最近1秒内访问过的会话下次再写回一次
+            self.dirty = {session_id for session_id in self.dirty if self.access_time.get(session_id, 0) > flush_time - 1}
+            self.evicted.clear()
+            access_time = dict(self.access_time)
+        rows = []
+        for session_id, session in pending:
+            try:
+                data = json.dumps(session.to_dict(), ensure_ascii=False)
+            except Exception as e:
+                logger.warning("[session_store] session {} can't be serialized: {}".format(session_id, e))
+                continue
+            rows.append((session_id, data, access_time.get(session_id, time.time())))
+            self._set_size(session_id, len(data.encode("utf-8")))
+        if rows:
+            self.store.save_many(self.namespace, rows)
+        if self.expires_in_seconds and time.time() - self.last_purge > 60:
+            self.last_purge = time.time()
+            self.store.purge(self.namespace, time.time() - self.expires_in_seconds)
+        with self.lock:
+            self._evict()
+
+    # 以下方法调用方需持有self.lock
+    def _load(self, session_id):
+        min_updated = time.time() - self.expires_in_seconds if self.expires_in_seconds else 0
+        data = self.store.load(self.namespace, session_id, min_updated)
+        if data is None:
+            raise KeyError(session_id)
+        self.sizes[session_id] = len(data.encode("utf-8"))
+        self.hot_bytes += self.sizes[session_id]
+        return self.loads(json.loads(data))
+
+    def _put(self, session_id, session, now):
+        if session_id not in self.hot and session_id not in self.sizes:
+            self.sizes[session_id] = 0
+        self.hot[session_id] = session
+        self.hot.move_to_end(session_id)
+        self.access_time[session_id] = now
+        self.dirty.add(session_id)
+        self._evict()
+
+    def _set_size(self, session_id, size):
+        with self.lock:
+            if session_id in self.hot:
+                self.hot_bytes += size - self.sizes.get(session_id, 0)
+                self.sizes[session_id] = size
+
+    def _drop(self, session_id):
+        self.hot.pop(session_id, None)
+        self.access_time.pop(session_id, None)
+        self.hot_bytes -= self.sizes.pop(session_id, 0)
+
+    def _evict(self):
+        while len(self.hot) > 1 and (len(self.hot) > self.max_count or (self.max_bytes and self.hot_bytes > self.max_bytes)):
+            self.evict(next(iter(self.hot)))
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+_tiered_sessions = []  # TieredSessions的弱引用
+_flusher = None
+
+
+def get_session_store():
+    """
+    根据配置返回会话存储，session_store未配置时返回None，会话只保存在内存中
+    """
+    if conf().get("session_store", "") != "sqlite":
+        return None
+    path = conf().get("session_store_path") or os.path.join(get_appdata_dir(), "sessions.db")
+    with _stores_lock:
+        store = _stores.get(path)
+        if store is None:
+            store = SqliteSessionStore(path)
+            _stores[path] = store
+            logger.info("[session_store] use sqlite session store: {}".format(path))
+        return store
+
+
+def register_tiered_sessions(sessions: TieredSessions):
+    global _flusher
+    with _stores_lock:
+        _tiered_sessions.append(weakref.ref(sessions))
+        if _flusher is None:
+            _flusher = threading.Thread(target=_flush_loop, name="session_flusher", daemon=True)
+            _flusher.start()
+            atexit.register(flush_all)
+
+
+def flush_all():
+    for ref in list(_tiered_sessions):
+        sessions = ref()
+        if sessions is None:
+            _tiered_sessions.remove(ref)
+            continue
+        try:
+            sessions.flush()
+        except Exception as e:
+            logger.exception("[session_store] flush sessions error: {}".format(e))
+
+
+def _flush_loop():
+    while True:
+        time.sleep(conf().get("session_flush_interval", 5))
+        flush_all()
@@ -0,0 +1,97 @@
+"""
+Session summary
+
+会话接近conversation_max_tokens时，在后台线程中用较便宜的模型把较早的对话压缩成摘要，下次使用会话时用摘要替换这些消息，
+不再直接丢弃最早的对话。摘要请求不在回复流程中执行，不会增加回复耗时。
+摘要总是通过OpenAI接口(open_ai_api_key、open_ai_api_base)生成，与会话所属的bot无关；请求失败后按指数退避暂停提交新的摘要任务。
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from common import const
+from common.log import logger
+from config import conf_snapshot
+
+SUMMARY_PROMPT = (
+    "请把下面的对话压缩成一段简洁的摘要，保留用户的身份、偏好、提出的问题、已经得出的结论和未完成的事项，"
+    "如果对话中包含之前的摘要，请将其合并。只输出摘要内容。"
+)
+SUMMARY_QUERY_PREFIX = "以下是我们之前对话的摘要：\n"
+SUMMARY_ANSWER = "好的，我会参考之前的对话继续交流。"
+
+_executor = None
+_executor_lock = threading.Lock()
+_failures = 0  # 连续失败次数
+_retry_at = 0  # 失败后允许再次提交摘要任务的时间
+MAX_BACKOFF = 3600  # 失败退避的最长间隔(秒)
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="session_summary")
+    return _executor
+
+
+def summarize(messages) -> str:
+    """
+    调用conversation_summary_model生成对话摘要
+    """
+    import openai
+
+    config = conf_snapshot()
+    transcript = "\n".join(
+        "{}: {}".format(message["role"], message["content"]) for message in messages if isinstance(message.get("content"), str)
+    )
+    response = openai.ChatCompletion.create(
+        api_key=config.get("open_ai_api_key"),
+        api_base=config.get("open_ai_api_base") or None,
+        model=config.get("conversation_summary_model") or const.GPT_4o_MINI,
+        messages=[{"role": "system", "content": SUMMARY_PROMPT}, {"role": "user", "content": transcript}],
+        temperature=0,
+        request_timeout=config.get("request_timeout", None),
+    )
+    summary = response.choices[0]["message"]["content"].strip()
+    logger.debug("[session_summary] folded %s messages, summary_tokens=%s", len(messages), response["usage"]["completion_tokens"])
+    return summary
+
+
+def available() -> bool:
+    """
+    是否可以提交摘要任务，未配置open_ai_api_key或处于失败退避期间时返回False
+    """
+    return bool(conf_snapshot().get("open_ai_api_key")) and time.monotonic() >= _retry_at
+
+
+def _summarize(messages) -> str:
+    global _failures, _retry_at
+    try:
+        summary = summarize(messages)
+    except Exception:
+        with _executor_lock:
+            _failures += 1
+            backoff = min(60 * 2 ** (_failures - 1), MAX_BACKOFF)
+            _retry_at = time.monotonic() + backoff
+        logger.warning("[session_summary] summarize failed {} times in a row, pause for {}s".format(_failures, backoff))
+        raise
+    _failures = 0
+    return summary
+
+
+def submit(messages):
+    """
+    在后台线程中生成摘要
+    :return: Future，结果为摘要文本
+    """
+    return _get_executor().submit(_summarize, list(messages))
+
+
+def summary_messages(summary):
+    """
+    摘要以一组问答的形式放入会话，保持用户和助手消息交替，各家模型接口都能接受
+    """
+    return [{"role": "user", "content": SUMMARY_QUERY_PREFIX + summary}, {"role": "assistant", "content": SUMMARY_ANSWER}]
@@ -1,22 +1,22 @@
 # encoding:utf-8
 
-import time
-
-import openai
-import openai.error
-from bot.bot import Bot
+from bot.chat_completion_bot import ChatCompletionBot
 from bot.zhipuai.zhipu_ai_session import ZhipuAISession
 from bot.zhipuai.zhipu_ai_image import ZhipuAIImage
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
-from common.log import logger
-from config import conf, load_config
-from zhipuai import ZhipuAI
+from config import conf
 
 
 # ZhipuAI对话模型API
-class ZHIPUAIBot(Bot, ZhipuAIImage):
+class ZHIPUAIBot(ChatCompletionBot, ZhipuAIImage):
+    LOG_TAG = "[ZHIPU_AI]"
+    MODEL_KEY = "gpt_model"
+    RATE_LIMIT_DELAY = 20
+    SERVER_ERROR_DELAY = 10
+    EXCEPTION_DELAY = 5
+
     def __init__(self):
         super().__init__()
         self.sessions = SessionManager(ZhipuAISession, model=conf().get("model") or "ZHIPU_AI")
@@ -25,125 +25,17 @@ class ZHIPUAIBot(Bot, ZhipuAIImage):
             "temperature": conf().get("temperature", 0.9),  # 值在(0,1)之间(智谱AI 的温度不能取 0 或者 1)
             "top_p": conf().get("top_p", 0.7),  # 值在(0,1)之间(智谱AI 的 top_p 不能取 0 或者 1)
         }
-        self.client = ZhipuAI(api_key=conf().get("zhipu_ai_api_key"))
-
-    def reply(self, query, context=None):
-        # acquire reply content
-        if context.type == ContextType.TEXT:
-            logger.info("[ZHIPU_AI] query={}".format(query))
-
-            session_id = context["session_id"]
-            reply = None
-            clear_memory_commands = conf().get("clear_memory_commands", ["#清除记忆"])
-            if query in clear_memory_commands:
-                self.sessions.clear_session(session_id)
-                reply = Reply(ReplyType.INFO, "记忆已清除")
-            elif query == "#清除所有":
-                self.sessions.clear_all_session()
-                reply = Reply(ReplyType.INFO, "所有人记忆已清除")
-            elif query == "#更新配置":
-                load_config()
-                reply = Reply(ReplyType.INFO, "配置已更新")
-            if reply:
-                return reply
-            session = self.sessions.session_query(query, session_id)
-            logger.debug("[ZHIPU_AI] session query={}".format(session.messages))
-
-            api_key = context.get("openai_api_key") or openai.api_key
-            model = context.get("gpt_model")
-            new_args = None
-            if model:
-                new_args = self.args.copy()
-                new_args["model"] = model
-            # if context.get('stream'):
-            #     # reply in stream
-            #     return self.reply_text_stream(query, new_query, session_id)
 
-            reply_content = self.reply_text(session, api_key, args=new_args)
-            logger.debug(
-                "[ZHIPU_AI] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
-                    session.messages,
-                    session_id,
-                    reply_content["content"],
-                    reply_content["completion_tokens"],
-                )
-            )
-            if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
-                reply = Reply(ReplyType.ERROR, reply_content["content"])
-            elif reply_content["completion_tokens"] > 0:
-                self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
-                reply = Reply(ReplyType.TEXT, reply_content["content"])
-            else:
-                reply = Reply(ReplyType.ERROR, reply_content["content"])
-                logger.debug("[ZHIPU_AI] reply {} used 0 tokens.".format(reply_content))
-            return reply
-        elif context.type == ContextType.IMAGE_CREATE:
+    def _reply_other(self, query, context):
+        if context.type == ContextType.IMAGE_CREATE:
             ok, retstring = self.create_img(query, 0)
-            reply = None
             if ok:
-                reply = Reply(ReplyType.IMAGE_URL, retstring)
-            else:
-                reply = Reply(ReplyType.ERROR, retstring)
-            return reply
-
-        else:
-            reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
-            return reply
-
-    def reply_text(self, session: ZhipuAISession, api_key=None, args=None, retry_count=0) -> dict:
-        """
-        call openai's ChatCompletion to get the answer
-        :param session: a conversation session
-        :param session_id: session id
-        :param retry_count: retry count
-        :return: {}
-        """
-        try:
-            # if conf().get("rate_limit_chatgpt") and not self.tb4chatgpt.get_token():
-            #     raise openai.error.RateLimitError("RateLimitError: rate limit exceeded")
-            # if api_key == None, the default openai.api_key will be used
-            if args is None:
-                args = self.args
-            # response = openai.ChatCompletion.create(api_key=api_key, messages=session.messages, **args)
-            response = self.client.chat.completions.create(messages=session.messages, **args)
-            # logger.debug("[ZHIPU_AI] response={}".format(response))
-            # logger.info("[ZHIPU_AI] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
-
-            return {
-                "total_tokens": response.usage.total_tokens,
-                "completion_tokens": response.usage.completion_tokens,
-                "content": response.choices[0].message.content,
-            }
-        except Exception as e:
-            need_retry = retry_count < 2
-            result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-            if isinstance(e, openai.error.RateLimitError):
-                logger.warn("[ZHIPU_AI] RateLimitError: {}".format(e))
-                result["content"] = "提问太快啦，请休息一下再问我吧"
-                if need_retry:
-                    time.sleep(20)
-            elif isinstance(e, openai.error.Timeout):
-                logger.warn("[ZHIPU_AI] Timeout: {}".format(e))
-                result["content"] = "我没有收到你的消息"
-                if need_retry:
-                    time.sleep(5)
-            elif isinstance(e, openai.error.APIError):
-                logger.warn("[ZHIPU_AI] Bad Gateway: {}".format(e))
-                result["content"] = "请再问我一次"
-                if need_retry:
-                    time.sleep(10)
-            elif isinstance(e, openai.error.APIConnectionError):
-                logger.warn("[ZHIPU_AI] APIConnectionError: {}".format(e))
-                result["content"] = "我连接不到你的网络"
-                if need_retry:
-                    time.sleep(5)
-            else:
-                logger.exception("[ZHIPU_AI] Exception: {}".format(e), e)
-                need_retry = False
-                self.sessions.clear_session(session.session_id)
-
-            if need_retry:
-                logger.warn("[ZHIPU_AI] 第{}次重试".format(retry_count + 1))
-                return self.reply_text(session, api_key, args, retry_count + 1)
-            else:
-                return result
+                return Reply(ReplyType.IMAGE_URL, retstring)
+            return Reply(ReplyType.ERROR, retstring)
+        return super()._reply_other(query, context)
+
+    def _build_request(self, session: ZhipuAISession, args):
+        # 同步和异步都直接调用智谱AI兼容OpenAI格式的对话接口
+        headers = {"Content-Type": "application/json", "Authorization": "Bearer " + conf().get("zhipu_ai_api_key")}
+        base_url = conf().get("zhipu_ai_api_base") or "https://open.bigmodel.cn/api/paas/v4"
+        return base_url + "/chat/completions", headers, dict(args, messages=session.messages)
@@ -82,6 +82,9 @@ class Bridge(object):
     def fetch_reply_content(self, query, context: Context) -> Reply:
         return self.get_bot("chat").reply(query, context)
 
+    async def afetch_reply_content(self, query, context: Context) -> Reply:
+        return await self.get_bot("chat").areply(query, context)
+
     def fetch_voice_to_text(self, voiceFile) -> Reply:
         return self.get_bot("voice_to_text").voiceToText(voiceFile)
 
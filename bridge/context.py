@@ -1,5 +1,6 @@
 # encoding:utf-8
 
+from collections.abc import MutableMapping
 from enum import Enum
 
 
@@ -23,49 +24,144 @@ class ContextType(Enum):
         return self.name
 
 
+# 高频访问的context参数，使用slot属性存储，值为None时视为不存在
+FAST_KEYS = frozenset(["session_id", "receiver", "isgroup", "msg", "origin_ctype"])
+
+
 class Context:
-    def __init__(self, type: ContextType = None, content=None, kwargs=dict()):
+    """
+    消息上下文，type和content之外的参数通过context[key]访问，session_id、receiver、isgroup、msg、origin_ctype同时可以作为属性直接访问
+    """
+
+    __slots__ = ("type", "content", "session_id", "receiver", "isgroup", "msg", "origin_ctype", "extra")
+
+    def __init__(self, type: ContextType = None, content=None, kwargs=None):
         self.type = type
         self.content = content
-        self.kwargs = kwargs
+        self.session_id = None
+        self.receiver = None
+        self.isgroup = None
+        self.msg = None
+        self.origin_ctype = None
+        self.extra = {}  # 其余参数
+        if kwargs:
+            self.kwargs = kwargs
+
+    @property
+    def kwargs(self):
+        """
+        全部参数的字典视图，读写直接作用于context
+        """
+        return ContextKwargs(self)
+
+    @kwargs.setter
+    def kwargs(self, kwargs):
+        self.session_id = self.receiver = self.isgroup = self.msg = self.origin_ctype = None
+        self.extra = {}
+        view = ContextKwargs(self)
+        for key, value in kwargs.items():
+            view[key] = value
 
     def __contains__(self, key):
         if key == "type":
             return self.type is not None
         elif key == "content":
             return self.content is not None
+        elif key in FAST_KEYS:
+            return getattr(self, key) is not None
         else:
-            return key in self.kwargs
+            return key in self.extra
 
     def __getitem__(self, key):
         if key == "type":
             return self.type
         elif key == "content":
             return self.content
+        elif key in FAST_KEYS:
+            value = getattr(self, key)
+            if value is None:
+                raise KeyError(key)
+            return value
         else:
-            return self.kwargs[key]
+            return self.extra[key]
 
     def get(self, key, default=None):
-        try:
-            return self[key]
-        except KeyError:
-            return default
+        if key == "type":
+            return self.type
+        elif key == "content":
+            return self.content
+        elif key in FAST_KEYS:
+            value = getattr(self, key)
+            return default if value is None else value
+        else:
+            return self.extra.get(key, default)
 
     def __setitem__(self, key, value):
         if key == "type":
             self.type = value
         elif key == "content":
             self.content = value
+        elif key in FAST_KEYS:
+            setattr(self, key, value)
         else:
-            self.kwargs[key] = value
+            self.extra[key] = value
 
     def __delitem__(self, key):
         if key == "type":
             self.type = None
         elif key == "content":
             self.content = None
+        elif key in FAST_KEYS:
+            if getattr(self, key) is None:
+                raise KeyError(key)
+            setattr(self, key, None)
         else:
-            del self.kwargs[key]
+            del self.extra[key]
 
     def __str__(self):
         return "Context(type={}, content={}, kwargs={})".format(self.type, self.content, self.kwargs)
+
+
+class ContextKwargs(MutableMapping):
+    """
+    Context参数的字典视图，兼容直接读写context.kwargs的插件
+    """
+
+    __slots__ = ("context",)
+
+    def __init__(self, context: Context):
+        self.context = context
+
+    def __getitem__(self, key):
+        if key in FAST_KEYS:
+            value = getattr(self.context, key)
+            if value is None:
+                raise KeyError(key)
+            return value
+        return self.context.extra[key]
+
+    def __setitem__(self, key, value):
+        if key in FAST_KEYS:
+            setattr(self.context, key, value)
+        else:
+            self.context.extra[key] = value
+
+    def __delitem__(self, key):
+        if key in FAST_KEYS:
+            if getattr(self.context, key) is None:
+                raise KeyError(key)
+            setattr(self.context, key, None)
+        else:
+            del self.context.extra[key]
+
+    def __iter__(self):
+        for key in ("session_id", "receiver", "isgroup", "msg", "origin_ctype"):
+            if getattr(self.context, key) is not None:
+                yield key
+        yield from self.context.extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
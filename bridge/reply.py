@@ -18,12 +18,15 @@ class ReplyType(Enum):
     VIDEO = 12
     MINIAPP = 13  # 小程序
     IMAGE_AND_TEXT = 14 # 图片和文字
+    STREAM = 15  # 流式文本，content为逐段生成文本的迭代器
 
     def __str__(self):
         return self.name
 
 
 class Reply:
+    __slots__ = ("type", "content")
+
     def __init__(self, type: ReplyType = None, content=None):
         self.type = type
         self.content = content
@@ -1,17 +1,26 @@
+import asyncio
+import heapq
 import os
-import re
+import random
 import threading
 import time
 from asyncio import CancelledError
+from collections import deque
 from concurrent.futures import Future, ThreadPoolExecutor
 
 from bridge.context import *
 from bridge.reply import *
 from channel.channel import Channel
+from channel.outbound_dispatcher import OutboundDispatcher
+from common.async_utils import run_in_thread
 from common.dequeue import Dequeue
+from common.delayed_executor import DelayedExecutor
+from common.expired_dict import ExpiredDict
 from common import memory
 from common.log import logger
-from config import conf
+from common.stream_utils import close_stream, split_sentences, wrap
+from common.trigger_matcher import mention_pattern
+from config import conf, conf_snapshot
 from plugins import *
 
 try:
@@ -19,7 +28,100 @@ try:
 except Exception as e:
     pass
 
-handler_pool = ThreadPoolExecutor(max_workers=8)  # 处理消息的线程池
+# 消息处理分道, 不同类型的消息使用独立的线程池，避免耗时的语音、图片任务占满线程导致文本回复排队
+# max_workers: 线程池大小, max_queue: 已提交但未开始执行的任务上限, 可在config.json的handler_lanes中覆盖
+DEFAULT_HANDLER_LANES = {
+    "text": {"max_workers": 8, "max_queue": 32},  # 文本回复
+    "voice": {"max_workers": 2, "max_queue": 16},  # 语音转换与识别
+    "image": {"max_workers": 2, "max_queue": 16},  # 图片生成、识图及其他媒体消息
+    "admin": {"max_workers": 1, "max_queue": 16},  # #开头的管理命令
+}
+handler_pools = {}  # 处理消息的线程池, key为分道名称
+handler_pools_lock = threading.Lock()
+handler_pool_initializer = None  # 线程池中每个线程启动时执行的函数
+send_retry_executor = DelayedExecutor("send_retry", max_workers=2)  # 发送失败后的延迟重试，等待期间不占用消息处理线程
+outbound_dispatcher = None  # 按接收者顺序发送消息的调度器
+async_loop = None  # async_mode下运行文本消息处理协程的事件循环
+shard_pool = None  # worker_processes大于0时按会话分片处理消息的工作进程池
+
+
+def get_lane_conf(lane) -> dict:
+    lane_conf = dict(DEFAULT_HANDLER_LANES.get(lane, DEFAULT_HANDLER_LANES["text"]))
+    lane_conf.update(conf().get("handler_lanes", {}).get(lane, {}))
+    return lane_conf
+
+
+def get_handler_pool(lane) -> ThreadPoolExecutor:
+    with handler_pools_lock:
+        if lane not in handler_pools:
+            max_workers = get_lane_conf(lane)["max_workers"]
+            handler_pools[lane] = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="handler_" + lane, initializer=handler_pool_initializer)
+            logger.debug("[chat_channel] create handler pool, lane=%s, max_workers=%s", lane, max_workers)
+        return handler_pools[lane]
+
+
+def get_outbound_dispatcher() -> OutboundDispatcher:
+    global outbound_dispatcher
+    with handler_pools_lock:
+        if outbound_dispatcher is None:
+            outbound_dispatcher = OutboundDispatcher(max_workers=conf().get("outbound_workers", 2))
+        return outbound_dispatcher
+
+
+def get_shard_pool(channel):
+    global shard_pool
+    with handler_pools_lock:
+        if shard_pool is None:
+            from channel.session_shard import ShardPool
+
+            shard_pool = ShardPool(channel, conf().get("worker_processes"))
+        return shard_pool
+
+
+def get_async_loop() -> asyncio.AbstractEventLoop:
+    global async_loop
+    with handler_pools_lock:
+        if async_loop is None:
+            async_loop = asyncio.new_event_loop()
+            # 协程中调用的同步插件、bot和发送接口在该线程池中执行
+            offload_workers = conf().get("async_offload_workers", 16)
+            async_loop.set_default_executor(ThreadPoolExecutor(max_workers=offload_workers, thread_name_prefix="async_offload", initializer=handler_pool_initializer))
+            threading.Thread(target=async_loop.run_forever, name="async_loop", daemon=True).start()
+            logger.info("[chat_channel] async mode enabled, offload_workers={}".format(offload_workers))
+        return async_loop
+
+
+# async_mode下文本分道的消息在事件循环中以协程处理，等待大模型接口时不占用线程
+def is_async_lane(lane) -> bool:
+    config = conf_snapshot()
+    return lane == "text" and config.get("async_mode", False) and not config.get("worker_processes", 0)
+
+
+def set_handler_pool_initializer(initializer):
+    global handler_pool_initializer
+    with handler_pools_lock:
+        handler_pool_initializer = initializer
+        for pool in handler_pools.values():
+            pool._initializer = initializer
+        if async_loop is not None:
+            async_loop._default_executor._initializer = initializer
+
+
+# 根据消息类型选择处理分道
+def get_lane(context: Context) -> str:
+    if context.type == ContextType.TEXT:
+        if context.content.startswith("#"):
+            return "admin"
+        return "text"
+    elif context.type == ContextType.VOICE:
+        return "voice"
+    elif context.type in [ContextType.IMAGE_CREATE, ContextType.IMAGE, ContextType.FILE, ContextType.VIDEO]:
+        return "image"
+    return "text"
+
+
+# 会话调度权重，按差额轮询(deficit round-robin)在会话间分配处理名额，权重越大每轮可处理的消息越多
+DEFAULT_SESSION_WEIGHTS = {"private": 2, "group": 1, "vip": 4}
 
 
 # 抽象类, 它包含了与消息通道无关的通用处理逻辑
@@ -27,8 +129,22 @@ class ChatChannel(Channel):
     name = None  # 登录的用户名
     user_id = None  # 登录的用户id
     futures = {}  # 记录每个session_id提交到线程池的future对象, 用于重置会话时把没执行的future取消掉，正在执行的不会被取消
-    sessions = {}  # 用于控制并发，每个session_id同时只能有一个context在处理
-    lock = threading.Lock()  # 用于控制对sessions的访问
+    sessions = {}  # 用于控制并发，每个session_id同时只能有一个context在处理, value为[消息队列, 并发信号量, 调度信息]
+    lock = threading.RLock()  # 用于控制对sessions的访问, 取消future时会同步触发回调, 因此需要可重入
+    cond = threading.Condition(lock)  # 有新消息或任务完成时唤醒consume线程
+    ready_sessions = deque()  # 可调度的session_id队列, 即有待处理消息且未达到并发上限的会话
+    deadline_sessions = []  # 队首消息带有截止时间的可调度会话，(截止时间, 序号, session_id)小顶堆，优先于ready_sessions按截止时间最早优先调度
+    ready_set = set()  # ready_sessions和deadline_sessions的去重集合
+    ready_seq = 0  # deadline_sessions中截止时间相同时按入队顺序调度
+    lane_pending = {}  # 每个分道已提交到线程池且未结束的任务数
+    lane_blocked = {}  # 每个分道因队列已满而等待的session_id
+    group_inflight = {}  # 每个群正在处理的任务数
+    group_blocked = {}  # 每个群因处理中任务数已达上限而等待的session_id
+    delayed_sessions = []  # 延迟调度的(到期时间, session_id)小顶堆, 用于等待合并连续消息
+    delayed_set = set()  # delayed_sessions的去重集合
+    # 运行指标, queued为当前排队消息数, shed为因队列已满丢弃的消息数, deadline_missed为超过截止时间才处理完成的消息数
+    stats = {"queued": 0, "shed": 0, "shed_oldest": 0, "shed_newest": 0, "shed_busy_reply": 0, "deadline_met": 0, "deadline_missed": 0, "send_retry": 0, "send_failed": 0}
+    send_retry_history = ExpiredDict(60, refresh_on_read=False)  # 每个接收者最近一分钟内的重试时间，用于限制重试次数
 
     def __init__(self):
         _thread = threading.Thread(target=self.consume)
@@ -37,52 +153,37 @@ class ChatChannel(Channel):
 
     # 根据消息构造context，消息内容相关的触发项写在这里
     def _compose_context(self, ctype: ContextType, content, **kwargs):
-        context = Context(ctype, content)
-        context.kwargs = kwargs
+        context = Context(ctype, content, kwargs)
+        config = conf_snapshot()  # 整个匹配过程使用同一版本的配置
         # context首次传入时，origin_ctype是None,
         # 引入的起因是：当输入语音时，会嵌套生成两个context，第一步语音转文本，第二步通过文本生成文字回复。
         # origin_ctype用于第二步文本回复时，判断是否需要匹配前缀，如果是私聊的语音，就不需要匹配前缀
-        if "origin_ctype" not in context:
-            context["origin_ctype"] = ctype
+        if context.origin_ctype is None:
+            context.origin_ctype = ctype
         # context首次传入时，receiver是None，根据类型设置receiver
-        first_in = "receiver" not in context
+        first_in = context.receiver is None
         # 群名匹配过程，设置session_id和receiver
         if first_in:  # context首次传入时，receiver是None，根据类型设置receiver
-            config = conf()
-            cmsg = context["msg"]
+            cmsg = context.msg
             user_data = conf().get_user_data(cmsg.from_user_id)
             context["openai_api_key"] = user_data.get("openai_api_key")
             context["gpt_model"] = user_data.get("gpt_model")
-            if context.get("isgroup", False):
+            if context.isgroup:
                 group_name = cmsg.other_user_nickname
                 group_id = cmsg.other_user_id
 
-                group_name_white_list = config.get("group_name_white_list", [])
-                group_name_keyword_white_list = config.get("group_name_keyword_white_list", [])
-                if any(
-                    [
-                        group_name in group_name_white_list,
-                        "ALL_GROUP" in group_name_white_list,
-                        check_contain(group_name, group_name_keyword_white_list),
-                    ]
-                ):
-                    group_chat_in_one_session = conf().get("group_chat_in_one_session", [])
+                if config.trigger.group_in_white_list(group_name):
                     session_id = cmsg.actual_user_id
-                    if any(
-                        [
-                            group_name in group_chat_in_one_session,
-                            "ALL_GROUP" in group_chat_in_one_session,
-                        ]
-                    ):
+                    if config.trigger.group_in_one_session(group_name):
                         session_id = group_id
                 else:
                     logger.debug(f"No need reply, groupName not in whitelist, group_name={group_name}")
                     return None
-                context["session_id"] = session_id
-                context["receiver"] = group_id
+                context.session_id = session_id
+                context.receiver = group_id
             else:
-                context["session_id"] = cmsg.other_user_id
-                context["receiver"] = cmsg.other_user_id
+                context.session_id = cmsg.other_user_id
+                context.receiver = cmsg.other_user_id
             e_context = PluginManager().emit_event(EventContext(Event.ON_RECEIVE_MESSAGE, {"channel": self, "context": context}))
             context = e_context["context"]
             if e_context.is_pass() or context is None:
@@ -98,87 +199,133 @@ class ChatChannel(Channel):
                 logger.debug("[chat_channel]reference query skipped")
                 return None
 
-            nick_name_black_list = conf().get("nick_name_black_list", [])
-            if context.get("isgroup", False):  # 群聊
+            nick_name_black_list = config.nick_name_black_set
+            cmsg = context.msg
+            if context.isgroup:  # 群聊
                 # 校验关键字
-                match_prefix = check_prefix(content, conf().get("group_chat_prefix"))
-                match_contain = check_contain(content, conf().get("group_chat_keyword"))
+                match_prefix = config.trigger.group_chat_prefix.match(content)
+                match_contain = config.trigger.group_chat_keyword.search(content)
                 flag = False
-                if context["msg"].to_user_id != context["msg"].actual_user_id:
+                if cmsg.to_user_id != cmsg.actual_user_id:
                     if match_prefix is not None or match_contain is not None:
                         flag = True
                         if match_prefix:
                             content = content.replace(match_prefix, "", 1).strip()
-                    if context["msg"].is_at:
-                        nick_name = context["msg"].actual_user_nickname
+                    if cmsg.is_at:
+                        nick_name = cmsg.actual_user_nickname
                         if nick_name and nick_name in nick_name_black_list:
                             # 黑名单过滤
                             logger.warning(f"[chat_channel] Nickname {nick_name} in In BlackList, ignore")
                             return None
 
                         logger.info("[chat_channel]receive group at")
-                        if not conf().get("group_at_off", False):
+                        if not config.group_at_off:
                             flag = True
                         self.name = self.name if self.name is not None else ""  # 部分渠道self.name可能没有赋值
-                        pattern = f"@{re.escape(self.name)}(\u2005|\u0020)"
-                        subtract_res = re.sub(pattern, r"", content)
-                        if isinstance(context["msg"].at_list, list):
-                            for at in context["msg"].at_list:
-                                pattern = f"@{re.escape(at)}(\u2005|\u0020)"
-                                subtract_res = re.sub(pattern, r"", subtract_res)
-                        if subtract_res == content and context["msg"].self_display_name:
+                        subtract_res = mention_pattern(self.name).sub("", content)
+                        if isinstance(cmsg.at_list, list):
+                            for at in cmsg.at_list:
+                                subtract_res = mention_pattern(at).sub("", subtract_res)
+                        if subtract_res == content and cmsg.self_display_name:
                             # 前缀移除后没有变化，使用群昵称再次移除
-                            pattern = f"@{re.escape(context['msg'].self_display_name)}(\u2005|\u0020)"
-                            subtract_res = re.sub(pattern, r"", content)
+                            subtract_res = mention_pattern(cmsg.self_display_name).sub("", content)
                         content = subtract_res
                 if not flag:
-                    if context["origin_ctype"] == ContextType.VOICE:
+                    if context.origin_ctype == ContextType.VOICE:
                         logger.info("[chat_channel]receive group voice, but checkprefix didn't match")
                     return None
             else:  # 单聊
-                nick_name = context["msg"].from_user_nickname
+                nick_name = cmsg.from_user_nickname
                 if nick_name and nick_name in nick_name_black_list:
                     # 黑名单过滤
                     logger.warning(f"[chat_channel] Nickname '{nick_name}' in In BlackList, ignore")
                     return None
 
-                match_prefix = check_prefix(content, conf().get("single_chat_prefix", [""]))
+                match_prefix = config.trigger.single_chat_prefix.match(content)
                 if match_prefix is not None:  # 判断如果匹配到自定义前缀，则返回过滤掉前缀+空格后的内容
                     content = content.replace(match_prefix, "", 1).strip()
-                elif context["origin_ctype"] == ContextType.VOICE:  # 如果源消息是私聊的语音消息，允许不匹配前缀，放宽条件
+                elif context.origin_ctype == ContextType.VOICE:  # 如果源消息是私聊的语音消息，允许不匹配前缀，放宽条件
                     pass
                 else:
                     return None
             content = content.strip()
-            img_match_prefix = check_prefix(content, conf().get("image_create_prefix",[""]))
-            if img_match_prefix and not conf().get('enable_tools', False):
+            img_match_prefix = config.trigger.image_create_prefix.match(content)
+            if img_match_prefix and not config.enable_tools:
                 content = content.replace(img_match_prefix, "", 1)
                 context.type = ContextType.IMAGE_CREATE
             else:
                 context.type = ContextType.TEXT
             context.content = content.strip()
-            if "desire_rtype" not in context and conf().get("always_reply_voice") and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
+            if "desire_rtype" not in context and config.always_reply_voice and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
                 context["desire_rtype"] = ReplyType.VOICE
+            # 流式回复不能跨进程传递，也不能转换成语音
+            if "stream" not in context and config.stream_reply and not config.worker_processes and context.get("desire_rtype") != ReplyType.VOICE:
+                context["stream"] = True
         elif context.type == ContextType.VOICE:
-            if "desire_rtype" not in context and conf().get("voice_reply_voice") and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
+            if "desire_rtype" not in context and config.voice_reply_voice and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
                 context["desire_rtype"] = ReplyType.VOICE
         return context
 
     def _handle(self, context: Context):
         if context is None or not context.content:
             return
-        logger.debug("[chat_channel] ready to handle context: {}".format(context))
+        logger.debug("[chat_channel] ready to handle context: %s", context)
+        if conf_snapshot().get("worker_processes", 0) > 0:
+            # reply的构建和包装步骤在会话所属的工作进程中执行
+            reply = get_shard_pool(self).handle(context)
+            if reply and reply.content:
+                self._send_reply(context, reply)
+            return
         # reply的构建步骤
         reply = self._generate_reply(context)
+        stream = reply.content if reply and reply.type == ReplyType.STREAM else None
+
+        logger.debug("[chat_channel] ready to decorate reply: %s", reply)
 
-        logger.debug("[chat_channel] ready to decorate reply: {}".format(reply))
+        try:
+            # reply的包装步骤
+            if reply and reply.content:
+                reply = self._decorate_reply(context, reply)
+
+                # reply的发送步骤
+                self._send_reply(context, reply)
+        finally:
+            # 流式回复被插件替换或发送失败时，也要结束生成并把回复记入会话
+            close_stream(stream)
+
+    # _handle的协程版本，async_mode下使用，插件事件、回复包装和发送等同步步骤放到线程中执行
+    async def _ahandle(self, context: Context):
+        if context is None or not context.content:
+            return
+        logger.debug("[chat_channel] ready to handle context: %s", context)
+        reply = await self._agenerate_reply(context)
+        stream = reply.content if reply and reply.type == ReplyType.STREAM else None
 
-        # reply的包装步骤
-        if reply and reply.content:
-            reply = self._decorate_reply(context, reply)
+        logger.debug("[chat_channel] ready to decorate reply: %s", reply)
 
-            # reply的发送步骤
-            self._send_reply(context, reply)
+        try:
+            if reply and reply.content:
+                reply = await run_in_thread(self._decorate_reply, context, reply)
+                await run_in_thread(self._send_reply, context, reply)
+        finally:
+            if stream is not None:
+                await run_in_thread(close_stream, stream)
+
+    async def _agenerate_reply(self, context: Context, reply: Reply = Reply()) -> Reply:
+        if context.type != ContextType.TEXT and context.type != ContextType.IMAGE_CREATE:
+            return await run_in_thread(self._generate_reply, context, reply)
+        e_context = await PluginManager().aemit_event(
+            EventContext(
+                Event.ON_HANDLE_CONTEXT,
+                {"channel": self, "context": context, "reply": reply},
+            )
+        )
+        reply = e_context["reply"]
+        if not e_context.is_pass():
+            logger.debug("[chat_channel] ready to handle context: type=%s, content=%s", context.type, context.content)
+            context["channel"] = e_context["channel"]
+            reply = await super().abuild_reply_content(context.content, context)
+        return reply
 
     def _generate_reply(self, context: Context, reply: Reply = Reply()) -> Reply:
         e_context = PluginManager().emit_event(
@@ -189,7 +336,7 @@ class ChatChannel(Channel):
         )
         reply = e_context["reply"]
         if not e_context.is_pass():
-            logger.debug("[chat_channel] ready to handle context: type={}, content={}".format(context.type, context.content))
+            logger.debug("[chat_channel] ready to handle context: type=%s, content=%s", context.type, context.content)
             if context.type == ContextType.TEXT or context.type == ContextType.IMAGE_CREATE:  # 文字和图片消息
                 context["channel"] = e_context["channel"]
                 reply = super().build_reply_content(context.content, context)
@@ -258,13 +405,25 @@ class ChatChannel(Channel):
                     if desire_rtype == ReplyType.VOICE and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
                         reply = super().build_text_to_voice(reply.content)
                         return self._decorate_reply(context, reply)
-                    if context.get("isgroup", False):
+                    config = conf_snapshot()
+                    if context.isgroup:
                         if not context.get("no_need_at", False):
-                            reply_text = "@" + context["msg"].actual_user_nickname + "\n" + reply_text.strip()
-                        reply_text = conf().get("group_chat_reply_prefix", "") + reply_text + conf().get("group_chat_reply_suffix", "")
+                            reply_text = "@" + context.msg.actual_user_nickname + "\n" + reply_text.strip()
+                        reply_text = config.get("group_chat_reply_prefix", "") + reply_text + config.get("group_chat_reply_suffix", "")
                     else:
-                        reply_text = conf().get("single_chat_reply_prefix", "") + reply_text + conf().get("single_chat_reply_suffix", "")
+                        reply_text = config.get("single_chat_reply_prefix", "") + reply_text + config.get("single_chat_reply_suffix", "")
                     reply.content = reply_text
+                elif reply.type == ReplyType.STREAM:
+                    config = conf_snapshot()
+                    if context.isgroup:
+                        prefix = config.get("group_chat_reply_prefix", "")
+                        if not context.get("no_need_at", False):
+                            prefix += "@" + context.msg.actual_user_nickname + "\n"
+                        suffix = config.get("group_chat_reply_suffix", "")
+                    else:
+                        prefix = config.get("single_chat_reply_prefix", "")
+                        suffix = config.get("single_chat_reply_suffix", "")
+                    reply.content = wrap(reply.content, prefix, suffix)
                 elif reply.type == ReplyType.IMAGE_AND_TEXT:
                     reply.content = reply.content
                 elif reply.type == ReplyType.ERROR or reply.type == ReplyType.INFO:
@@ -288,28 +447,70 @@ class ChatChannel(Channel):
             )
             reply = e_context["reply"]
             if not e_context.is_pass() and reply and reply.type:
-                logger.debug("[chat_channel] ready to send reply: {}, context: {}".format(reply, context))
+                logger.debug("[chat_channel] ready to send reply: %s, context: %s", reply, context)
                 self._send(reply, context)
 
     def _send(self, reply: Reply, context: Context, retry_cnt=0):
         try:
-            self.send(reply, context)
+            if reply.type == ReplyType.STREAM:
+                self.send_stream(reply, context)
+            else:
+                self.send(reply, context)
         except Exception as e:
             logger.error("[chat_channel] sendMsg error: {}".format(str(e)))
             if isinstance(e, NotImplementedError):
                 return
             logger.exception(e)
-            if retry_cnt < 2:
-                time.sleep(3 + 3 * retry_cnt)
-                self._send(reply, context, retry_cnt + 1)
+            if reply.type == ReplyType.STREAM:  # 流式回复的内容已被消费，不能重发
+                return
+            self._schedule_send_retry(reply, context, retry_cnt)
+
+    # 发送流式回复，默认把文本切分成完整的段落或句子，作为多条消息依次发送，能原地更新消息的通道可以重写
+    def send_stream(self, reply: Reply, context: Context):
+        for text in split_sentences(reply.content, conf_snapshot().get("stream_flush_chars", 200)):
+            self._send(Reply(ReplyType.TEXT, text), context)
+
+    # 按接收者顺序异步执行发送操作，用于替代发送多条消息时的sleep，delay为距离该接收者上一次发送的最短间隔(秒)
+    # retry为True时失败的发送按send_retry配置重试，与_send共用重试预算和统计
+    def send_in_order(self, receiver, fn, *args, delay=0, api=None, retry=True, **kwargs):
+        on_error = (lambda e, retry_cnt: self._send_retry_delay(receiver, retry_cnt)) if retry else None
+        get_outbound_dispatcher().submit(receiver, fn, *args, delay=delay, api=api, on_error=on_error, **kwargs)
+
+    # 发送失败后按指数退避加随机抖动放入延迟重试队列，不阻塞当前的处理线程
+    def _schedule_send_retry(self, reply: Reply, context: Context, retry_cnt):
+        delay = self._send_retry_delay(context.receiver, retry_cnt)
+        if delay is not None:
+            send_retry_executor.submit_after(delay, self._send, reply, context, retry_cnt + 1)
+
+    # 检查重试次数和接收者的重试预算，返回重试前等待的秒数，不能重试时记为发送失败并返回None
+    def _send_retry_delay(self, receiver, retry_cnt):
+        with self.lock:
+            if retry_cnt >= conf_snapshot().get("send_retry_max", 2):
+                self.stats["send_failed"] += 1
+                logger.warning("[chat_channel] send failed after {} retries, receiver={}".format(retry_cnt, receiver))
+                return
+            now = time.monotonic()
+            history = self.send_retry_history.get(receiver) or deque()
+            while history and now - history[0] > 60:
+                history.popleft()
+            if len(history) >= conf_snapshot().get("send_retry_budget", 10):
+                self.stats["send_failed"] += 1
+                logger.warning("[chat_channel] send retry budget exhausted, receiver={}".format(receiver))
+                return
+            history.append(now)
+            self.send_retry_history[receiver] = history
+            self.stats["send_retry"] += 1
+        delay = conf_snapshot().get("send_retry_base_delay", 3) * (2 ** retry_cnt) * random.uniform(0.5, 1.5)
+        logger.info("[chat_channel] retry send in {:.1f}s, retry_cnt={}, receiver={}".format(delay, retry_cnt + 1, receiver))
+        return delay
 
     def _success_callback(self, session_id, **kwargs):  # 线程正常结束时的回调函数
-        logger.debug("Worker return success, session_id = {}".format(session_id))
+        logger.debug("Worker return success, session_id = %s", session_id)
 
     def _fail_callback(self, session_id, exception, **kwargs):  # 线程异常结束时的回调函数
         logger.exception("Worker return exception: {}".format(exception))
 
-    def _thread_pool_callback(self, session_id, **kwargs):
+    def _thread_pool_callback(self, session_id, lane, **kwargs):
         def func(worker: Future):
             try:
                 worker_exception = worker.exception()
@@ -321,71 +522,321 @@ class ChatChannel(Channel):
                 logger.info("Worker cancelled, session_id = {}".format(session_id))
             except Exception as e:
                 logger.exception("Worker raise exception: {}".format(e))
+            context = kwargs.get("context")
+            deadline = context.get("deadline") if context else None
             with self.lock:
+                if deadline is not None:
+                    if time.time() > deadline:
+                        self.stats["deadline_missed"] += 1
+                        logger.warning("[chat_channel] context missed deadline by {:.1f}s, session_id={}".format(time.time() - deadline, session_id))
+                    else:
+                        self.stats["deadline_met"] += 1
+                if worker in self.futures.get(session_id, []):
+                    self.futures[session_id].remove(worker)
+                self.lane_pending[lane] -= 1
+                self._unblock(self.lane_blocked, lane)
+                group_id = self.sessions[session_id][2]["group_id"]
+                if group_id is not None:
+                    self.group_inflight[group_id] -= 1
+                    if self.group_inflight[group_id] == 0:
+                        del self.group_inflight[group_id]
+                    self._unblock(self.group_blocked, group_id)
                 self.sessions[session_id][1].release()
+                if not self.sessions[session_id][0].empty():
+                    self._mark_ready(session_id, front=self._has_quantum(session_id))
+                else:
+                    self._release_session_if_idle(session_id)
 
         return func
 
+    # 将session_id放入可调度队列并唤醒consume线程，调用方需持有self.lock
+    def _mark_ready(self, session_id, front=False):
+        if session_id not in self.ready_set:
+            self.ready_set.add(session_id)
+            deadline = self._head_deadline(session_id)
+            if deadline is not None:
+                self.ready_seq += 1
+                heapq.heappush(self.deadline_sessions, (deadline, self.ready_seq, session_id))
+            elif front:
+                self.ready_sessions.appendleft(session_id)
+            else:
+                self.ready_sessions.append(session_id)
+            self.cond.notify()
+
+    # 会话队首消息的截止时间，调用方需持有self.lock
+    def _head_deadline(self, session_id):
+        if session_id not in self.sessions or self.sessions[session_id][0].empty():
+            return None
+        return self.sessions[session_id][0].queue[0].get("deadline")
+
+    # 取出下一个要调度的会话，带截止时间的会话按截止时间最早优先，调用方需持有self.lock
+    def _next_ready(self):
+        if self.deadline_sessions:
+            _, _, session_id = heapq.heappop(self.deadline_sessions)
+        else:
+            session_id = self.ready_sessions.popleft()
+        self.ready_set.discard(session_id)
+        return session_id
+
+    # 会话因分道或群并发已满而等待时记录下来，调用方需持有self.lock
+    def _block(self, blocked_dict, key, session_id):
+        blocked = blocked_dict.setdefault(key, [])
+        if session_id not in blocked:
+            blocked.append(session_id)
+
+    # 分道或群有空闲名额时，将等待的会话重新放入可调度队列，调用方需持有self.lock
+    def _unblock(self, blocked_dict, key):
+        for session_id in blocked_dict.pop(key, []):
+            self._mark_ready(session_id, front=self._has_quantum(session_id))
+
+    # 会话本轮的轮询额度是否未用完，额度未用完的会话排在队首，优先获得空出的名额，调用方需持有self.lock
+    # concurrency_in_session为1时每个会话同时只有一条消息在处理，权重通过名额空出时的先后顺序生效
+    def _has_quantum(self, session_id):
+        return session_id in self.sessions and self.sessions[session_id][2]["deficit"] >= 1
+
+    # 会话没有排队消息且没有处理中的任务时删除该会话，调用方需持有self.lock
+    def _release_session_if_idle(self, session_id):
+        context_queue, semaphore = self.sessions[session_id][:2]
+        if context_queue.empty() and semaphore._initial_value == semaphore._value:
+            assert len(self.futures.get(session_id, [])) == 0, "thread pool error"
+            del self.sessions[session_id]
+            self.futures.pop(session_id, None)
+
     def produce(self, context: Context):
-        session_id = context["session_id"]
+        session_id = context.session_id
+        shed_context = None
         with self.lock:
             if session_id not in self.sessions:
                 self.sessions[session_id] = [
                     Dequeue(),
-                    threading.BoundedSemaphore(conf().get("concurrency_in_session", 4)),
+                    threading.BoundedSemaphore(conf_snapshot().get("concurrency_in_session", 4)),
+                    {
+                        "weight": _session_weight(context),
+                        "deficit": 0,
+                        "group_id": context.receiver if context.isgroup else None,
+                    },
                 ]
+            context["receive_time"] = time.monotonic()
             if context.type == ContextType.TEXT and context.content.startswith("#"):
-                self.sessions[session_id][0].putleft(context)  # 优先处理管理命令
+                self.sessions[session_id][0].putleft(context)  # 优先处理管理命令, 不受队列长度限制
             else:
+                admitted, shed_context = self._admit(session_id, context)
+                if not admitted:
+                    self._release_session_if_idle(session_id)
+                    self._reply_busy(shed_context)
+                    return
                 self.sessions[session_id][0].put(context)
+            self.stats["queued"] += 1
+            self._mark_ready(session_id)
+
+    # 检查队列长度限制，必要时按配置的策略丢弃消息，返回(是否接收新消息, 被丢弃的消息)，调用方需持有self.lock
+    def _admit(self, session_id, context):
+        session_max = conf_snapshot().get("session_queue_max_size", 0)
+        global_max = conf_snapshot().get("global_queue_max_size", 0)
+        if session_max > 0 and self.sessions[session_id][0].qsize() >= session_max:
+            victim_session_id = session_id
+        elif global_max > 0 and self.stats["queued"] >= global_max:
+            # 全局队列已满时，从排队最多的会话中丢弃
+            victim_session_id = max(self.sessions, key=lambda sid: self.sessions[sid][0].qsize())
+        else:
+            return True, None
+        policy = conf_snapshot().get("queue_overflow_policy", "drop_oldest")
+        if policy == "drop_oldest":
+            dropped = self._drop_oldest(victim_session_id)
+            if dropped is not None:
+                self._record_shed("shed_oldest", dropped)
+                return True, dropped
+        if policy == "reply_busy":
+            self._record_shed("shed_busy_reply", context)
+        else:
+            self._record_shed("shed_newest", context)
+        return False, context
+
+    # 丢弃会话中最早的一条非管理命令消息，调用方需持有self.lock
+    def _drop_oldest(self, session_id):
+        context_queue = self.sessions[session_id][0].queue
+        for i, queued in enumerate(context_queue):
+            if not (queued.type == ContextType.TEXT and queued.content.startswith("#")):
+                del context_queue[i]
+                self.stats["queued"] -= 1
+                return queued
+        return None
+
+    def _record_shed(self, key, context):
+        self.stats["shed"] += 1
+        self.stats[key] += 1
+        logger.warning("[chat_channel] queue full, {} message, session_id={}, shed total={}".format(key, context.session_id, self.stats["shed"]))
+
+    # 队列已满且策略为reply_busy时，回复繁忙提示
+    def _reply_busy(self, context):
+        if context is None or conf_snapshot().get("queue_overflow_policy", "drop_oldest") != "reply_busy":
+            return
+        busy_reply = conf_snapshot().get("queue_busy_reply", "当前消息较多，请稍后再试")
+        if busy_reply:
+            reply = Reply(ReplyType.TEXT, busy_reply)
+            get_handler_pool("admin").submit(lambda: self._send_reply(context, self._decorate_reply(context, reply)))
+
+    # 分道中已提交的任务是否已达上限，调用方需持有self.lock
+    def _lane_full(self, lane):
+        if is_async_lane(lane):
+            return self.lane_pending.get(lane, 0) >= conf_snapshot().get("async_max_inflight", 256)
+        lane_conf = get_lane_conf(lane)
+        return self.lane_pending.get(lane, 0) >= lane_conf["max_workers"] + lane_conf["max_queue"]
+
+    # 从可调度的会话中取出一条消息并占用该会话的一个并发名额，返回(context, lane)，调用方需持有self.lock
+    def _pop_context(self, session_id):
+        if session_id not in self.sessions:
+            return None, None
+        context_queue, semaphore, schedule = self.sessions[session_id]
+        if context_queue.empty():
+            schedule["deficit"] = 0
+            self._release_session_if_idle(session_id)
+            return None, None
+        head = context_queue.queue[0]
+        coalesce_window = conf_snapshot().get("message_coalesce_ms", 0) / 1000
+        if coalesce_window > 0 and _coalescable(head):
+            due_time = head["receive_time"] + coalesce_window
+            if time.monotonic() < due_time:  # 等待合并窗口结束, 期间同一用户的后续消息会合并处理
+                self._delay(session_id, due_time)
+                return None, None
+        lane = get_lane(head)
+        if self._lane_full(lane):  # 分道已满，分道内任务完成时会重新放入可调度队列
+            self._block(self.lane_blocked, lane, session_id)
+            return None, None
+        group_id = schedule["group_id"]
+        group_max_inflight = conf_snapshot().get("group_max_inflight", 0)
+        if group_id is not None and group_max_inflight > 0 and self.group_inflight.get(group_id, 0) >= group_max_inflight:
+            self._block(self.group_blocked, group_id, session_id)  # 群内处理中的任务已达上限，群内任务完成时会重新放入可调度队列
+            return None, None
+        has_deadline = head.get("deadline") is not None  # 有截止时间的消息不受轮询额度限制
+        if not has_deadline and schedule["deficit"] < 1:  # 新一轮调度，补充额度
+            schedule["deficit"] += schedule["weight"]
+            if schedule["deficit"] < 1:  # 权重小于1的会话需要累积多轮额度
+                self._mark_ready(session_id)
+                return None, None
+        if not semaphore.acquire(blocking=False):  # 并发已满，任务完成时会重新放入可调度队列
+            return None, None
+        if not has_deadline:
+            schedule["deficit"] -= 1
+        if group_id is not None:
+            self.group_inflight[group_id] = self.group_inflight.get(group_id, 0) + 1
+        context = context_queue.get()
+        self.stats["queued"] -= 1
+        if coalesce_window > 0 and _coalescable(context):
+            self._coalesce(context, context_queue, coalesce_window)
+        self.lane_pending[lane] = self.lane_pending.get(lane, 0) + 1
+        if context_queue.empty():
+            schedule["deficit"] = 0
+        elif semaphore._value > 0:
+            self._mark_ready(session_id, front=schedule["deficit"] >= 1)  # 本轮额度未用完时优先继续调度
+        return context, lane
+
+    # 将同一用户在合并窗口内连续发送且仍在排队的文本消息合并到context中，调用方需持有self.lock
+    def _coalesce(self, context, context_queue, coalesce_window):
+        contents = [context.content]
+        last_time = context["receive_time"]
+        while not context_queue.empty():
+            follow = context_queue.queue[0]
+            if not _coalescable(follow) or _sender_id(follow) != _sender_id(context):
+                break
+            if follow["receive_time"] - last_time > coalesce_window:
+                break
+            context_queue.get()
+            self.stats["queued"] -= 1
+            contents.append(follow.content)
+            last_time = follow["receive_time"]
+        if len(contents) > 1:
+            logger.info("[chat_channel] coalesce {} messages, session_id={}".format(len(contents), context.session_id))
+            context.content = "\n".join(contents)
+
+    # 延迟到due_time后再调度该会话，调用方需持有self.lock
+    def _delay(self, session_id, due_time):
+        if session_id not in self.delayed_set:
+            self.delayed_set.add(session_id)
+            heapq.heappush(self.delayed_sessions, (due_time, session_id))
+
+    # 将已到期的延迟会话放入可调度队列，返回距离下一个到期的秒数，调用方需持有self.lock
+    def _wake_delayed(self):
+        now = time.monotonic()
+        while self.delayed_sessions and self.delayed_sessions[0][0] <= now:
+            _, session_id = heapq.heappop(self.delayed_sessions)
+            self.delayed_set.discard(session_id)
+            self._mark_ready(session_id)
+        if self.delayed_sessions:
+            return self.delayed_sessions[0][0] - now
+        return None
 
-    # 消费者函数，单独线程，用于从消息队列中取出消息并处理
+    # 消费者函数，单独线程，在produce或任务完成时被唤醒，从可调度队列中取出消息并处理
     def consume(self):
         while True:
             with self.lock:
-                session_ids = list(self.sessions.keys())
-            for session_id in session_ids:
-                with self.lock:
-                    context_queue, semaphore = self.sessions[session_id]
-                if semaphore.acquire(blocking=False):  # 等线程处理完毕才能删除
-                    if not context_queue.empty():
-                        context = context_queue.get()
-                        logger.debug("[chat_channel] consume context: {}".format(context))
-                        future: Future = handler_pool.submit(self._handle, context)
-                        future.add_done_callback(self._thread_pool_callback(session_id, context=context))
-                        with self.lock:
-                            if session_id not in self.futures:
-                                self.futures[session_id] = []
-                            self.futures[session_id].append(future)
-                    elif semaphore._initial_value == semaphore._value + 1:  # 除了当前，没有任务再申请到信号量，说明所有任务都处理完毕
-                        with self.lock:
-                            self.futures[session_id] = [t for t in self.futures[session_id] if not t.done()]
-                            assert len(self.futures[session_id]) == 0, "thread pool error"
-                            del self.sessions[session_id]
-                    else:
-                        semaphore.release()
-            time.sleep(0.2)
+                timeout = self._wake_delayed()
+                while not self.ready_sessions and not self.deadline_sessions:
+                    self.cond.wait(timeout)
+                    timeout = self._wake_delayed()
+                session_id = self._next_ready()
+                context, lane = self._pop_context(session_id)
+                if context is None:
+                    continue
+            logger.debug("[chat_channel] consume context: %s, lane: %s", context, lane)
+            if is_async_lane(lane):
+                future: Future = asyncio.run_coroutine_threadsafe(self._ahandle(context), get_async_loop())
+            else:
+                future: Future = get_handler_pool(lane).submit(self._handle, context)
+            with self.lock:
+                if session_id not in self.futures:
+                    self.futures[session_id] = []
+                self.futures[session_id].append(future)
+            future.add_done_callback(self._thread_pool_callback(session_id, lane, context=context))
 
-    # 取消session_id对应的所有任务，只能取消排队的消息和已提交线程池但未执行的任务
+    # 取消session_id对应的所有任务，只能取消排队的消息和已提交线程池但未执行的任务，async_mode下正在等待回复的协程也会被取消
     def cancel_session(self, session_id):
         with self.lock:
             if session_id in self.sessions:
-                for future in self.futures[session_id]:
+                for future in list(self.futures.get(session_id, [])):
                     future.cancel()
+                if session_id not in self.sessions:
+                    return
                 cnt = self.sessions[session_id][0].qsize()
                 if cnt > 0:
                     logger.info("Cancel {} messages in session {}".format(cnt, session_id))
+                self.stats["queued"] -= cnt
                 self.sessions[session_id][0] = Dequeue()
+                self._release_session_if_idle(session_id)
 
     def cancel_all_session(self):
         with self.lock:
-            for session_id in self.sessions:
-                for future in self.futures[session_id]:
-                    future.cancel()
-                cnt = self.sessions[session_id][0].qsize()
-                if cnt > 0:
-                    logger.info("Cancel {} messages in session {}".format(cnt, session_id))
-                self.sessions[session_id][0] = Dequeue()
+            for session_id in list(self.sessions.keys()):
+                self.cancel_session(session_id)
+
+
+# 会话的调度权重，vip_session_list中的会话id、群名或用户昵称使用vip权重
+def _session_weight(context: Context):
+    weights = dict(DEFAULT_SESSION_WEIGHTS)
+    weights.update(conf_snapshot().get("session_weights", {}))
+    vip_session_list = conf_snapshot().get("vip_session_list", [])
+    if vip_session_list:
+        names = [context.session_id]
+        cmsg = context.msg
+        if cmsg is not None:
+            names += [cmsg.other_user_nickname, cmsg.actual_user_nickname if context.isgroup else cmsg.from_user_nickname]
+        if any(name and name in vip_session_list for name in names):
+            return weights["vip"]
+    return weights["group"] if context.isgroup else weights["private"]
+
+
+# 是否为可合并的普通文本消息, 管理命令不参与合并
+def _coalescable(context: Context):
+    return context.type == ContextType.TEXT and not context.content.startswith("#") and _sender_id(context) is not None
+
+
+def _sender_id(context: Context):
+    cmsg = context.msg
+    if cmsg is None:
+        return None
+    if context.isgroup:
+        return cmsg.actual_user_id
+    return cmsg.from_user_id
 
 
 def check_prefix(content, prefix_list):
@@ -34,34 +34,65 @@ _rawmsg: 原始消息对象
 
 
 class ChatMessage(object):
-    msg_id = None
-    create_time = None
-
-    ctype = None
-    content = None
-
-    from_user_id = None
-    from_user_nickname = None
-    to_user_id = None
-    to_user_nickname = None
-    other_user_id = None
-    other_user_nickname = None
-    my_msg = False
-    self_display_name = None
-
-    is_group = False
-    is_at = False
-    actual_user_id = None
-    actual_user_nickname = None
-    at_list = None
-
-    _prepare_fn = None
-    _prepared = False
-    _rawmsg = None
+    # 公共字段使用slot存储，子类特有的字段仍保存在__dict__中
+    __slots__ = (
+        "msg_id",
+        "create_time",
+        "ctype",
+        "content",
+        "from_user_id",
+        "from_user_nickname",
+        "to_user_id",
+        "to_user_nickname",
+        "other_user_id",
+        "other_user_nickname",
+        "my_msg",
+        "self_display_name",
+        "is_group",
+        "is_at",
+        "actual_user_id",
+        "actual_user_nickname",
+        "at_list",
+        "_prepare_fn",
+        "_prepared",
+        "_rawmsg",
+        "__dict__",
+    )
 
     def __init__(self, _rawmsg):
+        self.msg_id = None
+        self.create_time = None
+
+        self.ctype = None
+        self.content = None
+
+        self.from_user_id = None
+        self.from_user_nickname = None
+        self.to_user_id = None
+        self.to_user_nickname = None
+        self.other_user_id = None
+        self.other_user_nickname = None
+        self.my_msg = False
+        self.self_display_name = None
+
+        self.is_group = False
+        self.is_at = False
+        self.actual_user_id = None
+        self.actual_user_nickname = None
+        self.at_list = None
+
+        self._prepare_fn = None
+        self._prepared = False
         self._rawmsg = _rawmsg
 
+    def fields(self):
+        """
+        返回全部字段，包括slot字段和子类添加的字段
+        """
+        fields = {key: getattr(self, key) for key in ChatMessage.__slots__ if key != "__dict__"}
+        fields.update(self.__dict__)
+        return fields
+
     def prepare(self):
         if self._prepare_fn and not self._prepared:
             self._prepared = True
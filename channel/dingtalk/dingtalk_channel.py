@@ -23,6 +23,7 @@ from channel.dingtalk.dingtalk_message import DingTalkMessage
 from common.expired_dict import ExpiredDict
 from common.log import logger
 from common.singleton import singleton
+from common.stream_utils import accumulate
 from common.time_check import time_checker
 from config import conf
 import cv2
@@ -107,7 +108,7 @@ class DingTalkChanel(ChatChannel, dingtalk_stream.ChatbotHandler):
         super(dingtalk_stream.ChatbotHandler, self).__init__()
         self.logger = self.setup_logger()
         # 历史消息id暂存，用于幂等控制
-        self.receivedMsgs = ExpiredDict(conf().get("expires_in_seconds", 3600))
+        self.receivedMsgs = ExpiredDict(conf().get("expires_in_seconds", 3600), refresh_on_read=False)
         logger.info("[DingTalk] client_id={}, client_secret={} ".format(
             self.dingtalk_client_id, self.dingtalk_client_secret))
         # 无需群校验和前缀
@@ -234,6 +235,30 @@ class DingTalkChanel(ChatChannel, dingtalk_stream.ChatbotHandler):
             self.reply_text(reply.content, incoming_message)
 
 
+    def send_stream(self, reply: Reply, context: Context):
+        """
+        开启AI卡片时，流式回复在同一张卡片中逐步更新，否则按段落分多条消息发送
+        """
+        if not conf().get("dingtalk_card_enabled"):
+            return super().send_stream(reply, context)
+        incoming_message = context.msg.incoming_message
+        content_key = "content"
+        card_instance = dingtalk_stream.AICardReplier(self.dingtalk_client, incoming_message)
+        card_instance_id = card_instance.create_and_send_card(
+            self.dingtalk_message_card_template_id, {content_key: ""}, callback_type="STREAM"
+        )
+        for text, finished in accumulate(reply.content, conf().get("stream_update_interval", 1)):
+            card_instance.streaming(
+                card_instance_id,
+                content_key=content_key,
+                content_value=text,
+                append=False,
+                finished=finished,
+                failed=False,
+            )
+        if context.msg.is_group:
+            self.reply_text("📢 您有一条新的消息，请查看。", incoming_message)
+
     def generate_button_markdown_content(self, context, reply):
         image_url = context.kwargs.get("image_url")
         promptEn = context.kwargs.get("promptEn")
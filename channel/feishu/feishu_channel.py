@@ -8,13 +8,14 @@
 # -*- coding=utf-8 -*-
 import uuid
 
-import requests
 import web
 from channel.feishu.feishu_message import FeishuMessage
 from bridge.context import Context
 from bridge.reply import Reply, ReplyType
+from common import http_client
 from common.log import logger
 from common.singleton import singleton
+from common.stream_utils import accumulate
 from config import conf
 from common.expired_dict import ExpiredDict
 from bridge.context import ContextType
@@ -31,11 +32,13 @@ class FeiShuChanel(ChatChannel):
     feishu_app_id = conf().get('feishu_app_id')
     feishu_app_secret = conf().get('feishu_app_secret')
     feishu_token = conf().get('feishu_token')
+    # 飞书一条消息最多编辑20次
+    MAX_MESSAGE_EDITS = 20
 
     def __init__(self):
         super().__init__()
         # 历史消息id暂存，用于幂等控制
-        self.receivedMsgs = ExpiredDict(60 * 60 * 7.1)
+        self.receivedMsgs = ExpiredDict(60 * 60 * 7.1, refresh_on_read=False)
         logger.info("[FeiShu] app_id={}, app_secret={} verification_token={}".format(
             self.feishu_app_id, self.feishu_app_secret, self.feishu_token))
         # 无需群校验和前缀
@@ -51,12 +54,7 @@ class FeiShuChanel(ChatChannel):
         web.httpserver.runsimple(app.wsgifunc(), ("0.0.0.0", port))
 
     def send(self, reply: Reply, context: Context):
-        msg = context.get("msg")
-        is_group = context["isgroup"]
-        if msg:
-            access_token = msg.access_token
-        else:
-            access_token = self.fetch_access_token()
+        access_token = self._access_token(context)
         headers = {
             "Authorization": "Bearer " + access_token,
             "Content-Type": "application/json",
@@ -73,14 +71,50 @@ class FeiShuChanel(ChatChannel):
                 return
             msg_type = "image"
             content_key = "image_key"
-        if is_group:
+        self._send_message(context, headers, msg_type, content_key, reply_content)
+
+    def send_stream(self, reply: Reply, context: Context):
+        """
+        流式回复先发送第一段文本，之后编辑同一条消息更新内容，一条消息最多编辑MAX_MESSAGE_EDITS次
+        """
+        headers = {
+            "Authorization": "Bearer " + self._access_token(context),
+            "Content-Type": "application/json",
+        }
+        message_id = None
+        edits = 0
+        for text, finished in accumulate(reply.content, conf().get("stream_update_interval", 1)):
+            if message_id is None:
+                message_id = self._send_message(context, headers, "text", "text", text)
+                if message_id is None:
+                    return
+            elif finished or edits < self.MAX_MESSAGE_EDITS - 1:
+                # 编辑次数用完前保留最后一次，确保最终内容完整
+                url = f"https://open.feishu.cn/open-apis/im/v1/messages/{message_id}"
+                data = {"msg_type": "text", "content": json.dumps({"text": text})}
+                res = http_client.put(url, headers=headers, json=data, timeout=(5, 10)).json()
+                edits += 1
+                if res.get("code") != 0:
+                    logger.error(f"[FeiShu] update message failed, code={res.get('code')}, msg={res.get('msg')}")
+
+    def _access_token(self, context: Context) -> str:
+        msg = context.get("msg")
+        if msg:
+            return msg.access_token
+        return self.fetch_access_token()
+
+    def _send_message(self, context: Context, headers, msg_type, content_key, reply_content):
+        """
+        :return: 发送成功时返回消息id，失败时返回None
+        """
+        if context["isgroup"]:
             # 群聊中直接回复
-            url = f"https://open.feishu.cn/open-apis/im/v1/messages/{msg.msg_id}/reply"
+            url = f"https://open.feishu.cn/open-apis/im/v1/messages/{context.get('msg').msg_id}/reply"
             data = {
                 "msg_type": msg_type,
                 "content": json.dumps({content_key: reply_content})
             }
-            res = requests.post(url=url, headers=headers, json=data, timeout=(5, 10))
+            res = http_client.post(url=url, headers=headers, json=data, timeout=(5, 10))
         else:
             url = "https://open.feishu.cn/open-apis/im/v1/messages"
             params = {"receive_id_type": context.get("receive_id_type") or "open_id"}
@@ -89,12 +123,13 @@ class FeiShuChanel(ChatChannel):
                 "msg_type": msg_type,
                 "content": json.dumps({content_key: reply_content})
             }
-            res = requests.post(url=url, headers=headers, params=params, json=data, timeout=(5, 10))
+            res = http_client.post(url=url, headers=headers, params=params, json=data, timeout=(5, 10))
         res = res.json()
         if res.get("code") == 0:
             logger.info(f"[FeiShu] send message success")
-        else:
-            logger.error(f"[FeiShu] send message failed, code={res.get('code')}, msg={res.get('msg')}")
+            return res.get("data", {}).get("message_id")
+        logger.error(f"[FeiShu] send message failed, code={res.get('code')}, msg={res.get('msg')}")
+        return None
 
 
     def fetch_access_token(self) -> str:
@@ -107,7 +142,7 @@ class FeiShuChanel(ChatChannel):
             "app_secret": self.feishu_app_secret
         }
         data = bytes(json.dumps(req_body), encoding='utf8')
-        response = requests.post(url=url, data=data, headers=headers)
+        response = http_client.post(url=url, data=data, headers=headers)
         if response.status_code == 200:
             res = response.json()
             if res.get("code") != 0:
@@ -121,7 +156,7 @@ class FeiShuChanel(ChatChannel):
 
     def _upload_image_url(self, img_url, access_token):
         logger.debug(f"[WX] start download image, img_url={img_url}")
-        response = requests.get(img_url)
+        response = http_client.get(img_url)
         suffix = utils.get_path_suffix(img_url)
         temp_name = str(uuid.uuid4()) + "." + suffix
         if response.status_code == 200:
@@ -138,7 +173,7 @@ class FeiShuChanel(ChatChannel):
             'Authorization': f'Bearer {access_token}',
         }
         with open(temp_name, "rb") as file:
-            upload_response = requests.post(upload_url, files={"image": file}, data=data, headers=headers)
+            upload_response = http_client.post(upload_url, files={"image": file}, data=data, headers=headers)
             logger.info(f"[FeiShu] upload file, res={upload_response.content}")
             os.remove(temp_name)
             return upload_response.json().get("data").get("image_key")
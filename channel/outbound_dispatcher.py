@@ -0,0 +1,93 @@
+"""
+Outbound send dispatcher
+
+每个接收者一个先进先出的发送队列，由少量发送线程依次执行，保证同一接收者的消息按顺序发送。
+发送间隔和接口限速通过定时调度实现，等待期间不占用消息处理线程和发送线程。
+"""
+
+import threading
+import time
+from collections import deque
+
+from common.delayed_executor import DelayedExecutor
+from common.log import logger
+from config import conf
+
+
+class OutboundDispatcher:
+    def __init__(self, max_workers=2):
+        self.executor = DelayedExecutor("outbound", max_workers=max_workers)
+        self.lock = threading.Lock()
+        self.queues = {}  # receiver -> deque[(fn, args, kwargs, delay, api, on_error)]，队首为正在执行或等待执行的任务
+        self.retries = {}  # receiver -> 队首任务已重试的次数
+        self.api_next_time = {}  # 每个接口下一次允许调用的时间
+        self.local = threading.local()  # 记录当前发送线程正在执行的接收者及插入位置
+
+    def submit(self, receiver, fn, *args, delay=0, api=None, on_error=None, **kwargs):
+        """
+        按接收者顺序执行fn
+        :param receiver: 接收者，同一接收者的任务按提交顺序执行
+        :param delay: 距离该接收者上一个任务结束的最短间隔(秒)
+        :param api: 接口名称，用于按outbound_rate_limits限速
+        :param on_error: fn抛出异常时调用on_error(异常, 已重试次数)，返回重试前等待的秒数，返回None表示不再重试
+        """
+        task = (fn, args, kwargs, delay, api, on_error)
+        with self.lock:
+            queue = self.queues.get(receiver)
+            if queue is None:
+                self.queues[receiver] = deque([task])
+                self._schedule(receiver, delay)
+            elif getattr(self.local, "receiver", None) == receiver:
+                # 在该接收者的任务内提交的后续任务，紧跟当前任务执行，排在之后提交的任务前面
+                queue.insert(self.local.inserted + 1, task)
+                self.local.inserted += 1
+            else:
+                queue.append(task)
+
+    def pending(self):
+        with self.lock:
+            return sum(len(queue) for queue in self.queues.values())
+
+    # 调度接收者队首的任务，调用方需持有self.lock
+    def _schedule(self, receiver, delay):
+        api = self.queues[receiver][0][4]
+        delay = max(delay, conf().get("outbound_min_interval", 0))
+        rate = conf().get("outbound_rate_limits", {}).get(api) if api else None
+        if rate:
+            now = time.monotonic()
+            run_time = max(now + delay, self.api_next_time.get(api, 0))
+            self.api_next_time[api] = run_time + 1 / rate
+            delay = run_time - now
+        self.executor.submit_after(delay, self._run, receiver)
+
+    def _run(self, receiver):
+        with self.lock:
+            fn, args, kwargs, _, _, on_error = self.queues[receiver][0]
+            retry_cnt = self.retries.get(receiver, 0)
+        self.local.receiver = receiver
+        self.local.inserted = 0
+        retry_delay = None
+        try:
+            fn(*args, **kwargs)
+        except Exception as e:
+            logger.exception("[outbound] send to {} error: {}".format(receiver, e))
+            if on_error:
+                try:
+                    retry_delay = on_error(e, retry_cnt)
+                except Exception as e:
+                    logger.exception("[outbound] error callback failed: {}".format(e))
+        finally:
+            self.local.receiver = None
+            with self.lock:
+                queue = self.queues[receiver]
+                if retry_delay is not None:
+                    # 失败的任务留在队首重试，同一接收者之后的消息继续排在它后面
+                    self.retries[receiver] = retry_cnt + 1
+                    self._schedule(receiver, retry_delay)
+                    return
+                self.retries.pop(receiver, None)
+                queue.popleft()
+                if queue:
+                    self._schedule(receiver, queue[0][3])
+                else:
+                    del self.queues[receiver]
@@ -0,0 +1,193 @@
+"""
+Session shard processes
+
+按session_id哈希将消息分配到多个工作进程处理，绕开单进程GIL对正则匹配、token计算、语音转换、图片压缩等CPU密集步骤的限制。
+每个工作进程持有自己的bot会话和插件实例，同一会话的消息总是进入同一进程，回复返回渠道进程发送。
+"""
+
+import itertools
+import multiprocessing
+import pickle
+import threading
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+
+from bridge.context import Context
+from bridge.reply import Reply
+from channel.chat_channel import ChatChannel
+from channel.chat_message import ChatMessage
+from common.log import logger
+from config import conf, load_config
+
+
+class ShardPool:
+    """
+    渠道进程一侧，负责启动工作进程、分发消息并接收回复
+    """
+
+    def __init__(self, channel: ChatChannel, processes):
+        self.channel = channel
+        self.mp = multiprocessing.get_context("spawn")
+        self.channel_info = {
+            "channel_type": channel.channel_type,
+            "name": channel.name,
+            "user_id": channel.user_id,
+            "not_support_replytype": channel.NOT_SUPPORT_REPLYTYPE,
+        }
+        self.resp_queue = self.mp.Queue()
+        self.req_queues = [self.mp.Queue() for _ in range(processes)]
+        self.processes = [None] * processes
+        self.lock = threading.Lock()
+        self.seq = itertools.count()
+        self.futures = {}  # 请求id -> 等待回复的future
+        # 请求id -> 原始context，处理期间工作进程主动发送消息时据此找回原始消息对象，请求结束后的发送使用context副本
+        self.contexts = {}
+        for index in range(processes):
+            self._start_process(index)
+        threading.Thread(target=self._read_responses, name="shard_reader", daemon=True).start()
+
+    def shard(self, session_id) -> int:
+        return zlib.crc32(str(session_id).encode("utf-8")) % len(self.req_queues)
+
+    def handle(self, context: Context) -> Reply:
+        """
+        将context交给对应的工作进程生成并包装回复，阻塞直到回复返回
+        """
+        cmsg = context.get("msg")
+        if cmsg is not None:
+            cmsg.prepare()  # 下载图片、语音等文件需要原始消息对象，在渠道进程中完成
+        index = self.shard(context["session_id"])
+        future = Future()
+        with self.lock:
+            req_id = next(self.seq)
+            self.futures[req_id] = future
+            self.contexts[req_id] = context
+        try:
+            data = pickle.dumps((req_id, _snapshot_context(context, req_id)))
+            with self.lock:
+                if not self.processes[index].is_alive():
+                    logger.warning("[shard] worker {} exited with code {}, restart it".format(index, self.processes[index].exitcode))
+                    self._start_process(index)
+            self.req_queues[index].put(data)
+            while True:
+                try:
+                    return future.result(timeout=5)
+                except TimeoutError:
+                    if not self.processes[index].is_alive():
+                        raise RuntimeError("shard worker {} exited while handling session {}".format(index, context["session_id"]))
+        finally:
+            with self.lock:
+                self.futures.pop(req_id, None)
+                self.contexts.pop(req_id, None)
+
+    # 调用方需持有self.lock或在初始化时调用
+    def _start_process(self, index):
+        process = self.mp.Process(
+            target=shard_main,
+            args=(index, self.channel_info, self.req_queues[index], self.resp_queue),
+            name="shard_{}".format(index),
+            daemon=True,
+        )
+        process.start()
+        self.processes[index] = process
+        logger.info("[shard] start worker {}, pid={}".format(index, process.pid))
+
+    def _read_responses(self):
+        while True:
+            try:
+                kind, req_id, payload = pickle.loads(self.resp_queue.get())
+                if kind == "send":
+                    # 工作进程中主动发送的消息，在读取线程中直接发送以保证先于最终回复送达
+                    reply, snapshot = payload
+                    with self.lock:
+                        context = self.contexts.get(req_id, snapshot)
+                    self.channel._send(reply, context)
+                    continue
+                with self.lock:
+                    future = self.futures.get(req_id)
+                if future is None:
+                    continue
+                if kind == "reply":
+                    future.set_result(payload)
+                else:
+                    future.set_exception(RuntimeError(payload))
+            except Exception as e:
+                logger.exception("[shard] read response error: {}".format(e))
+
+
+class ShardChannel(ChatChannel):
+    """
+    工作进程一侧的渠道对象，只执行回复的生成和包装步骤，发送操作转交渠道进程
+    """
+
+    def __init__(self, channel_info, resp_queue):
+        # 不启动consume线程，消息由渠道进程调度
+        self.channel_type = channel_info["channel_type"]
+        self.name = channel_info["name"]
+        self.user_id = channel_info["user_id"]
+        self.NOT_SUPPORT_REPLYTYPE = channel_info["not_support_replytype"]
+        self.resp_queue = resp_queue
+
+    def send(self, reply: Reply, context: Context):
+        req_id = context.get("shard_request_id")
+        self._put("send", req_id, (reply, _snapshot_context(context, req_id)))
+
+    def process(self, req_id, context: Context):
+        try:
+            reply = self._generate_reply(context)
+            if reply and reply.content:
+                reply = self._decorate_reply(context, reply)
+            self._put("reply", req_id, reply)
+        except Exception as e:
+            logger.exception("[shard] handle context error: {}".format(e))
+            self._put("error", req_id, str(e))
+
+    def _put(self, kind, req_id, payload):
+        try:
+            data = pickle.dumps((kind, req_id, payload))
+        except Exception as e:
+            logger.error("[shard] {} can't be pickled: {}".format(kind, e))
+            data = pickle.dumps(("error", req_id, str(e)))
+        self.resp_queue.put(data)
+
+
+# 工作进程入口，加载配置和插件后循环处理渠道进程分发的消息
+def shard_main(index, channel_info, req_queue, resp_queue):
+    from plugins import PluginManager
+
+    load_config()
+    PluginManager().load_plugins()
+    channel = ShardChannel(channel_info, resp_queue)
+    pool = ThreadPoolExecutor(max_workers=conf().get("shard_worker_threads", 8), thread_name_prefix="shard_{}".format(index))
+    logger.info("[shard] worker {} ready".format(index))
+    while True:
+        req_id, context = pickle.loads(req_queue.get())
+        pool.submit(channel.process, req_id, context)
+
+
+# 复制context中可以跨进程传递的部分，原始消息对象替换为只包含基本字段的ChatMessage
+def _snapshot_context(context: Context, req_id) -> Context:
+    kwargs = {}
+    for key, value in context.kwargs.items():
+        if key == "channel":
+            continue
+        if key == "msg" and value is not None:
+            value = _snapshot_msg(value)
+        kwargs[key] = value
+    kwargs["shard_request_id"] = req_id
+    return Context(context.type, context.content, kwargs)
+
+
+def _snapshot_msg(cmsg: ChatMessage) -> ChatMessage:
+    snapshot = ChatMessage(None)
+    for key, value in cmsg.fields().items():
+        if key in ["_rawmsg", "_prepare_fn"]:
+            continue
+        try:
+            pickle.dumps(value)
+        except Exception:
+            logger.debug("[shard] skip unpicklable message field: %s", key)
+            continue
+        setattr(snapshot, key, value)
+    snapshot._prepared = True
+    return snapshot
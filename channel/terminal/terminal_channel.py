@@ -18,6 +18,7 @@ class TerminalMessage(ChatMessage):
         to_user_id="Chatgpt",
         other_user_id="Chatgpt",
     ):
+        super().__init__(None)
         self.msg_id = msg_id
         self.ctype = ctype
         self.content = content
@@ -42,11 +43,11 @@ class TerminalChannel(ChatChannel):
         elif reply.type == ReplyType.IMAGE_URL:  # 从网络下载图片
             import io
 
-            import requests
+            from common import http_client
             from PIL import Image
 
             img_url = reply.content
-            pic_res = requests.get(img_url, stream=True)
+            pic_res = http_client.get(img_url, stream=True)
             image_storage = io.BytesIO()
             for block in pic_res.iter_content(1024):
                 image_storage.write(block)
@@ -60,6 +61,13 @@ class TerminalChannel(ChatChannel):
         sys.stdout.flush()
         return
 
+    def send_stream(self, reply: Reply, context: Context):
+        print("\nBot:")
+        for chunk in reply.content:
+            print(chunk, end="", flush=True)
+        print("\n\nUser:", end="")
+        sys.stdout.flush()
+
     def startup(self):
         context = Context()
         logger.setLevel("WARN")
@@ -2,7 +2,7 @@ import sys
 import time
 import web
 import json
-from queue import Queue
+from queue import Empty, Queue
 from bridge.context import *
 from bridge.reply import Reply, ReplyType
 from channel.chat_channel import ChatChannel, check_prefix
@@ -23,6 +23,7 @@ class WebMessage(ChatMessage):
         to_user_id="Chatgpt",
         other_user_id="Chatgpt",
     ):
+        super().__init__(None)
         self.msg_id = msg_id
         self.ctype = ctype
         self.content = content
@@ -64,11 +65,11 @@ class WebChannel(ChatChannel):
             elif reply.type == ReplyType.IMAGE_URL:
                 import io
 
-                import requests
+                from common import http_client
                 from PIL import Image
 
                 img_url = reply.content
-                pic_res = requests.get(img_url, stream=True)
+                pic_res = http_client.get(img_url, stream=True)
                 image_storage = io.BytesIO()
                 for block in pic_res.iter_content(1024):
                     image_storage.write(block)
@@ -99,6 +100,18 @@ class WebChannel(ChatChannel):
             logger.error(f"Error in send method: {e}")
             raise
 
+    def send_stream(self, reply: Reply, context: Context):
+        """
+        流式回复逐段推送给网页，网页按stream_id把内容追加到同一条消息中
+        """
+        user_id = context["receiver"]
+        if user_id not in self.message_queues:
+            self.message_queues[user_id] = Queue()
+        stream_id = self._generate_msg_id()
+        for chunk in reply.content:
+            self.message_queues[user_id].put({"type": str(reply.type), "stream_id": stream_id, "content": chunk, "done": False, "timestamp": time.time()})
+        self.message_queues[user_id].put({"type": str(reply.type), "stream_id": stream_id, "content": "", "done": True, "timestamp": time.time()})
+
     def sse_handler(self, user_id):
         """
         Handle Server-Sent Events (SSE) for real-time communication.
@@ -114,14 +127,11 @@ class WebChannel(ChatChannel):
         try:    
             while True:
                 try:
-                    # 发送心跳
+                    # 有消息时立即推送，0.5秒内没有消息时发送心跳
+                    message = self.message_queues[user_id].get(timeout=0.5)
+                    yield f"data: {json.dumps(message)}\n\n"
+                except Empty:
                     yield f": heartbeat\n\n"
-                    
-                    # 非阻塞方式获取消息
-                    if not self.message_queues[user_id].empty():
-                        message = self.message_queues[user_id].get_nowait()
-                        yield f"data: {json.dumps(message)}\n\n"
-                    time.sleep(0.5)
                 except Exception as e:
                     logger.error(f"SSE Error: {e}")
                     break
@@ -6,16 +6,17 @@ wechat channel
 
 import io
 import json
+import logging
 import os
 import threading
 import time
-import requests
 
 from bridge.context import *
 from bridge.reply import *
 from channel.chat_channel import ChatChannel
 from channel import chat_channel
 from channel.wechat.wechat_message import *
+from common import http_client
 from common.expired_dict import ExpiredDict
 from common.log import logger
 from common.singleton import singleton
@@ -32,7 +33,7 @@ def handler_single_msg(msg):
     try:
         cmsg = WechatMessage(msg, False)
     except NotImplementedError as e:
-        logger.debug("[WX]single message {} skipped: {}".format(msg["MsgId"], e))
+        logger.debug("[WX]single message %s skipped: %s", msg["MsgId"], e)
         return None
     WechatChannel().handle_single(cmsg)
     return None
@@ -43,7 +44,7 @@ def handler_group_msg(msg):
     try:
         cmsg = WechatMessage(msg, True)
     except NotImplementedError as e:
-        logger.debug("[WX]group message {} skipped: {}".format(msg["MsgId"], e))
+        logger.debug("[WX]group message %s skipped: %s", msg["MsgId"], e)
         return None
     WechatChannel().handle_group(cmsg)
     return None
@@ -58,10 +59,10 @@ def _check(func):
         self.receivedMsgs[msgId] = True
         create_time = cmsg.create_time  # 消息时间戳
         if conf().get("hot_reload") == True and int(create_time) < int(time.time()) - 60:  # 跳过1分钟前的历史消息
-            logger.debug("[WX]history message {} skipped".format(msgId))
+            logger.debug("[WX]history message %s skipped", msgId)
             return
         if cmsg.my_msg and not cmsg.is_group:
-            logger.debug("[WX]my message {} skipped".format(msgId))
+            logger.debug("[WX]my message %s skipped", msgId)
             return
         return func(self, cmsg)
 
@@ -113,7 +114,7 @@ class WechatChannel(ChatChannel):
 
     def __init__(self):
         super().__init__()
-        self.receivedMsgs = ExpiredDict(conf().get("expires_in_seconds", 3600))
+        self.receivedMsgs = ExpiredDict(conf().get("expires_in_seconds", 3600), refresh_on_read=False)
         self.auto_login_times = 0
 
     def startup(self):
@@ -156,7 +157,8 @@ class WechatChannel(ChatChannel):
                 time.sleep(2)
                 self.auto_login_times += 1
                 if self.auto_login_times < 100:
-                    chat_channel.handler_pool._shutdown = False
+                    for pool in chat_channel.handler_pools.values():
+                        pool._shutdown = False
                     self.startup()
         except Exception as e:
             pass
@@ -185,15 +187,16 @@ class WechatChannel(ChatChannel):
         if cmsg.ctype == ContextType.VOICE:
             if conf().get("speech_recognition") != True:
                 return
-            logger.debug("[WX]receive voice msg: {}".format(cmsg.content))
+            logger.debug("[WX]receive voice msg: %s", cmsg.content)
         elif cmsg.ctype == ContextType.IMAGE:
-            logger.debug("[WX]receive image msg: {}".format(cmsg.content))
+            logger.debug("[WX]receive image msg: %s", cmsg.content)
         elif cmsg.ctype == ContextType.PATPAT:
-            logger.debug("[WX]receive patpat msg: {}".format(cmsg.content))
+            logger.debug("[WX]receive patpat msg: %s", cmsg.content)
         elif cmsg.ctype == ContextType.TEXT:
-            logger.debug("[WX]receive text msg: {}, cmsg={}".format(json.dumps(cmsg._rawmsg, ensure_ascii=False), cmsg))
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("[WX]receive text msg: %s, cmsg=%s", json.dumps(cmsg._rawmsg, ensure_ascii=False), cmsg)
         else:
-            logger.debug("[WX]receive msg: {}, cmsg={}".format(cmsg.content, cmsg))
+            logger.debug("[WX]receive msg: %s, cmsg=%s", cmsg.content, cmsg)
         context = self._compose_context(cmsg.ctype, cmsg.content, isgroup=False, msg=cmsg)
         if context:
             self.produce(context)
@@ -204,18 +207,18 @@ class WechatChannel(ChatChannel):
         if cmsg.ctype == ContextType.VOICE:
             if conf().get("group_speech_recognition") != True:
                 return
-            logger.debug("[WX]receive voice for group msg: {}".format(cmsg.content))
+            logger.debug("[WX]receive voice for group msg: %s", cmsg.content)
         elif cmsg.ctype == ContextType.IMAGE:
-            logger.debug("[WX]receive image for group msg: {}".format(cmsg.content))
+            logger.debug("[WX]receive image for group msg: %s", cmsg.content)
         elif cmsg.ctype in [ContextType.JOIN_GROUP, ContextType.PATPAT, ContextType.ACCEPT_FRIEND, ContextType.EXIT_GROUP]:
-            logger.debug("[WX]receive note msg: {}".format(cmsg.content))
+            logger.debug("[WX]receive note msg: %s", cmsg.content)
         elif cmsg.ctype == ContextType.TEXT:
             # logger.debug("[WX]receive group msg: {}, cmsg={}".format(json.dumps(cmsg._rawmsg, ensure_ascii=False), cmsg))
             pass
         elif cmsg.ctype == ContextType.FILE:
             logger.debug(f"[WX]receive attachment msg, file_name={cmsg.content}")
         else:
-            logger.debug("[WX]receive group msg: {}".format(cmsg.content))
+            logger.debug("[WX]receive group msg: %s", cmsg.content)
         context = self._compose_context(cmsg.ctype, cmsg.content, isgroup=True, msg=cmsg, no_need_at=conf().get("no_need_at", False))
         if context:
             self.produce(context)
@@ -237,7 +240,7 @@ class WechatChannel(ChatChannel):
         elif reply.type == ReplyType.IMAGE_URL:  # 从网络下载图片
             img_url = reply.content
             logger.debug(f"[WX] start download image, img_url={img_url}")
-            pic_res = requests.get(img_url, stream=True)
+            pic_res = http_client.get(img_url, stream=True)
             image_storage = io.BytesIO()
             size = 0
             for block in pic_res.iter_content(1024):
@@ -269,7 +272,7 @@ class WechatChannel(ChatChannel):
         elif reply.type == ReplyType.VIDEO_URL:  # 新增视频URL回复类型
             video_url = reply.content
             logger.debug(f"[WX] start download video, video_url={video_url}")
-            video_res = requests.get(video_url, stream=True)
+            video_res = http_client.get(video_url, stream=True)
             video_storage = io.BytesIO()
             size = 0
             for block in video_res.iter_content(1024):
@@ -283,7 +286,7 @@ class WechatChannel(ChatChannel):
             res_dict = reply.content
             text_content = res_dict.get('content')
             img_url = res_dict.get('img_url')
-            pic_res = requests.get(img_url, stream=True)
+            pic_res = http_client.get(img_url, stream=True)
             image_storage = io.BytesIO()
             size = 0
             for block in pic_res.iter_content(1024):
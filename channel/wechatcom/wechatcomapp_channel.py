@@ -1,9 +1,7 @@
 # -*- coding=utf-8 -*-
 import io
 import os
-import time
 
-import requests
 import web
 from wechatpy.enterprise import create_reply, parse_message
 from wechatpy.enterprise.crypto import WeChatCrypto
@@ -15,6 +13,7 @@ from bridge.reply import Reply, ReplyType
 from channel.chat_channel import ChatChannel
 from channel.wechatcom.wechatcomapp_client import WechatComAppClient
 from channel.wechatcom.wechatcomapp_message import WechatComAppMessage
+from common import http_client
 from common.log import logger
 from common.singleton import singleton
 from common.utils import compress_imgfile, fsize, split_string_by_utf8_length, convert_webp_to_png, remove_markdown_symbol
@@ -57,9 +56,8 @@ class WechatComAppChannel(ChatChannel):
             if len(texts) > 1:
                 logger.info("[wechatcom] text too long, split into {} parts".format(len(texts)))
             for i, text in enumerate(texts):
-                self.client.message.send_text(self.agent_id, receiver, text)
-                if i != len(texts) - 1:
-                    time.sleep(0.5)  # 休眠0.5秒，防止发送过快乱序
+                # 分段之间间隔0.5秒，防止发送过快乱序
+                self.send_in_order(receiver, self.client.message.send_text, self.agent_id, receiver, text, delay=0.5 if i else 0, api="send_text")
             logger.info("[wechatcom] Do send text to {}: {}".format(receiver, reply_text))
         elif reply.type == ReplyType.VOICE:
             try:
@@ -83,13 +81,12 @@ class WechatComAppChannel(ChatChannel):
                     os.remove(amr_file)
             except Exception:
                 pass
-            for media_id in media_ids:
-                self.client.message.send_voice(self.agent_id, receiver, media_id)
-                time.sleep(1)
+            for i, media_id in enumerate(media_ids):
+                self.send_in_order(receiver, self.client.message.send_voice, self.agent_id, receiver, media_id, delay=1 if i else 0, api="send_voice")
             logger.info("[wechatcom] sendVoice={}, receiver={}".format(reply.content, receiver))
         elif reply.type == ReplyType.IMAGE_URL:  # 从网络下载图片
             img_url = reply.content
-            pic_res = requests.get(img_url, stream=True)
+            pic_res = http_client.get(img_url, stream=True)
             image_storage = io.BytesIO()
             for block in pic_res.iter_content(1024):
                 image_storage.write(block)
@@ -112,7 +109,7 @@ class WechatComAppChannel(ChatChannel):
                 logger.error("[wechatcom] upload image failed: {}".format(e))
                 return
 
-            self.client.message.send_image(self.agent_id, receiver, response["media_id"])
+            self.send_in_order(receiver, self.client.message.send_image, self.agent_id, receiver, response["media_id"], api="send_image")
             logger.info("[wechatcom] sendImage url={}, receiver={}".format(img_url, receiver))
         elif reply.type == ReplyType.IMAGE:  # 从文件读取图片
             image_storage = reply.content
@@ -128,7 +125,7 @@ class WechatComAppChannel(ChatChannel):
             except WeChatClientException as e:
                 logger.error("[wechatcom] upload image failed: {}".format(e))
                 return
-            self.client.message.send_image(self.agent_id, receiver, response["media_id"])
+            self.send_in_order(receiver, self.client.message.send_image, self.agent_id, receiver, response["media_id"], api="send_image")
             logger.info("[wechatcom] sendImage, receiver={}".format(receiver))
 
 
@@ -6,6 +6,8 @@ from wechatpy.utils import check_signature
 from config import conf
 
 MAX_UTF8_LEN = 2048
+# 被动回复时微信服务器会以5秒为间隔重试3次，第三次请求最多等待4秒，超过该时间只能回复"正在思考中"
+PASSIVE_REPLY_WINDOW = 5 * 2 + 4
 
 
 class WeChatAPIException(Exception):
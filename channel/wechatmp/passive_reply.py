@@ -63,6 +63,7 @@ class Query:
 
                     if supported and context:
                         channel.running.add(from_user)
+                        context["deadline"] = request_time + PASSIVE_REPLY_WINDOW  # 在重试窗口内完成才能直接回复给用户
                         channel.produce(context)
                     else:
                         trigger_prefix = conf().get("single_chat_prefix", [""])[0]
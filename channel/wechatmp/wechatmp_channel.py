@@ -4,9 +4,7 @@ import imghdr
 import io
 import os
 import threading
-import time
 
-import requests
 import web
 from wechatpy.crypto import WeChatCrypto
 from wechatpy.exceptions import WeChatClientException
@@ -17,6 +15,7 @@ from bridge.reply import *
 from channel.chat_channel import ChatChannel
 from channel.wechatmp.common import *
 from channel.wechatmp.wechatmp_client import WechatMPClient
+from common import http_client
 from common.log import logger
 from common.singleton import singleton
 from common.utils import split_string_by_utf8_length, remove_markdown_symbol
@@ -83,12 +82,12 @@ class WechatMPChannel(ChatChannel):
             if reply.type == ReplyType.TEXT or reply.type == ReplyType.INFO or reply.type == ReplyType.ERROR:
                 reply_text = remove_markdown_symbol(reply.content)
                 logger.info("[wechatmp] text cached, receiver {}\n{}".format(receiver, reply_text))
-                self.cache_dict[receiver].append(("text", reply_text))
+                self._cache_reply(receiver, "text", reply_text)
             elif reply.type == ReplyType.IMAGE_AND_TEXT:
                 res_dict = reply.content
                 text_content = res_dict.get('content')
                 img_url = res_dict.get('img_url')
-                pic_res = requests.get(img_url, stream=True)
+                pic_res = http_client.get(img_url, stream=True)
                 image_storage = io.BytesIO()
                 for block in pic_res.iter_content(1024):
                     image_storage.write(block)
@@ -104,8 +103,8 @@ class WechatMPChannel(ChatChannel):
                     return
                 media_id = response["media_id"]
                 logger.info("[wechatmp] image uploaded, receiver {}, media_id {}".format(receiver, media_id))
-                self.cache_dict[receiver].append(("image", media_id))
-                self.cache_dict[receiver].append(("text", text_content))
+                self._cache_reply(receiver, "image", media_id)
+                self._cache_reply(receiver, "text", text_content)
             elif reply.type == ReplyType.VOICE:
                 voice_file_path = reply.content
                 duration, files = split_audio(voice_file_path, 60 * 1000)
@@ -119,18 +118,18 @@ class WechatMPChannel(ChatChannel):
                             response = self.client.material.add("voice", f)
                             logger.debug("[wechatmp] upload voice response: {}".format(response))
                             f_size = os.fstat(f.fileno()).st_size
-                            time.sleep(1.0 + 2 * f_size / 1024 / 1024)
                             # todo check media_id
                     except WeChatClientException as e:
                         logger.error("[wechatmp] upload voice failed: {}".format(e))
                         return
                     media_id = response["media_id"]
                     logger.info("[wechatmp] voice uploaded, receiver {}, media_id {}".format(receiver, media_id))
-                    self.cache_dict[receiver].append(("voice", media_id))
+                    # 素材上传后需要等待一段时间才能使用
+                    self._cache_reply(receiver, "voice", media_id, delay=1.0 + 2 * f_size / 1024 / 1024)
 
             elif reply.type == ReplyType.IMAGE_URL:  # 从网络下载图片
                 img_url = reply.content
-                pic_res = requests.get(img_url, stream=True)
+                pic_res = http_client.get(img_url, stream=True)
                 image_storage = io.BytesIO()
                 for block in pic_res.iter_content(1024):
                     image_storage.write(block)
@@ -146,7 +145,7 @@ class WechatMPChannel(ChatChannel):
                     return
                 media_id = response["media_id"]
                 logger.info("[wechatmp] image uploaded, receiver {}, media_id {}".format(receiver, media_id))
-                self.cache_dict[receiver].append(("image", media_id))
+                self._cache_reply(receiver, "image", media_id)
             elif reply.type == ReplyType.IMAGE:  # 从文件读取图片
                 image_storage = reply.content
                 image_storage.seek(0)
@@ -161,10 +160,10 @@ class WechatMPChannel(ChatChannel):
                     return
                 media_id = response["media_id"]
                 logger.info("[wechatmp] image uploaded, receiver {}, media_id {}".format(receiver, media_id))
-                self.cache_dict[receiver].append(("image", media_id))
+                self._cache_reply(receiver, "image", media_id)
             elif reply.type == ReplyType.VIDEO_URL:  # 从网络下载视频
                 video_url = reply.content
-                video_res = requests.get(video_url, stream=True)
+                video_res = http_client.get(video_url, stream=True)
                 video_storage = io.BytesIO()
                 for block in video_res.iter_content(1024):
                     video_storage.write(block)
@@ -180,7 +179,7 @@ class WechatMPChannel(ChatChannel):
                     return
                 media_id = response["media_id"]
                 logger.info("[wechatmp] video uploaded, receiver {}, media_id {}".format(receiver, media_id))
-                self.cache_dict[receiver].append(("video", media_id))
+                self._cache_reply(receiver, "video", media_id)
 
             elif reply.type == ReplyType.VIDEO:  # 从文件读取视频
                 video_storage = reply.content
@@ -196,7 +195,7 @@ class WechatMPChannel(ChatChannel):
                     return
                 media_id = response["media_id"]
                 logger.info("[wechatmp] video uploaded, receiver {}, media_id {}".format(receiver, media_id))
-                self.cache_dict[receiver].append(("video", media_id))
+                self._cache_reply(receiver, "video", media_id)
 
         else:
             if reply.type == ReplyType.TEXT or reply.type == ReplyType.INFO or reply.type == ReplyType.ERROR:
@@ -205,15 +204,14 @@ class WechatMPChannel(ChatChannel):
                 if len(texts) > 1:
                     logger.info("[wechatmp] text too long, split into {} parts".format(len(texts)))
                 for i, text in enumerate(texts):
-                    self.client.message.send_text(receiver, text)
-                    if i != len(texts) - 1:
-                        time.sleep(0.5)  # 休眠0.5秒，防止发送过快乱序
+                    # 分段之间间隔0.5秒，防止发送过快乱序
+                    self.send_in_order(receiver, self.client.message.send_text, receiver, text, delay=0.5 if i else 0, api="send_text")
                 logger.info("[wechatmp] Do send text to {}: {}".format(receiver, reply_text))
             elif reply.type == ReplyType.IMAGE_AND_TEXT:
                 res_dict = reply.content
                 text_content = res_dict.get('content')
                 img_url = res_dict.get('img_url')
-                pic_res = requests.get(img_url, stream=True)
+                pic_res = http_client.get(img_url, stream=True)
                 image_storage = io.BytesIO()
                 for block in pic_res.iter_content(1024):
                     image_storage.write(block)
@@ -227,14 +225,13 @@ class WechatMPChannel(ChatChannel):
                 except WeChatClientException as e:
                     logger.error("[wechatmp] upload image failed: {}".format(e))
                     return
-                self.client.message.send_image(receiver, response["media_id"])
+                self.send_in_order(receiver, self.client.message.send_image, receiver, response["media_id"], api="send_image")
                 texts = split_string_by_utf8_length(text_content, MAX_UTF8_LEN)
                 if len(texts) > 1:
                     logger.info("[wechatmp] text too long, split into {} parts".format(len(texts)))
                 for i, text in enumerate(texts):
-                    self.client.message.send_text(receiver, text)
-                    if i != len(texts) - 1:
-                        time.sleep(0.5)  # 休眠0.5秒，防止发送过快乱序
+                    # 分段之间间隔0.5秒，防止发送过快乱序
+                    self.send_in_order(receiver, self.client.message.send_text, receiver, text, delay=0.5 if i else 0, api="send_text")
                 logger.info("[wechatmp] Do send text to {}: {}".format(receiver, text_content))
             elif reply.type == ReplyType.VOICE:
                 try:
@@ -271,13 +268,12 @@ class WechatMPChannel(ChatChannel):
                 except Exception:
                     pass
 
-                for media_id in media_ids:
-                    self.client.message.send_voice(receiver, media_id)
-                    time.sleep(1)
+                for i, media_id in enumerate(media_ids):
+                    self.send_in_order(receiver, self.client.message.send_voice, receiver, media_id, delay=1 if i else 0, api="send_voice")
                 logger.info("[wechatmp] Do send voice to {}".format(receiver))
             elif reply.type == ReplyType.IMAGE_URL:  # 从网络下载图片
                 img_url = reply.content
-                pic_res = requests.get(img_url, stream=True)
+                pic_res = http_client.get(img_url, stream=True)
                 image_storage = io.BytesIO()
                 for block in pic_res.iter_content(1024):
                     image_storage.write(block)
@@ -291,7 +287,7 @@ class WechatMPChannel(ChatChannel):
                 except WeChatClientException as e:
                     logger.error("[wechatmp] upload image failed: {}".format(e))
                     return
-                self.client.message.send_image(receiver, response["media_id"])
+                self.send_in_order(receiver, self.client.message.send_image, receiver, response["media_id"], api="send_image")
                 logger.info("[wechatmp] Do send image to {}".format(receiver))
             elif reply.type == ReplyType.IMAGE:  # 从文件读取图片
                 image_storage = reply.content
@@ -305,11 +301,11 @@ class WechatMPChannel(ChatChannel):
                 except WeChatClientException as e:
                     logger.error("[wechatmp] upload image failed: {}".format(e))
                     return
-                self.client.message.send_image(receiver, response["media_id"])
+                self.send_in_order(receiver, self.client.message.send_image, receiver, response["media_id"], api="send_image")
                 logger.info("[wechatmp] Do send image to {}".format(receiver))
             elif reply.type == ReplyType.VIDEO_URL:  # 从网络下载视频
                 video_url = reply.content
-                video_res = requests.get(video_url, stream=True)
+                video_res = http_client.get(video_url, stream=True)
                 video_storage = io.BytesIO()
                 for block in video_res.iter_content(1024):
                     video_storage.write(block)
@@ -323,7 +319,7 @@ class WechatMPChannel(ChatChannel):
                 except WeChatClientException as e:
                     logger.error("[wechatmp] upload video failed: {}".format(e))
                     return
-                self.client.message.send_video(receiver, response["media_id"])
+                self.send_in_order(receiver, self.client.message.send_video, receiver, response["media_id"], api="send_video")
                 logger.info("[wechatmp] Do send video to {}".format(receiver))
             elif reply.type == ReplyType.VIDEO:  # 从文件读取视频
                 video_storage = reply.content
@@ -337,17 +333,21 @@ class WechatMPChannel(ChatChannel):
                 except WeChatClientException as e:
                     logger.error("[wechatmp] upload video failed: {}".format(e))
                     return
-                self.client.message.send_video(receiver, response["media_id"])
+                self.send_in_order(receiver, self.client.message.send_video, receiver, response["media_id"], api="send_video")
                 logger.info("[wechatmp] Do send video to {}".format(receiver))
         return
 
+    # 被动回复模式下按顺序缓存回复，delay为距离上一条缓存的最短间隔(秒)
+    def _cache_reply(self, receiver, reply_type, content, delay=0):
+        self.send_in_order(receiver, lambda: self.cache_dict[receiver].append((reply_type, content)), delay=delay, retry=False)
+
     def _success_callback(self, session_id, context, **kwargs):  # 线程异常结束时的回调函数
         logger.debug("[wechatmp] Success to generate reply, msgId={}".format(context["msg"].msg_id))
         if self.passive_reply:
-            self.running.remove(session_id)
+            # 等待缓存的回复全部写入后再结束处理状态
+            self.send_in_order(session_id, self.running.remove, session_id, retry=False)
 
     def _fail_callback(self, session_id, exception, context, **kwargs):  # 线程异常结束时的回调函数
         logger.exception("[wechatmp] Fail to generate reply to user, msgId={}, exception={}".format(context["msg"].msg_id, exception))
         if self.passive_reply:
-            assert session_id not in self.cache_dict
-            self.running.remove(session_id)
+            self.send_in_order(session_id, self.running.remove, session_id, retry=False)
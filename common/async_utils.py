@@ -0,0 +1,10 @@
+import asyncio
+import functools
+
+
+async def run_in_thread(fn, *args, **kwargs):
+    """
+    在事件循环的默认线程池中执行同步函数，避免阻塞事件循环，用于在协程中调用同步的插件、bot和发送接口
+    """
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, functools.partial(fn, *args, **kwargs))
@@ -1,4 +1,4 @@
-import requests
+from common import http_client
 import os
 from config import conf
 
@@ -45,7 +45,7 @@ class CloudFlareR2:
         }
         file_name = file_path.rsplit(os.sep, 1)[-1]
         # 发送PUT请求上传文件
-        response = requests.put(
+        response = http_client.put(
             f"{url}/{file_name}",  # 文件在R2中的路径
             headers=headers,
             data=file_content
@@ -0,0 +1,47 @@
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from common.log import logger
+
+
+class DelayedExecutor:
+    """
+    延迟执行器，由一个定时线程维护到期时间小顶堆，任务到期后提交到线程池执行，等待期间不占用线程池的线程
+    """
+
+    def __init__(self, name, max_workers=2):
+        self.name = name
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self.tasks = []  # (到期时间, 序号, fn, args, kwargs)
+        self.seq = itertools.count()
+        self.cond = threading.Condition()
+        self.timer = None
+
+    def submit_after(self, delay, fn, *args, **kwargs):
+        """
+        delay秒后执行fn
+        """
+        with self.cond:
+            heapq.heappush(self.tasks, (time.monotonic() + delay, next(self.seq), fn, args, kwargs))
+            if self.timer is None:
+                self.timer = threading.Thread(target=self._run, name=self.name + "_timer", daemon=True)
+                self.timer.start()
+            self.cond.notify()
+
+    def pending(self):
+        with self.cond:
+            return len(self.tasks)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.tasks or self.tasks[0][0] > time.monotonic():
+                    self.cond.wait(self.tasks[0][0] - time.monotonic() if self.tasks else None)
+                _, _, fn, args, kwargs = heapq.heappop(self.tasks)
+            try:
+                self.pool.submit(fn, *args, **kwargs)
+            except Exception as e:
+                logger.exception("[{}] submit delayed task error: {}".format(self.name, e))
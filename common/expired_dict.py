@@ -1,42 +1,92 @@
-from datetime import datetime, timedelta
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import MutableMapping
 
 
-class ExpiredDict(dict):
-    def __init__(self, expires_in_seconds):
-        super().__init__()
+class ExpiredDict(MutableMapping):
+    """
+    带过期时间的字典，读写和判断是否存在均为O(1)，过期条目在写入时从最早过期的一端批量清理
+    :param expires_in_seconds: 过期时间(秒)
+    :param max_size: 最多保存的条目数，超出时淘汰最早过期的条目，0表示不限制
+    :param refresh_on_read: 读取时是否刷新过期时间，为True时按最近访问计算过期，max_size即LRU淘汰；为False时从写入起固定时间过期
+    """
+
+    def __init__(self, expires_in_seconds, max_size=0, refresh_on_read=True):
         self.expires_in_seconds = expires_in_seconds
+        self.max_size = max_size
+        self.refresh_on_read = refresh_on_read
+        self._data = OrderedDict()  # key -> (value, 到期时间)，过期时间相同，因此按写入或访问顺序排列即按到期时间排列
+        self._lock = threading.RLock()
 
     def __getitem__(self, key):
-        value, expiry_time = super().__getitem__(key)
-        if datetime.now() > expiry_time:
-            del self[key]
-            raise KeyError("expired {}".format(key))
-        self.__setitem__(key, value)
-        return value
+        with self._lock:
+            value, expiry_time = self._data[key]
+            now = time.monotonic()
+            if now > expiry_time:
+                del self._data[key]
+                raise KeyError("expired {}".format(key))
+            if self.refresh_on_read:
+                self._data[key] = (value, now + self.expires_in_seconds)
+                self._data.move_to_end(key)
+            return value
 
     def __setitem__(self, key, value):
-        expiry_time = datetime.now() + timedelta(seconds=self.expires_in_seconds)
-        super().__setitem__(key, (value, expiry_time))
+        with self._lock:
+            now = time.monotonic()
+            self._data[key] = (value, now + self.expires_in_seconds)
+            self._data.move_to_end(key)
+            self._evict(now)
 
-    def get(self, key, default=None):
-        try:
-            return self[key]
-        except KeyError:
-            return default
+    def __delitem__(self, key):
+        with self._lock:
+            del self._data[key]
 
     def __contains__(self, key):
-        try:
-            self[key]
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return False
+            if time.monotonic() > item[1]:
+                del self._data[key]
+                return False
             return True
-        except KeyError:
-            return False
 
+    def __len__(self):
+        with self._lock:
+            self._evict(time.monotonic())
+            return len(self._data)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __repr__(self):
+        return "ExpiredDict({})".format(dict(self.items()))
+
+    # 以下方法返回当前未过期条目的快照，不刷新过期时间
     def keys(self):
-        keys = list(super().keys())
-        return [key for key in keys if key in self]
+        with self._lock:
+            self._evict(time.monotonic())
+            return list(self._data.keys())
 
     def items(self):
-        return [(key, self[key]) for key in self.keys()]
+        with self._lock:
+            self._evict(time.monotonic())
+            return [(key, value) for key, (value, _) in self._data.items()]
 
-    def __iter__(self):
-        return self.keys().__iter__()
+    def values(self):
+        with self._lock:
+            self._evict(time.monotonic())
+            return [value for value, _ in self._data.values()]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    # 从最早过期的一端删除已过期及超出max_size的条目，调用方需持有self._lock
+    def _evict(self, now):
+        while self._data:
+            key, (_, expiry_time) = next(iter(self._data.items()))
+            if expiry_time > now and not (self.max_size and len(self._data) > self.max_size):
+                break
+            del self._data[key]
@@ -0,0 +1,210 @@
+"""
+共享的HTTP客户端
+
+所有bot、语音、通道和插件的HTTP请求都通过这里发送，每个host使用一个带连接池的requests.Session，
+同一个服务的后续请求复用keep-alive连接，不需要重新进行TCP和TLS握手。未指定timeout的请求使用默认的连接和读取超时。
+接口与requests相同，如 http_client.post(url, json=body, headers=headers)。
+
+http_backend设置为httpx时使用HTTP/2发送请求(需要安装httpx[http2])，也可以用register_backend注册其他实现。
+
+协程中使用apost、aget等异步接口，每个事件循环共用一个aiohttp连接池，响应内容读取完成后返回AsyncResponse。
+"""
+
+import asyncio
+import json
+import os
+import threading
+import weakref
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from common.log import logger
+from config import conf
+
+_lock = threading.Lock()
+_sessions = {}  # (后端, scheme://host) -> 会话
+_pid = os.getpid()
+_backends = {}  # 后端名称 -> 创建会话的函数
+_async_sessions = weakref.WeakKeyDictionary()  # 事件循环 -> aiohttp.ClientSession
+
+
+def register_backend(name, factory):
+    """
+    注册HTTP后端
+    :param factory: 创建会话的函数，参数为连接池大小，返回的对象需要提供与requests.Session.request相同的request方法
+    """
+    _backends[name] = factory
+
+
+def _requests_session(pool_size):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class HttpxSession:
+    """
+    使用httpx发送HTTP/2请求，返回requests.Response，异常也转换为requests的异常，调用方不需要区分后端
+    流式下载以及指定了代理、证书的请求仍然使用requests发送
+    """
+
+    FALLBACK_KWARGS = ("stream", "proxies", "verify", "cert", "hooks")
+
+    def __init__(self, pool_size):
+        import httpx
+
+        self.httpx = httpx
+        self.client = httpx.Client(http2=True, limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size))
+        self.fallback = _requests_session(pool_size)
+
+    def request(self, method, url, timeout=None, allow_redirects=True, **kwargs):
+        if any(kwargs.get(key) for key in self.FALLBACK_KWARGS):
+            return self.fallback.request(method, url, timeout=timeout, allow_redirects=allow_redirects, **kwargs)
+        for key in self.FALLBACK_KWARGS:
+            kwargs.pop(key, None)
+        if isinstance(timeout, tuple):
+            timeout = self.httpx.Timeout(timeout[1], connect=timeout[0])
+        try:
+            res = self.client.request(method, url, timeout=timeout, follow_redirects=allow_redirects, **kwargs)
+        except self.httpx.TimeoutException as e:
+            raise requests.Timeout(str(e))
+        except self.httpx.TransportError as e:
+            raise requests.ConnectionError(str(e))
+        response = requests.Response()
+        response.status_code = res.status_code
+        response.reason = res.reason_phrase
+        response.headers = requests.structures.CaseInsensitiveDict(res.headers)
+        response.url = str(res.url)
+        response.encoding = res.encoding
+        response._content = res.content
+        response._content_consumed = True
+        return response
+
+
+register_backend("requests", _requests_session)
+register_backend("httpx", HttpxSession)
+
+
+def get_session(url):
+    """
+    返回url所在host的会话，同一host的请求共用连接池
+    """
+    global _pid
+    parts = urlsplit(url)
+    backend = conf().get("http_backend") or "requests"
+    key = (backend, parts.scheme + "://" + parts.netloc)
+    session = _sessions.get(key)
+    if session is not None and _pid == os.getpid():
+        return session
+    with _lock:
+        if _pid != os.getpid():
+            # fork出的子进程不能使用父进程的连接
+            _sessions.clear()
+            _pid = os.getpid()
+        session = _sessions.get(key)
+        if session is None:
+            pool_size = conf().get("http_pool_size", 10)
+            try:
+                session = _backends[backend](pool_size)
+            except Exception as e:
+                logger.warning("[http_client] init http backend {} failed, use requests: {}".format(backend, e))
+                session = _requests_session(pool_size)
+            _sessions[key] = session
+        return session
+
+
+def default_timeout():
+    return conf().get("http_connect_timeout", 10), conf().get("http_read_timeout", 180)
+
+
+def request(method, url, **kwargs):
+    if kwargs.get("timeout") is None:
+        kwargs["timeout"] = default_timeout()
+    return get_session(url).request(method, url, **kwargs)
+
+
+def get(url, params=None, **kwargs):
+    return request("GET", url, params=params, **kwargs)
+
+
+def post(url, data=None, json=None, **kwargs):
+    return request("POST", url, data=data, json=json, **kwargs)
+
+
+def put(url, data=None, **kwargs):
+    return request("PUT", url, data=data, **kwargs)
+
+
+def delete(url, **kwargs):
+    return request("DELETE", url, **kwargs)
+
+
+class AsyncResponse:
+    """
+    异步请求的响应，属性与requests.Response的常用属性相同
+    """
+
+    def __init__(self, status_code, headers, content, url):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.url = url
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", errors="replace")
+
+    def json(self):
+        return json.loads(self.content)
+
+
+def get_async_session():
+    """
+    返回当前事件循环的aiohttp会话，需要在协程中调用
+    """
+    import aiohttp
+
+    loop = asyncio.get_running_loop()
+    session = _async_sessions.get(loop)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(limit=conf().get("http_async_pool_size", 100))
+        session = aiohttp.ClientSession(connector=connector)
+        _async_sessions[loop] = session
+    return session
+
+
+def _async_timeout(timeout):
+    import aiohttp
+
+    if timeout is None:
+        timeout = default_timeout()
+    if isinstance(timeout, tuple):
+        return aiohttp.ClientTimeout(sock_connect=timeout[0], sock_read=timeout[1])
+    return aiohttp.ClientTimeout(total=timeout)
+
+
+async def arequest(method, url, timeout=None, proxies=None, **kwargs):
+    """
+    异步发送请求，参数与request相同，proxies只使用与url协议对应的代理
+    """
+    if proxies:
+        kwargs["proxy"] = proxies.get(urlsplit(url).scheme)
+    async with get_async_session().request(method, url, timeout=_async_timeout(timeout), **kwargs) as res:
+        content = await res.read()
+        return AsyncResponse(res.status, res.headers, content, str(res.url))
+
+
+async def aget(url, params=None, **kwargs):
+    return await arequest("GET", url, params=params, **kwargs)
+
+
+async def apost(url, data=None, json=None, **kwargs):
+    return await arequest("POST", url, data=data, json=json, **kwargs)
@@ -1,30 +1,98 @@
+import atexit
 import logging
+import multiprocessing
+import queue
 import sys
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
 
+LOG_FORMAT = "[%(levelname)s][%(asctime)s][%(filename)s:%(lineno)d] - %(message)s"
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
 
-def _reset_logger(log):
+# 后台写日志的监听线程，业务线程只把日志记录放入队列
+_listener = None
+
+
+class ModuleLevelFilter(logging.Filter):
+    """
+    按模块过滤日志，模块名为打印日志的文件名(不含扩展名)，如chat_channel，未配置的模块使用默认级别
+    """
+
+    def __init__(self, module_levels: dict, default_level):
+        super().__init__()
+        self.module_levels = module_levels
+        self.default_level = default_level
+
+    def filter(self, record):
+        return record.levelno >= self.module_levels.get(record.module, self.default_level)
+
+
+def _to_level(level):
+    if isinstance(level, int):
+        return level
+    return logging.getLevelName(str(level).upper())
+
+
+def _build_handlers(log_file, max_bytes, backup_count, rotate_when):
+    formatter = logging.Formatter(LOG_FORMAT, datefmt=DATE_FORMAT)
+    handlers = [logging.StreamHandler(sys.stdout)]
+    # 分片工作进程只输出到控制台，避免多个进程同时写入和轮转同一个日志文件
+    if log_file and multiprocessing.current_process().name == "MainProcess":
+        if rotate_when:
+            handlers.append(TimedRotatingFileHandler(log_file, when=rotate_when, backupCount=backup_count, encoding="utf-8"))
+        elif max_bytes:
+            handlers.append(RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8"))
+        else:
+            handlers.append(logging.FileHandler(log_file, encoding="utf-8"))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    return handlers
+
+
+def _stop_listener():
+    global _listener
+    if _listener is not None:
+        _listener.stop()  # 写完队列中剩余的日志后返回
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+def _reset_logger(log, log_file="run.log", max_bytes=10 * 1024 * 1024, backup_count=5, rotate_when=""):
+    global _listener
     for handler in log.handlers:
         handler.close()
         log.removeHandler(handler)
         del handler
     log.handlers.clear()
     log.propagate = False
-    console_handle = logging.StreamHandler(sys.stdout)
-    console_handle.setFormatter(
-        logging.Formatter(
-            "[%(levelname)s][%(asctime)s][%(filename)s:%(lineno)d] - %(message)s",
-            datefmt="%Y-%m-%d %H:%M:%S",
-        )
-    )
-    file_handle = logging.FileHandler("run.log", encoding="utf-8")
-    file_handle.setFormatter(
-        logging.Formatter(
-            "[%(levelname)s][%(asctime)s][%(filename)s:%(lineno)d] - %(message)s",
-            datefmt="%Y-%m-%d %H:%M:%S",
-        )
-    )
-    log.addHandler(file_handle)
-    log.addHandler(console_handle)
+    _stop_listener()
+    log_queue = queue.SimpleQueue()
+    _listener = QueueListener(log_queue, *_build_handlers(log_file, max_bytes, backup_count, rotate_when))
+    _listener.start()
+    log.addHandler(QueueHandler(log_queue))
+
+
+def configure_logger(level=logging.INFO, module_levels=None, log_file="run.log", max_bytes=10 * 1024 * 1024, backup_count=5, rotate_when=""):
+    """
+    加载配置后调用，重新设置日志级别和输出文件
+    :param level: 默认日志级别
+    :param module_levels: 按模块设置的日志级别，如 {"chat_channel": "DEBUG"}
+    :param log_file: 日志文件，为空时只输出到控制台
+    :param max_bytes: 日志文件按大小轮转的阈值，0表示不按大小轮转
+    :param backup_count: 保留的历史日志文件数
+    :param rotate_when: 按时间轮转的周期，取值同TimedRotatingFileHandler的when参数，如midnight，设置后不再按大小轮转
+    """
+    _reset_logger(logger, log_file, max_bytes, backup_count, rotate_when)
+    level = _to_level(level)
+    for log_filter in list(logger.filters):
+        if isinstance(log_filter, ModuleLevelFilter):
+            logger.removeFilter(log_filter)
+    if module_levels:
+        module_levels = {module: _to_level(module_level) for module, module_level in module_levels.items()}
+        # logger按最低级别放行，再由过滤器按模块判断
+        logger.addFilter(ModuleLevelFilter(module_levels, level))
+        level = min(level, *module_levels.values())
+    logger.setLevel(level)
 
 
 def _get_logger():
@@ -36,3 +104,4 @@ def _get_logger():
 
 # 日志句柄
 logger = _get_logger()
+atexit.register(_stop_listener)
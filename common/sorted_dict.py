@@ -1,7 +1,12 @@
-import heapq
+from bisect import bisect_left, insort
 
 
 class SortedDict(dict):
+    """
+    按sort_func排序的字典，遍历顺序为排序顺序
+    每个key的排序值记录在索引中，增删改通过二分查找定位，只有排序实际发生变化时才使缓存的key顺序失效
+    """
+
     def __init__(self, sort_func=lambda k, v: k, init_dict=None, reverse=False):
         if init_dict is None:
             init_dict = []
@@ -10,56 +15,68 @@ class SortedDict(dict):
         self.sort_func = sort_func
         self.sorted_keys = None
         self.reverse = reverse
-        self.heap = []
+        self.index = {}  # key -> (排序值, key)
+        self.order = []  # 按(排序值, key)升序排列
         for k, v in init_dict:
             self[k] = v
 
     def __setitem__(self, key, value):
-        if key in self:
-            super().__setitem__(key, value)
-            for i, (priority, k) in enumerate(self.heap):
-                if k == key:
-                    self.heap[i] = (self.sort_func(key, value), key)
-                    heapq.heapify(self.heap)
-                    break
-            self.sorted_keys = None
-        else:
-            super().__setitem__(key, value)
-            heapq.heappush(self.heap, (self.sort_func(key, value), key))
-            self.sorted_keys = None
+        super().__setitem__(key, value)
+        self._reorder(key, (self.sort_func(key, value), key))
 
     def __delitem__(self, key):
         super().__delitem__(key)
-        for i, (priority, k) in enumerate(self.heap):
-            if k == key:
-                del self.heap[i]
-                heapq.heapify(self.heap)
-                break
+        self._remove(self.index.pop(key))
+
+    def pop(self, key, *default):
+        if key not in self:
+            return super().pop(key, *default)
+        value = super().pop(key)
+        self._remove(self.index.pop(key))
+        return value
+
+    def clear(self):
+        super().clear()
+        self.index.clear()
+        self.order.clear()
         self.sorted_keys = None
 
     def keys(self):
         if self.sorted_keys is None:
-            self.sorted_keys = [k for _, k in sorted(self.heap, reverse=self.reverse)]
+            keys = [k for _, k in self.order]
+            if self.reverse:
+                keys.reverse()
+            self.sorted_keys = keys
         return self.sorted_keys
 
     def items(self):
-        if self.sorted_keys is None:
-            self.sorted_keys = [k for _, k in sorted(self.heap, reverse=self.reverse)]
-        sorted_items = [(k, self[k]) for k in self.sorted_keys]
-        return sorted_items
+        return [(k, self[k]) for k in self.keys()]
+
+    def values(self):
+        return [self[k] for k in self.keys()]
 
-    def _update_heap(self, key):
-        for i, (priority, k) in enumerate(self.heap):
-            if k == key:
-                new_priority = self.sort_func(key, self[key])
-                if new_priority != priority:
-                    self.heap[i] = (new_priority, key)
-                    heapq.heapify(self.heap)
-                    self.sorted_keys = None
-                break
+    def update_order(self, key):
+        """
+        value的内容被原地修改后调用，重新计算key的排序位置
+        """
+        self._reorder(key, (self.sort_func(key, self[key]), key))
 
     def __iter__(self):
         return iter(self.keys())
 
     def __repr__(self):
         return f"{type(self).__name__}({dict(self)}, sort_func={self.sort_func.__name__}, reverse={self.reverse})"
+
+    def _reorder(self, key, entry):
+        old_entry = self.index.get(key)
+        if old_entry == entry:
+            return
+        if old_entry is not None:
+            self._remove(old_entry)
+        self.index[key] = entry
+        insort(self.order, entry)
+        self.sorted_keys = None
+
+    def _remove(self, entry):
+        del self.order[bisect_left(self.order, entry)]
+        self.sorted_keys = None
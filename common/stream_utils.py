@@ -0,0 +1,132 @@
+"""
+流式回复的工具函数
+
+bot返回ReplyType.STREAM类型的回复时，content为逐段生成文本的迭代器，通道可以原地更新消息，
+不能更新消息的通道把文本切分成完整的段落或句子，作为多条消息依次发送。
+"""
+
+import re
+import time
+
+# 句子结束的位置，英文句号后需要有空白，避免在小数点处切分
+SENTENCE_END = re.compile(r"[。！？!?；;\n]|\.(?=\s)")
+
+
+class StreamContent:
+    """
+    流式回复的内容，按迭代器使用。迭代结束或调用close时执行on_close，且只执行一次
+    close时会读完剩余的文本，回复被插件替换或发送失败时，bot仍能在on_close中把完整的回复记入会话
+    """
+
+    def __init__(self, chunks, on_close=None):
+        self.chunks = iter(chunks)
+        self.on_close = on_close
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.closed:
+            raise StopIteration
+        try:
+            return next(self.chunks)
+        except StopIteration:
+            self.close()
+            raise
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for _ in self.chunks:
+            pass
+        if self.on_close:
+            self.on_close()
+
+
+def close_stream(content):
+    """
+    发送结束后关闭流式回复的内容，content不是StreamContent时不做处理
+    """
+    if isinstance(content, StreamContent):
+        content.close()
+
+
+def map_sentences(chunks, fn):
+    """
+    按完整的句子处理流式文本，返回fn(句子)，保留原有的空白和换行；fn返回None时停止输出
+    """
+    buffer = ""
+    for chunk in chunks:
+        buffer += chunk
+        cut = -1
+        for match in SENTENCE_END.finditer(buffer):
+            cut = match.end()
+        if cut < 0:
+            continue
+        text, buffer = fn(buffer[:cut]), buffer[cut:]
+        if text is None:
+            return
+        yield text
+    if buffer:
+        text = fn(buffer)
+        if text is not None:
+            yield text
+
+
+def wrap(chunks, prefix="", suffix=""):
+    """
+    在流式文本前后加上前缀和后缀，去掉开头的空白
+    """
+    started = False
+    for chunk in chunks:
+        if not started:
+            chunk = chunk.lstrip()
+            if not chunk:
+                continue
+            started = True
+            chunk = prefix + chunk
+        yield chunk
+    if started and suffix:
+        yield suffix
+
+
+def split_sentences(chunks, flush_chars=200):
+    """
+    把流式文本切分成多条消息，累计超过flush_chars个字符后优先在段落处切分，没有段落时在句末切分，最后返回剩余的文本
+    """
+    buffer = ""
+    for chunk in chunks:
+        buffer += chunk
+        if len(buffer) < flush_chars:
+            continue
+        cut = buffer.rfind("\n\n")
+        if cut <= 0:
+            cut = -1
+            for match in SENTENCE_END.finditer(buffer):
+                cut = match.end()
+            if cut < 0:
+                continue  # 还没有完整的句子
+        text, buffer = buffer[:cut].strip(), buffer[cut:]
+        if text:
+            yield text
+    buffer = buffer.strip()
+    if buffer:
+        yield buffer
+
+
+def accumulate(chunks, interval=1.0):
+    """
+    合并流式文本，收到第一段文本时立即返回，之后最多每隔interval秒返回一次当前的完整文本，用于原地更新消息
+    :return: 迭代器 (当前完整文本, 是否已生成完毕)
+    """
+    text = ""
+    last_time = 0
+    for chunk in chunks:
+        text += chunk
+        now = time.monotonic()
+        if now - last_time >= interval:
+            last_time = now
+            yield text, False
+    yield text, True
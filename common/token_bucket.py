@@ -1,39 +1,111 @@
+import asyncio
 import threading
 import time
+from collections import OrderedDict
 
 
 class TokenBucket:
-    def __init__(self, tpm, timeout=None):
+    """
+    令牌桶，根据距上次计算的时间按需补充令牌，不需要后台线程
+    获取令牌时先预约，令牌不足时等待到预约的时间点，等待期间不持有锁
+    """
+
+    def __init__(self, tpm, timeout=None, full=False):
         self.capacity = int(tpm)  # 令牌桶容量
-        self.tokens = 0  # 初始令牌数为0
         self.rate = int(tpm) / 60  # 令牌每秒生成速率
         self.timeout = timeout  # 等待令牌超时时间
-        self.cond = threading.Condition()  # 条件变量
-        self.is_running = True
-        # 开启令牌生成线程
-        threading.Thread(target=self._generate_tokens).start()
-
-    def _generate_tokens(self):
-        """生成令牌"""
-        while self.is_running:
-            with self.cond:
-                if self.tokens < self.capacity:
-                    self.tokens += 1
-                self.cond.notify()  # 通知获取令牌的线程
-            time.sleep(1 / self.rate)
+        self.tokens = self.capacity if full else 0  # 初始令牌数，预约后可能为负数
+        self.last_time = time.monotonic()
+        self.lock = threading.Lock()
 
-    def get_token(self):
-        """获取令牌"""
-        with self.cond:
-            while self.tokens <= 0:
-                flag = self.cond.wait(self.timeout)
-                if not flag:  # 超时
-                    return False
+    def _reserve(self, max_wait):
+        """
+        预约一个令牌
+        :param max_wait: 最多等待的秒数，None表示不限制
+        :return: 需要等待的秒数，超过max_wait时不预约并返回None
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_time) * self.rate)
+            self.last_time = now
+            wait = (1 - self.tokens) / self.rate if self.tokens < 1 else 0
+            if max_wait is not None and wait > max_wait:
+                return None
             self.tokens -= 1
+            return wait
+
+    def get_token(self):
+        """获取令牌，超时返回False"""
+        wait = self._reserve(self.timeout)
+        if wait is None:
+            return False
+        if wait > 0:
+            time.sleep(wait)
         return True
 
+    async def aget_token(self):
+        """获取令牌的协程版本"""
+        wait = self._reserve(self.timeout)
+        if wait is None:
+            return False
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return True
+
+    def try_acquire(self):
+        """不等待，有可用令牌时获取并返回True"""
+        return self._reserve(0) is not None
+
+    def is_full(self):
+        """令牌是否已补满，预约使令牌为负数时需要更长时间才能补满"""
+        with self.lock:
+            return self.tokens + (time.monotonic() - self.last_time) * self.rate >= self.capacity
+
     def close(self):
-        self.is_running = False
+        pass
+
+
+class KeyedTokenBucket:
+    """
+    按key独立限速的令牌桶，如按用户、群、API Key或模型限速
+    新的key使用装满的令牌桶，已补满的令牌桶会被回收，回收后重建结果相同
+    """
+
+    def __init__(self, tpm, timeout=None, max_keys=10000):
+        self.tpm = tpm
+        self.timeout = timeout
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()  # key -> 令牌桶，按最近使用排序
+        self.lock = threading.Lock()
+
+    def bucket(self, key) -> TokenBucket:
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                self._purge()
+                bucket = TokenBucket(self.tpm, self.timeout, full=True)
+                self.buckets[key] = bucket
+            else:
+                self.buckets.move_to_end(key)
+            return bucket
+
+    # 从最久未使用的一端回收已补满的令牌桶，令牌未补满(如被预约成负数)的令牌桶保留到补满为止，
+    # 避免刚被限速的key重建后立即获得整桶令牌；只有key数超过max_keys时才回收未补满的令牌桶，调用方需持有self.lock
+    def _purge(self):
+        while self.buckets:
+            key, bucket = next(iter(self.buckets.items()))
+            if len(self.buckets) < self.max_keys and not bucket.is_full():
+                break
+            del self.buckets[key]
+
+    def get_token(self, key):
+        return self.bucket(key).get_token()
+
+    async def aget_token(self, key):
+        return await self.bucket(key).aget_token()
+
+    def try_acquire(self, key):
+        return self.bucket(key).try_acquire()
 
 
 if __name__ == "__main__":
@@ -43,3 +115,15 @@ if __name__ == "__main__":
         if token_bucket.get_token():
             print(f"第{i+1}次请求成功")
     token_bucket.close()
+
+    # 预约使令牌为负数后，闲置60秒令牌桶仍未补满，不能被回收重建而获得额外的整桶令牌
+    clock = [time.monotonic()]
+    time.monotonic = lambda: clock[0]
+    keyed = KeyedTokenBucket(60)
+    for _ in range(120):  # 容量60，另外60个为预约的令牌，令牌数为-60
+        keyed.bucket("user")._reserve(None)
+    clock[0] += 90  # 补充90个令牌，令牌数为30
+    keyed.bucket("other")  # 创建新的key时回收已补满的令牌桶
+    acquired = sum(keyed.try_acquire("user") for _ in range(100))
+    assert acquired == 30, "throttled key got {} tokens, expected 30".format(acquired)
+    print("KeyedTokenBucket ok")
@@ -0,0 +1,109 @@
+"""
+tiktoken编码器注册表
+
+模型到编码的映射和编码器在进程内只加载一次，BPE文件从本地缓存目录读取，可以在启动时后台预加载，避免第一条消息等待下载。
+无法联网时，把其他机器tiktoken_cache_dir目录中的文件复制到本机同一目录即可离线使用。
+非OpenAI模型可以注册自己的token计数函数，不再使用tiktoken。
+"""
+
+import os
+import threading
+
+from common import const
+from common.log import logger
+from config import conf, get_appdata_dir
+
+DEFAULT_ENCODING = "cl100k_base"
+
+_lock = threading.Lock()
+_cache_dir_ready = False
+_encodings = {}  # 编码名 -> Encoding
+_model_encodings = {}  # 模型名 -> 编码名
+_token_counters = []  # (模型名列表, 模型名前缀列表, 计数函数)
+
+
+def count_by_character(text) -> int:
+    return len(text)
+
+
+def register_token_counter(counter, models=(), prefixes=()):
+    """
+    为非OpenAI模型注册token计数函数，后注册的优先
+    :param counter: 计数函数，参数为消息内容，返回token数
+    :param models: 使用该函数的模型名
+    :param prefixes: 使用该函数的模型名前缀
+    """
+    _token_counters.insert(0, (tuple(models), tuple(prefixes), counter))
+
+
+def get_token_counter(model):
+    """
+    返回模型注册的token计数函数，没有注册时返回None，表示使用tiktoken计算
+    """
+    for models, prefixes, counter in _token_counters:
+        if model in models or model.startswith(prefixes):
+            return counter
+    return None
+
+
+def _init_cache_dir():
+    global _cache_dir_ready
+    if _cache_dir_ready:
+        return
+    cache_dir = conf().get("tiktoken_cache_dir") or os.environ.get("TIKTOKEN_CACHE_DIR") or os.path.join(get_appdata_dir(), "tiktoken_cache")
+    os.makedirs(cache_dir, exist_ok=True)
+    # tiktoken优先从该目录读取BPE文件，不存在时才下载并保存到该目录
+    os.environ["TIKTOKEN_CACHE_DIR"] = cache_dir
+    _cache_dir_ready = True
+
+
+def get_encoding(name=DEFAULT_ENCODING):
+    encoding = _encodings.get(name)
+    if encoding is None:
+        import tiktoken
+
+        with _lock:
+            encoding = _encodings.get(name)
+            if encoding is None:
+                _init_cache_dir()
+                encoding = tiktoken.get_encoding(name)
+                _encodings[name] = encoding
+    return encoding
+
+
+def encoding_for_model(model):
+    name = _model_encodings.get(model)
+    if name is None:
+        import tiktoken
+
+        with _lock:
+            _init_cache_dir()
+        try:
+            name = tiktoken.encoding_for_model(model).name
+        except KeyError:
+            logger.debug("[tokenizer] model %s not found, using %s encoding", model, DEFAULT_ENCODING)
+            name = DEFAULT_ENCODING
+        _model_encodings[model] = name
+    return get_encoding(name)
+
+
+def preload(names=(DEFAULT_ENCODING,)):
+    """
+    在后台线程中加载编码器，tiktoken未安装或下载失败时只打印日志
+    """
+
+    def load():
+        for name in names:
+            try:
+                get_encoding(name)
+                logger.info("[tokenizer] encoding {} loaded".format(name))
+            except ImportError:
+                logger.debug("[tokenizer] tiktoken not installed, skip preload")
+                return
+            except Exception as e:
+                logger.warning("[tokenizer] load encoding {} failed: {}".format(name, e))
+
+    threading.Thread(target=load, name="tokenizer_preload", daemon=True).start()
+
+
+register_token_counter(count_by_character, models=["wenxin", "xunfei"], prefixes=[const.GEMINI])
@@ -0,0 +1,132 @@
+import functools
+import re
+from collections import deque
+
+
+class PrefixMatcher:
+    """
+    前缀匹配，按前缀建立字典树，匹配耗时只与最长前缀的长度有关
+    多个前缀同时匹配时返回列表中最靠前的一个，与依次startswith的结果相同
+    """
+
+    def __init__(self, prefix_list):
+        self.prefix_list = list(prefix_list or [])
+        self.root = {}  # 字符 -> 子节点，节点中的None键保存该前缀在列表中的序号
+        for index, prefix in enumerate(self.prefix_list):
+            node = self.root
+            for char in prefix:
+                node = node.setdefault(char, {})
+            node.setdefault(None, index)
+
+    def match(self, content):
+        """
+        :return: 匹配到的前缀，未匹配时返回None
+        """
+        node = self.root
+        best = node.get(None)
+        for char in content:
+            node = node.get(char)
+            if node is None:
+                break
+            index = node.get(None)
+            if index is not None and (best is None or index < best):
+                best = index
+        return None if best is None else self.prefix_list[best]
+
+
+class KeywordMatcher:
+    """
+    关键词包含匹配，关键词较多时使用Aho-Corasick自动机，只需扫描一遍内容，耗时与关键词数量无关
+    """
+
+    # 关键词不超过该数量时直接逐个查找，比逐字符遍历自动机更快
+    SCAN_THRESHOLD = 16
+
+    def __init__(self, keyword_list):
+        keywords = list(dict.fromkeys(keyword_list or []))
+        self.keywords = keywords
+        self.match_all = "" in keywords  # 空字符串包含于任意内容
+        self.goto = None
+        if len(keywords) > self.SCAN_THRESHOLD and not self.match_all:
+            self._build(keywords)
+
+    def _build(self, keywords):
+        # 节点用序号表示，goto[i]为字符到子节点的映射，fail[i]为失配指针，output[i]表示到达该节点时已匹配到关键词
+        goto, fail, output = [{}], [0], [False]
+        for keyword in keywords:
+            node = 0
+            for char in keyword:
+                child = goto[node].get(char)
+                if child is None:
+                    child = len(goto)
+                    goto[node][char] = child
+                    goto.append({})
+                    fail.append(0)
+                    output.append(False)
+                node = child
+            output[node] = True
+        queue = deque(goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in goto[node].items():
+                queue.append(child)
+                state = fail[node]
+                while state and char not in goto[state]:
+                    state = fail[state]
+                fail[child] = goto[state].get(char, 0)
+                output[child] = output[child] or output[fail[child]]
+        self.goto, self.fail, self.output = goto, fail, output
+
+    def search(self, content):
+        """
+        :return: 包含任一关键词时返回True，否则返回None
+        """
+        if self.match_all:
+            return True
+        if self.goto is None:
+            for keyword in self.keywords:
+                if keyword in content:
+                    return True
+            return None
+        goto, fail, output = self.goto, self.fail, self.output
+        state = 0
+        for char in content:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                return True
+        return None
+
+
+class TriggerMatcher:
+    """
+    消息触发条件的匹配器，根据一个版本的配置预先编译，配置变化后重新生成
+    """
+
+    def __init__(self, config):
+        self.single_chat_prefix = PrefixMatcher(config.get("single_chat_prefix", [""]))
+        self.group_chat_prefix = PrefixMatcher(config.get("group_chat_prefix"))
+        self.image_create_prefix = PrefixMatcher(config.get("image_create_prefix", [""]))
+        self.group_chat_keyword = KeywordMatcher(config.get("group_chat_keyword"))
+        self.group_name_keyword_white_list = KeywordMatcher(config.get("group_name_keyword_white_list", []))
+        group_name_white_list = set(config.get("group_name_white_list") or [])
+        self.all_group = "ALL_GROUP" in group_name_white_list
+        self.group_name_white_list = frozenset(group_name_white_list)
+        group_chat_in_one_session = set(config.get("group_chat_in_one_session") or [])
+        self.all_group_in_one_session = "ALL_GROUP" in group_chat_in_one_session
+        self.group_chat_in_one_session = frozenset(group_chat_in_one_session)
+
+    def group_in_white_list(self, group_name):
+        return self.all_group or group_name in self.group_name_white_list or bool(self.group_name_keyword_white_list.search(group_name))
+
+    def group_in_one_session(self, group_name):
+        return self.all_group_in_one_session or group_name in self.group_chat_in_one_session
+
+
+@functools.lru_cache(maxsize=1024)
+def mention_pattern(name):
+    """
+    匹配 @名称 加空格的正则，按名称缓存编译结果
+    """
+    return re.compile(f"@{re.escape(name)}(\u2005|\u0020)")
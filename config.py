@@ -5,8 +5,11 @@ import logging
 import os
 import pickle
 import copy
+import itertools
+import threading
 
-from common.log import logger
+from common.log import configure_logger, logger
+from common.trigger_matcher import TriggerMatcher
 
 # 将所有可用的配置项写在字典里, 请使用小写字母
 # 此处的配置值无实际意义，程序不会读取此处的配置，仅用于提示格式，请将配置加入到config.json中
@@ -62,16 +65,51 @@ available_setting = {
     "image_proxy": True,  # 是否需要图片代理，国内访问LinkAI时需要
     "image_create_prefix": ["画", "看", "找"],  # 开启图片回复的前缀
     "concurrency_in_session": 1,  # 同一会话最多有多少条消息在处理中，大于1可能乱序
+    "session_queue_max_size": 0,  # 单个会话最多排队的消息数，0表示不限制，#开头的管理命令不受限制
+    "global_queue_max_size": 0,  # 所有会话最多排队的消息数，0表示不限制
+    "queue_overflow_policy": "drop_oldest",  # 队列已满时的处理策略，drop_oldest: 丢弃最早的消息, drop_newest: 丢弃新消息, reply_busy: 丢弃新消息并回复queue_busy_reply
+    "queue_busy_reply": "当前消息较多，请稍后再试",  # 队列已满时的繁忙提示
+    "session_weights": {"private": 2, "group": 1, "vip": 4},  # 会话调度权重，权重越大在消息拥挤时获得的处理名额越多
+    "vip_session_list": [],  # 使用vip权重的会话，可填写会话id、群名称或用户昵称
+    "group_max_inflight": 0,  # 单个群同时处理中的消息数上限，防止单个群占满线程，0表示不限制
+    "message_coalesce_ms": 0,  # 连续消息合并窗口(毫秒)，同一用户在窗口内连续发送的文本消息合并为一次提问，0表示不合并
+    "send_retry_max": 2,  # 消息发送失败后的最大重试次数
+    "send_retry_base_delay": 3,  # 发送重试的基础间隔(秒)，每次重试间隔翻倍并加入随机抖动
+    "send_retry_budget": 10,  # 每个接收者每分钟最多重试发送的次数
+    "outbound_workers": 2,  # 按接收者顺序发送消息的线程数
+    "outbound_min_interval": 0,  # 同一接收者两次发送之间的最短间隔(秒)
+    "outbound_rate_limits": {},  # 发送接口限速，每秒最多调用次数，如 {"send_text": 20, "send_image": 5}
+    "async_mode": False,  # 是否使用协程处理文本消息，开启后等待大模型回复时不占用线程，可同时处理大量请求
+    "async_max_inflight": 256,  # async_mode下同时处理中的文本消息数上限
+    "async_offload_workers": 16,  # async_mode下执行同步插件、bot及发送接口的线程数
+    "worker_processes": 0,  # 按会话分片处理消息的工作进程数，同一会话的消息总在同一进程中处理，0表示在渠道进程中处理
+    "shard_worker_threads": 8,  # 每个工作进程中处理消息的线程数
+    "handler_lanes": {},  # 消息处理分道的线程池配置，分道有text, voice, image, admin，如 {"voice": {"max_workers": 2, "max_queue": 16}}
     "image_create_size": "256x256",  # 图片大小,可选有 256x256, 512x512, 1024x1024 (dall-e-3默认为1024x1024)
     "group_chat_exit_group": False,
     # chatgpt会话参数
     "expires_in_seconds": 3600,  # 无操作会话的过期时间
+    "session_store": "",  # 会话持久化存储，sqlite表示保存到本地SQLite数据库，重启后会话不丢失，为空时只保存在内存中
+    "session_store_path": "",  # SQLite数据库文件路径，默认为数据目录下的sessions.db
+    "session_hot_max_count": 1000,  # 使用会话存储时内存中最多保留的会话数，其余会话在访问时从数据库加载
+    "session_hot_max_bytes": 0,  # 使用会话存储时内存中会话的总字节数上限，0表示不限制
+    "session_flush_interval": 5,  # 修改过的会话批量写入数据库的间隔(秒)
+    "session_memory_budget": 0,  # 所有会话内容的总字符数上限，超出时淘汰最久未使用的会话，0表示不限制
+    "session_memory_quotas": {},  # 按会话类型设置的字符数上限，如 {"ChatGPTSession": 5000000}
     # 人格描述
     "character_desc": "你是ChatGPT, 一个由OpenAI训练的大型语言模型, 你旨在回答并解决人们的任何问题，并且可以使用多种语言与人交流。",
     "conversation_max_tokens": 1000,  # 支持上下文记忆的最多字符数
+    "stream_reply": False,  # 是否开启流式回复，目前支持ChatGPT，生成的文本边生成边发送
+    "stream_flush_chars": 200,  # 不支持更新消息的通道，流式回复累计超过该字符数后在段落或句末切分，作为一条消息发送
+    "stream_update_interval": 1,  # 支持更新消息的通道(飞书、钉钉AI卡片)，流式回复更新消息的最短间隔(秒)
+    "conversation_summary": False,  # 是否开启对话摘要，上下文接近上限时在后台把较早的对话压缩成摘要，而不是直接丢弃
+    "conversation_summary_model": "gpt-4o-mini",  # 生成摘要使用的模型，通过open_ai_api_key和open_ai_api_base调用OpenAI接口
+    "conversation_summary_ratio": 0.8,  # 上下文达到conversation_max_tokens的该比例时开始生成摘要
+    "conversation_summary_keep": 4,  # 生成摘要时保留的最近消息条数
     # chatgpt限流配置
     "rate_limit_chatgpt": 20,  # chatgpt的调用频率限制
     "rate_limit_dalle": 50,  # openai dalle的调用频率限制
+    "rate_limit_chatgpt_per_user": 0,  # 单个用户每分钟最多提问次数，超出时直接提示，0表示不限制
     # chatgpt api参数 参考https://platform.openai.com/docs/api-reference/chat/create
     "temperature": 0.9,
     "top_p": 1,
@@ -79,6 +117,11 @@ available_setting = {
     "presence_penalty": 0,
     "request_timeout": 180,  # chatgpt请求超时时间，openai接口默认设置为600，对于难问题一般需要较长时间
     "timeout": 120,  # chatgpt重试超时时间，在这个时间内，将会自动重试
+    "http_connect_timeout": 10,  # 未指定超时的HTTP请求的连接超时时间(秒)
+    "http_read_timeout": 180,  # 未指定超时的HTTP请求的读取超时时间(秒)
+    "http_pool_size": 10,  # 每个host保持的keep-alive连接数
+    "http_async_pool_size": 100,  # 异步请求的最大并发连接数
+    "http_backend": "requests",  # HTTP请求使用的后端，设置为httpx时使用HTTP/2，需要安装httpx[http2]
     # Baidu 文心一言参数
     "baidu_wenxin_model": "eb-instant",  # 默认使用ERNIE-Bot-turbo模型
     "baidu_wenxin_api_key": "",  # Baidu api key
@@ -174,7 +217,13 @@ available_setting = {
     "channel_type": "",  # 通道类型，支持：{wx,wxy,terminal,wechatmp,wechatmp_service,wechatcom_app,dingtalk}
     "subscribe_msg": "",  # 订阅消息, 支持: wechatmp, wechatmp_service, wechatcom_app
     "debug": False,  # 是否开启debug模式，开启后会打印更多日志
+    "log_module_levels": {},  # 按模块设置日志级别，如 {"chat_channel": "DEBUG"}，模块名为文件名
+    "log_file": "run.log",  # 日志文件，为空时只输出到控制台
+    "log_max_bytes": 10 * 1024 * 1024,  # 日志文件超过该大小时轮转，0表示不按大小轮转
+    "log_backup_count": 5,  # 保留的历史日志文件数
+    "log_rotate_when": "",  # 按时间轮转日志，如midnight表示每天零点轮转，设置后不再按大小轮转
     "appdata_dir": "",  # 数据目录
+    "tiktoken_cache_dir": "",  # tiktoken的BPE文件缓存目录，默认为数据目录下的tiktoken_cache目录，离线部署时把已下载的文件放入该目录
     # 插件配置
     "plugin_trigger_prefix": "$",  # 规范插件提供聊天相关指令的前缀，建议不要和管理员指令前缀"#"冲突
     # 是否使用全局插件配置
@@ -198,9 +247,46 @@ available_setting = {
 }
 
 
+# 配置版本号，每次修改或重新加载配置后递增
+_config_versions = itertools.count(1)
+_snapshot_lock = threading.Lock()
+
+
+class ConfigSnapshot:
+    """
+    配置的只读快照，配置项可以作为属性直接访问，未配置的项为None
+    配置修改或重新加载后生成新的快照，处理一条消息时始终使用同一个快照，不会读到修改了一半的配置
+    """
+
+    def __init__(self, config: dict, version):
+        values = self.__dict__
+        values.update(copy.deepcopy(dict(config)))
+        values["version"] = version
+        # 预先计算的派生值
+        values["trigger"] = TriggerMatcher(config)
+        values["nick_name_black_set"] = frozenset(config.get("nick_name_black_list") or [])
+
+    def __getattr__(self, key):
+        # 只有在配置中不存在时才会调用
+        if key.startswith("__"):
+            raise AttributeError(key)
+        return None
+
+    def __setattr__(self, key, value):
+        raise AttributeError("config snapshot is read-only")
+
+    def __delattr__(self, key):
+        raise AttributeError("config snapshot is read-only")
+
+    def get(self, key, default=None):
+        return self.__dict__.get(key, default)
+
+
 class Config(dict):
     def __init__(self, d=None):
         super().__init__()
+        self.version = next(_config_versions)
+        self._snapshot = None
         if d is None:
             d = {}
         for k, v in d.items():
@@ -216,7 +302,23 @@ class Config(dict):
     def __setitem__(self, key, value):
         if key not in available_setting:
             raise Exception("key {} not in available_setting".format(key))
-        return super().__setitem__(key, value)
+        with _snapshot_lock:
+            super().__setitem__(key, value)
+            self.version = next(_config_versions)
+            self._snapshot = None
+
+    def snapshot(self) -> ConfigSnapshot:
+        """
+        获取当前版本配置的只读快照，版本不变时返回同一个对象
+        注意直接修改列表等配置值的内容不会生成新版本，修改配置请使用conf()[key] = value
+        """
+        snapshot = self._snapshot
+        if snapshot is None:
+            with _snapshot_lock:
+                if self._snapshot is None:
+                    self._snapshot = ConfigSnapshot(self, self.version)
+                snapshot = self._snapshot
+        return snapshot
 
     def get(self, key, default=None):
         try:
@@ -289,8 +391,8 @@ def load_config():
     config_str = read_file(config_path)
     logger.debug("[INIT] config str: {}".format(drag_sensitive(config_str)))
 
-    # 将json字符串反序列化为dict类型
-    config = Config(json.loads(config_str))
+    # 将json字符串反序列化为dict类型，全部处理完成后再替换全局配置，避免其他线程读到加载了一半的配置
+    new_config = Config(json.loads(config_str))
 
     # override config with environment variables.
     # Some online deployment platforms (e.g. Railway) deploy project from github directly. So you shouldn't put your secrets like api key in a config file, instead use environment variables to override the default config.
@@ -299,21 +401,29 @@ def load_config():
         if name in available_setting:
             logger.info("[INIT] override config by environ args: {}={}".format(name, value))
             try:
-                config[name] = eval(value)
+                new_config[name] = eval(value)
             except:
                 if value == "false":
-                    config[name] = False
+                    new_config[name] = False
                 elif value == "true":
-                    config[name] = True
+                    new_config[name] = True
                 else:
-                    config[name] = value
-
-    if config.get("debug", False):
-        logger.setLevel(logging.DEBUG)
+                    new_config[name] = value
+
+    configure_logger(
+        level=logging.DEBUG if new_config.get("debug", False) else logging.INFO,
+        module_levels=new_config.get("log_module_levels"),
+        log_file=new_config.get("log_file", "run.log"),
+        max_bytes=new_config.get("log_max_bytes", 10 * 1024 * 1024),
+        backup_count=new_config.get("log_backup_count", 5),
+        rotate_when=new_config.get("log_rotate_when", ""),
+    )
+    if new_config.get("debug", False):
         logger.debug("[INIT] set log level to DEBUG")
 
-    logger.info("[INIT] load config: {}".format(drag_sensitive(config)))
+    logger.info("[INIT] load config: {}".format(drag_sensitive(new_config)))
 
+    config = new_config
     config.load_user_datas()
 
 
@@ -330,6 +440,13 @@ def conf():
     return config
 
 
+def conf_snapshot() -> ConfigSnapshot:
+    """
+    当前配置的只读快照，适合在处理消息的热点路径中读取配置
+    """
+    return config.snapshot()
+
+
 def get_appdata_dir():
     data_path = os.path.join(get_root(), conf().get("appdata_dir", ""))
     if not os.path.exists(data_path):
@@ -1,5 +1,4 @@
 import plugins
-import requests
 import re
 import json
 import io
@@ -7,6 +6,7 @@ from urllib.parse import urlparse
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
 from channel import channel
+from common import http_client
 from common.log import logger
 from plugins import *
 from datetime import datetime, timedelta
@@ -521,9 +521,9 @@ class Apilot(Plugin):
     def make_request(self, url, method="GET", headers=None, params=None, data=None, json_data=None):
         try:
             if method.upper() == "GET":
-                response = requests.request(method, url, headers=headers, params=params)
+                response = http_client.request(method, url, headers=headers, params=params)
             elif method.upper() == "POST":
-                response = requests.request(method, url, headers=headers, data=data, json=json_data)
+                response = http_client.request(method, url, headers=headers, data=data, json=json_data)
             else:
                 return {"success": False, "message": "Unsupported HTTP method"}
 
@@ -7,6 +7,7 @@ import plugins
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
 from common.log import logger
+from common.stream_utils import map_sentences
 from plugins import *
 
 from .lib.WordsSearch import WordsSearch
@@ -77,6 +78,9 @@ class Banwords(Plugin):
                 return
 
     def on_decorate_reply(self, e_context: EventContext):
+        if e_context["reply"].type == ReplyType.STREAM:
+            e_context["reply"].content = map_sentences(e_context["reply"].content, self.filter_stream_sentence)
+            return
         if e_context["reply"].type not in [ReplyType.TEXT]:
             return
 
@@ -96,5 +100,19 @@ class Banwords(Plugin):
                 e_context.action = EventAction.CONTINUE
                 return
 
+    def filter_stream_sentence(self, sentence):
+        """
+        流式回复逐句过滤，已发送的内容无法撤回，ignore时从包含敏感词的句子起停止回复
+        """
+        if self.reply_action == "ignore":
+            f = self.searchr.FindFirst(sentence)
+            if f:
+                logger.info("[Banwords] %s in stream reply, stop replying" % f["Keyword"])
+                return None
+        elif self.reply_action == "replace":
+            if self.searchr.ContainsAny(sentence):
+                return self.searchr.Replace(sentence)
+        return sentence
+
     def get_help_text(self, **kwargs):
         return "过滤消息中的敏感词。"
@@ -4,11 +4,11 @@ import os
 import uuid
 from uuid import getnode as get_mac
 
-import requests
 
 import plugins
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
+from common import http_client
 from common.log import logger
 from plugins import *
 
@@ -75,7 +75,7 @@ class BDunit(Plugin):
         payload = ""
         headers = {"Content-Type": "application/json", "Accept": "application/json"}
 
-        response = requests.request("POST", url, headers=headers, data=payload)
+        response = http_client.request("POST", url, headers=headers, data=payload)
 
         # print(response.text)
         return response.json()["access_token"]
@@ -102,7 +102,7 @@ class BDunit(Plugin):
         }
         try:
             headers = {"Content-Type": "application/json"}
-            response = requests.post(url, json=body, headers=headers)
+            response = http_client.post(url, json=body, headers=headers)
             return json.loads(response.text)
         except Exception:
             return None
@@ -125,7 +125,7 @@ class BDunit(Plugin):
         }
         try:
             headers = {"Content-Type": "application/json"}
-            response = requests.post(url, json=body, headers=headers)
+            response = http_client.post(url, json=body, headers=headers)
             return json.loads(response.text)
         except Exception:
             return None
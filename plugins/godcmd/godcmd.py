@@ -9,6 +9,7 @@ from typing import Tuple
 
 import bridge.bridge
 import plugins
+from bot.session_memory import session_memory
 from bridge.bridge import Bridge
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
@@ -137,6 +138,14 @@ ADMIN_COMMANDS = {
         "alias": ["debug", "调试模式", "DEBUG"],
         "desc": "开启机器调试日志",
     },
+    "stats": {
+        "alias": ["stats", "运行状态"],
+        "desc": "查看消息队列等运行指标",
+    },
+    "sessions": {
+        "alias": ["sessions", "会话占用"],
+        "desc": "查看占用内存最多的会话",
+    },
     "enable_tools": {
         "alias": ["enable_tools", "开启工具"],
         "desc": "开启工具"
@@ -370,6 +379,22 @@ class Godcmd(Plugin):
                             else:
                                 logger.setLevel(logging.DEBUG)
                                 ok, result = True, "DEBUG模式已开启"
+                        elif cmd == "stats":
+                            stats = getattr(channel, "stats", None)
+                            if stats is None:
+                                ok, result = False, "当前通道不支持查看运行指标"
+                            else:
+                                ok = True
+                                result = "运行指标：\n" + "\n".join(f"{k}: {v}" for k, v in stats.items())
+                        elif cmd == "sessions":
+                            if not session_memory.enabled():
+                                ok, result = False, "未设置session_memory_budget或session_memory_quotas，不统计会话占用"
+                            else:
+                                ok = True
+                                session_memory.sweep()
+                                result = f"会话总占用：{session_memory.total}\n" + "\n".join(
+                                    f"{namespace} {session_id}: {size}" for namespace, session_id, size in session_memory.largest(10)
+                                )
                         elif cmd == "plist":
                             plugins = PluginManager().list_plugins()
                             ok = True
@@ -1,7 +1,7 @@
 from enum import Enum
 from config import conf
+from common import http_client
 from common.log import logger
-import requests
 import threading
 import time
 from bridge.reply import Reply, ReplyType
@@ -199,7 +199,7 @@ class MJBot:
         body = {"prompt": prompt, "mode": mode, "auto_translate": self.config.get("auto_translate")}
         if not self.config.get("img_proxy"):
             body["img_proxy"] = False
-        res = requests.post(url=self.base_url + "/generate", json=body, headers=self.headers, timeout=(5, 40))
+        res = http_client.post(url=self.base_url + "/generate", json=body, headers=self.headers, timeout=(5, 40))
         if res.status_code == 200:
             res = res.json()
             logger.debug(f"[MJ] image generate, res={res}")
@@ -240,7 +240,7 @@ class MJBot:
             body["index"] = index
         if not self.config.get("img_proxy"):
             body["img_proxy"] = False
-        res = requests.post(url=self.base_url + "/operate", json=body, headers=self.headers, timeout=(5, 40))
+        res = http_client.post(url=self.base_url + "/operate", json=body, headers=self.headers, timeout=(5, 40))
         logger.debug(res)
         if res.status_code == 200:
             res = res.json()
@@ -274,7 +274,7 @@ class MJBot:
             time.sleep(10)
             url = f"{self.base_url}/tasks/{task.id}"
             try:
-                res = requests.get(url, headers=self.headers, timeout=8)
+                res = http_client.get(url, headers=self.headers, timeout=8)
                 if res.status_code == 200:
                     res_json = res.json()
                     logger.debug(f"[MJ] task check res sync, task_id={task.id}, status={res.status_code}, "
@@ -432,6 +432,9 @@ class MJBot:
         return base_enabled or remote_enabled
 
 def _send(channel, reply: Reply, context, retry_cnt=0):
+    if hasattr(channel, "_send"):  # ChatChannel自带非阻塞的发送重试
+        channel._send(reply, context)
+        return
     try:
         channel.send(reply, context)
     except Exception as e:
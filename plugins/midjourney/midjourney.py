@@ -7,6 +7,7 @@ from bridge.reply import Reply, ReplyType
 from channel.chat_message import ChatMessage
 from channel.channel_factory import create_channel
 
+from common import http_client
 from common.log import logger
 from common.expired_dict import ExpiredDict
 from config import conf
@@ -17,7 +18,6 @@ from plugins import *
 import base64
 import os
 import io
-import requests
 
 
 @plugins.register(
@@ -155,15 +155,15 @@ class Midjourney(Plugin):
         return self.post_json('/submit/imagine', {'prompt': prompt, 'base64': base64_str, 'state': state})
 
     def post_json(self, api_path, data):
-        return requests.post(url=self.proxy_server + api_path, json=data,
+        return http_client.post(url=self.proxy_server + api_path, json=data,
                              headers={'mj-api-secret': self.proxy_api_secret}).json()
 
     def get_task(self, task_id):
-        return requests.get(url=self.proxy_server + '/task/%s/fetch' % task_id,
+        return http_client.get(url=self.proxy_server + '/task/%s/fetch' % task_id,
                             headers={'mj-api-secret': self.proxy_api_secret}).json()
     
     def get_task_image_seed(self, task_id):
-        return requests.get(url=self.proxy_server + '/task/%s/image-seed' % task_id,
+        return http_client.get(url=self.proxy_server + '/task/%s/image-seed' % task_id,
                         headers={'mj-api-secret': self.proxy_api_secret}).json()
 
     def add_task(self, task_id):
@@ -245,7 +245,7 @@ class Midjourney(Plugin):
 
     def download_and_compress_image(self, img_url, max_size=(800, 800)):  # 下载并压缩图片
         # 下载图片
-        pic_res = requests.get(img_url, stream=True)
+        pic_res = http_client.get(img_url, stream=True)
         image_storage = io.BytesIO()
         for block in pic_res.iter_content(1024):
             image_storage.write(block)
@@ -1,11 +1,13 @@
 # encoding:utf-8
 
+import asyncio
 import importlib
 import importlib.util
 import json
 import os
 import sys
 
+from common.async_utils import run_in_thread
 from common.log import logger
 from common.singleton import singleton
 from common.sorted_dict import SortedDict
@@ -128,7 +130,7 @@ class PluginManager:
             else:
                 self.plugins[name].enabled = pconf["plugins"][rawname]["enabled"]
                 self.plugins[name].priority = pconf["plugins"][rawname]["priority"]
-                self.plugins._update_heap(name)  # 更新下plugins中的顺序
+                self.plugins.update_order(name)  # 更新下plugins中的顺序
         if modified:
             self.save_config()
         return new_plugins
@@ -181,7 +183,7 @@ class PluginManager:
         # 加载全量插件配置
         self._load_all_config()
         pconf = self.pconf
-        logger.debug("plugins.json config={}".format(pconf))
+        logger.debug("plugins.json config=%s", pconf)
         for name, plugin in pconf["plugins"].items():
             if name.upper() not in self.plugins:
                 logger.error("Plugin %s not found, but found in plugins.json" % name)
@@ -191,12 +193,29 @@ class PluginManager:
         if e_context.event in self.listening_plugins:
             for name in self.listening_plugins[e_context.event]:
                 if self.plugins[name].enabled and e_context.action == EventAction.CONTINUE:
-                    logger.debug("Plugin %s triggered by event %s" % (name, e_context.event))
+                    logger.debug("Plugin %s triggered by event %s", name, e_context.event)
                     instance = self.instances[name]
                     instance.handlers[e_context.event](e_context, *args, **kwargs)
                     if e_context.is_break():
                         e_context["breaked_by"] = name
-                        logger.debug("Plugin %s breaked event %s" % (name, e_context.event))
+                        logger.debug("Plugin %s breaked event %s", name, e_context.event)
+        return e_context
+
+    # async_mode下使用，插件的处理函数为协程时直接await，同步的处理函数放到线程中执行，避免阻塞事件循环
+    async def aemit_event(self, e_context: EventContext, *args, **kwargs):
+        if e_context.event in self.listening_plugins:
+            for name in self.listening_plugins[e_context.event]:
+                if self.plugins[name].enabled and e_context.action == EventAction.CONTINUE:
+                    logger.debug("Plugin %s triggered by event %s", name, e_context.event)
+                    instance = self.instances[name]
+                    handler = instance.handlers[e_context.event]
+                    if asyncio.iscoroutinefunction(handler):
+                        await handler(e_context, *args, **kwargs)
+                    else:
+                        await run_in_thread(handler, e_context, *args, **kwargs)
+                    if e_context.is_break():
+                        e_context["breaked_by"] = name
+                        logger.debug("Plugin %s breaked event %s", name, e_context.event)
         return e_context
 
     def set_plugin_priority(self, name: str, priority: int):
@@ -206,10 +225,10 @@ class PluginManager:
         if self.plugins[name].priority == priority:
             return True
         self.plugins[name].priority = priority
-        self.plugins._update_heap(name)
+        self.plugins.update_order(name)
         rawname = self.plugins[name].name
         self.pconf["plugins"][rawname]["priority"] = priority
-        self.pconf["plugins"]._update_heap(rawname)
+        self.pconf["plugins"].update_order(rawname)
         self.save_config()
         self.refresh_order()
         return True
@@ -1,8 +1,8 @@
 import json
-import requests
 import openai
 import datetime
 from config import conf, load_config
+from common import http_client
 from common.log import logger
 from concurrent.futures.thread import ThreadPoolExecutor
 import concurrent
@@ -139,7 +139,7 @@ class Tools:
     def summary_by_jina(self, url):
         try:
             url = html.unescape(url)
-            response = requests.get(f'{self.jina_reader_base}/{url}', timeout=60)
+            response = http_client.get(f'{self.jina_reader_base}/{url}', timeout=60)
             return response.text
         except Exception:
             return ''
@@ -165,7 +165,7 @@ class Tools:
             "q": question,
             "max_results": max_results
         }
-        response = requests.get(self.ddg_base, params=params)
+        response = http_client.get(self.ddg_base, params=params)
         ddg_response = response.json()
         if ddg_response := response.json():
             # 利用jina reader总结网页内容
@@ -186,7 +186,7 @@ class Tools:
             "city": city
         }
         url = 'https://api.vvhan.com/api/weather'
-        response = requests.get(url, params=params)
+        response = http_client.get(url, params=params)
         data = response.json()["data"]
         return json.dumps(data)
 